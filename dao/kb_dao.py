@@ -1,9 +1,75 @@
-from typing import List, Dict, Any, Optional
+import re
+import time
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 
-from elasticsearch import Elasticsearch
+from elasticsearch import ConflictError, Elasticsearch, RequestError
+from elasticsearch.helpers import bulk, scan, streaming_bulk
 
 from dao.init import get_es_client
-from models.kb import KB_INDEX, KB_DOC_INDEX, KB_DOC_EMBED_INDEX
+from define import (
+    VECTOR_SEARCH_MODE,
+    KNN_NUM_CANDIDATES,
+    ES_VECTOR_INDEX_TYPE,
+    VECTOR_SIMILARITY,
+    EMBEDDING_SCAN_PAGE_SIZE,
+    EMBEDDING_SCAN_KEEP_ALIVE,
+)
+from models.kb import (
+    KB_INDEX,
+    KB_DOC_INDEX,
+    KB_DOC_EMBED_INDEX,
+    DEFAULT_EMBEDDING_MODEL,
+    DEFAULT_EMBEDDING_DIMS,
+)
+
+# every vector index: the default one, its reindexed copies and the per-dims ones
+ALL_EMBED_INDICES = f"{KB_DOC_EMBED_INDEX}*"
+
+
+# dotProduct gives the cosine without the norm passes, but only on unit-length stored vectors
+_SCRIPT_SCORE_SOURCES = {
+    "dot_product": "dotProduct(params.query_vector, 'embedding') + 1.0",
+    "cosine": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
+}
+
+
+# chunk dedup: a vector is owned by doc_uuid and may be referenced by other docs of the kb
+_DEDUP_MAPPING = {"dedup_hash": {"type": "keyword"}, "ref_doc_uuids": {"type": "keyword"}}
+_dedup_mapping_ready = False
+
+_ADD_REF_SCRIPT = (
+    "if (ctx._source.ref_doc_uuids == null) { ctx._source.ref_doc_uuids = []; } "
+    "if (!ctx._source.ref_doc_uuids.contains(params.doc_uuid)) { ctx._source.ref_doc_uuids.add(params.doc_uuid); }"
+)
+# drop docs from a vector's references; a vector they own moves to the next referencing
+# doc, or is deleted when nobody else references it
+_RELEASE_REFS_SCRIPT = (
+    "List refs = ctx._source.ref_doc_uuids; "
+    "if (refs == null) { refs = []; } "
+    "refs.removeIf(d -> params.doc_uuids.contains(d)); "
+    "ctx._source.ref_doc_uuids = refs; "
+    "if (params.doc_uuids.contains(ctx._source.doc_uuid)) { "
+    "if (refs.isEmpty()) { ctx.op = 'delete'; } else { ctx._source.doc_uuid = refs.remove(0); } }"
+)
+
+# a re-embed migration is claimed when the kb has none, the caller already owns it,
+# or its owner stopped sending heartbeats (migrations without heartbeat_at count as stale)
+_CLAIM_MIGRATION_SCRIPT = (
+    "def m = ctx._source.embed_migration; "
+    "if (m != null && m.owner != params.migration.owner "
+    "&& (m.heartbeat_at == null ? 0 : m.heartbeat_at) >= params.stale_before) { ctx.op = 'noop'; } "
+    "else { ctx._source.embed_migration = params.migration; }"
+)
+_OWNED_MIGRATION_UPDATE_SCRIPT = (
+    "def m = ctx._source.embed_migration; "
+    "if (m == null || m.owner != params.owner) { ctx.op = 'noop'; } "
+    "else { for (entry in params.fields.entrySet()) { ctx._source[entry.getKey()] = entry.getValue(); } }"
+)
+
+_BUMP_GENERATION_SCRIPT = (
+    "ctx._source.generation = (ctx._source.generation ?: 0) + 1; "
+    "ctx._source.generation_at = params.now"
+)
 
 
 def _ensure_indices(client: Elasticsearch) -> None:
@@ -44,22 +110,59 @@ def _ensure_indices(client: Elasticsearch) -> None:
 
     # vector index (store embeddings for server-side similarity)
     if not client.indices.exists(index=KB_DOC_EMBED_INDEX):
-        client.indices.create(
-            index=KB_DOC_EMBED_INDEX,
-            mappings={
-                "properties": {
-                    "uuid": {"type": "keyword"},
-                    "kb_uuid": {"type": "keyword"},
-                    "doc_uuid": {"type": "keyword"},
-                    "chunk": {"type": "text"},
-                    "embedding": {
-                        "type": "dense_vector",
-                        "dims": 1536,
-                    },
-                    "create_at": {"type": "long"},
-                }
-            },
-        )
+        client.indices.create(index=KB_DOC_EMBED_INDEX, mappings=_embed_index_mappings())
+    _ensure_dedup_mapping(client)
+
+
+def _ensure_dedup_mapping(client: Elasticsearch) -> None:
+    """vector indices created before chunk dedup get its keyword fields, once per process"""
+    global _dedup_mapping_ready
+    if not _dedup_mapping_ready:
+        client.indices.put_mapping(index=ALL_EMBED_INDICES, body={"properties": _DEDUP_MAPPING})
+        _dedup_mapping_ready = True
+
+
+def embed_index_name(model: str, dims: int) -> str:
+    """
+    vector index of one (embedding model, dims) pair, kbs embedded the same way share it.
+    the original ada-002 vectors stay in kb_doc_embed_index.
+    """
+    if model == DEFAULT_EMBEDDING_MODEL and dims == DEFAULT_EMBEDDING_DIMS:
+        return KB_DOC_EMBED_INDEX
+    slug = re.sub(r"[^a-z0-9]+", "-", model.lower()).strip("-")
+    return f"{KB_DOC_EMBED_INDEX}_{slug}_{dims}"
+
+
+def ensure_embed_index(index: str, dims: int) -> None:
+    client = get_es_client()
+    _ensure_indices(client)
+    if not client.indices.exists(index=index):
+        client.indices.create(index=index, mappings=_embed_index_mappings(dims))
+
+
+def _embed_index_mappings(dims: int = DEFAULT_EMBEDDING_DIMS) -> Dict[str, Any]:
+    """
+    vector index mapping. in knn mode the vectors are HNSW-indexed
+    (needs ES 8+), otherwise they are only stored for script_score.
+    """
+    embedding: Dict[str, Any] = {"type": "dense_vector", "dims": dims}
+    if VECTOR_SEARCH_MODE == "knn":
+        embedding.update({"index": True, "similarity": VECTOR_SIMILARITY})
+        if ES_VECTOR_INDEX_TYPE:
+            # e.g. int8_hnsw (ES 8.12+) keeps int8 codes in the HNSW graph
+            embedding["index_options"] = {"type": ES_VECTOR_INDEX_TYPE}
+    return {
+        "properties": {
+            "uuid": {"type": "keyword"},
+            "kb_uuid": {"type": "keyword"},
+            "doc_uuid": {"type": "keyword"},
+            "chunk": {"type": "text"},
+            "chunk_hash": {"type": "keyword"},
+            **_DEDUP_MAPPING,
+            "embedding": embedding,
+            "create_at": {"type": "long"},
+        }
+    }
 
 
 # ==== kb ====
@@ -90,7 +193,82 @@ def update_kb(uuid: str, fields: Dict[str, Any], owner_uuid: Optional[str] = Non
     if not hits:
         return
     kb_id = hits[0]["_id"]
-    client.update(index=KB_INDEX, id=kb_id, doc=fields)
+    # the kb doc is also updated by generation bumps and migration scripts
+    client.update(index=KB_INDEX, id=kb_id, doc=fields, retry_on_conflict=5)
+
+
+def _scripted_kb_update(kb_uuid: str, source: str, params: Dict[str, Any]) -> bool:
+    """run a painless update on the kb doc, False when the script chose noop (or the kb is gone)"""
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.search(index=KB_INDEX, query={"term": {"uuid": kb_uuid}}, _source=False)
+    hits = res.get("hits", {}).get("hits", [])
+    if not hits:
+        return False
+    result = client.update(
+        index=KB_INDEX,
+        id=hits[0]["_id"],
+        script={"source": source, "params": params},
+        retry_on_conflict=5,
+        refresh="wait_for",
+    )
+    return result.get("result") != "noop"
+
+
+def claim_kb_migration(kb_uuid: str, migration: Dict[str, Any], stale_before: int) -> bool:
+    """
+    set embed_migration (with its owner and heartbeat_at) unless another owner holds
+    a migration with a heartbeat at or after stale_before (ms)
+    """
+    return _scripted_kb_update(
+        kb_uuid, _CLAIM_MIGRATION_SCRIPT, {"migration": migration, "stale_before": stale_before}
+    )
+
+
+def update_kb_if_migration_owner(kb_uuid: str, owner: str, fields: Dict[str, Any]) -> bool:
+    """update kb fields only while owner still holds the kb's embed_migration"""
+    return _scripted_kb_update(kb_uuid, _OWNED_MIGRATION_UPDATE_SCRIPT, {"owner": owner, "fields": fields})
+
+
+def list_migrating_kbs() -> List[Dict[str, Any]]:
+    """kbs with an embed_migration set"""
+    client = get_es_client()
+    _ensure_indices(client)
+    return [
+        hit["_source"]
+        for hit in scan(client, index=KB_INDEX, query={"query": {"exists": {"field": "embed_migration.index"}}})
+    ]
+
+
+def _bump_generation(client: Elasticsearch, kb_uuid: str) -> None:
+    """
+    +1 on the generation of the kb, done after every write to its docs or vectors.
+    retrieval results are cached per generation; generation_at (ms) tells readers
+    when the writes before it are searchable (after the next ES refresh).
+    the write itself succeeded already, a failed bump is only logged: cached
+    retrieval results of the kb then live until RETRIEVAL_CACHE_TTL or the next bump.
+    """
+    try:
+        res = client.search(index=KB_INDEX, query={"term": {"uuid": kb_uuid}}, _source=False)
+        for hit in res.get("hits", {}).get("hits", []):
+            client.update(
+                index=KB_INDEX,
+                id=hit["_id"],
+                script={"source": _BUMP_GENERATION_SCRIPT, "params": {"now": int(time.time() * 1000)}},
+                retry_on_conflict=5,
+            )
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] failed to bump generation of kb {kb_uuid}: {exc}")
+
+
+def bump_kb_generation(kb_uuid: str) -> None:
+    """
+    for kb changes outside the doc/vector writes below, e.g. a vector index cutover,
+    and once after a batch of writes made with bump=False
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    _bump_generation(client, kb_uuid)
 
 
 def delete_kb(uuid: str) -> None:
@@ -104,7 +282,7 @@ def delete_kb(uuid: str) -> None:
 
     # cascade delete doc and vector
     client.delete_by_query(index=KB_DOC_INDEX, body={"query": {"term": {"kb_uuid": uuid}}})
-    client.delete_by_query(index=KB_DOC_EMBED_INDEX, body={"query": {"term": {"kb_uuid": uuid}}})
+    client.delete_by_query(index=ALL_EMBED_INDICES, body={"query": {"term": {"kb_uuid": uuid}}})
 
 
 def list_kb(page: int, size: int, owner_uuid: str) -> Dict[str, Any]:
@@ -145,10 +323,28 @@ def get_kb(uuid: str, owner_uuid: Optional[str] = None) -> Optional[Dict[str, An
 # ==== doc ====
 
 
-def create_doc(doc: Dict[str, Any]) -> None:
+def create_doc(doc: Dict[str, Any], bump: bool = True) -> None:
     client = get_es_client()
     _ensure_indices(client)
     client.index(index=KB_DOC_INDEX, document=doc)
+    if bump:
+        _bump_generation(client, doc["kb_uuid"])
+
+
+def create_doc_once(doc: Dict[str, Any], bump: bool = True) -> bool:
+    """
+    create the doc with its uuid as the ES id, in a single round trip.
+    False when a doc with that id exists already (a retried write).
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    try:
+        client.create(index=KB_DOC_INDEX, id=doc["uuid"], document=doc)
+    except ConflictError:
+        return False
+    if bump:
+        _bump_generation(client, doc["kb_uuid"])
+    return True
 
 
 def update_doc(uuid: str, fields: Dict[str, Any]) -> None:
@@ -160,6 +356,7 @@ def update_doc(uuid: str, fields: Dict[str, Any]) -> None:
         return
     doc_id = hits[0]["_id"]
     client.update(index=KB_DOC_INDEX, id=doc_id, doc=fields)
+    _bump_generation(client, hits[0]["_source"]["kb_uuid"])
 
 
 def delete_doc(uuid: str) -> None:
@@ -171,11 +368,47 @@ def delete_doc(uuid: str) -> None:
     for hit in hits:
         client.delete(index=KB_DOC_INDEX, id=hit["_id"])
 
-    # delete corresponding vector
+    # delete corresponding vector, in every vector index the kb may write to;
+    # vectors other docs still reference are handed over to them first
+    _release_shared_embeddings(client, [uuid])
     client.delete_by_query(
-        index=KB_DOC_EMBED_INDEX,
+        index=ALL_EMBED_INDICES,
         body={"query": {"term": {"doc_uuid": uuid}}},
     )
+    for kb_uuid in {hit["_source"]["kb_uuid"] for hit in hits}:
+        _bump_generation(client, kb_uuid)
+
+
+def delete_docs(kb_uuid: str, doc_uuids: List[str]) -> None:
+    """bulk variant of delete_doc for docs of one kb"""
+    if not doc_uuids:
+        return
+    client = get_es_client()
+    _ensure_indices(client)
+    client.delete_by_query(
+        index=KB_DOC_INDEX,
+        body={"query": {"bool": {"filter": [{"term": {"kb_uuid": kb_uuid}}, {"terms": {"uuid": doc_uuids}}]}}},
+    )
+    _release_shared_embeddings(client, doc_uuids)
+    client.delete_by_query(
+        index=ALL_EMBED_INDICES,
+        body={"query": {"bool": {"filter": [{"term": {"kb_uuid": kb_uuid}}, {"terms": {"doc_uuid": doc_uuids}}]}}},
+    )
+    _bump_generation(client, kb_uuid)
+
+
+def iter_kb_docs(kb_uuid: str, source_includes: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    """stream every doc of a kb (scroll), unlike list_docs not limited by from + size"""
+    client = get_es_client()
+    _ensure_indices(client)
+    for hit in scan(
+        client,
+        index=KB_DOC_INDEX,
+        query={"query": {"term": {"kb_uuid": kb_uuid}}},
+        _source=source_includes or True,
+        size=EMBEDDING_SCAN_PAGE_SIZE,
+    ):
+        yield hit["_source"]
 
 
 def list_docs(kb_uuid: str, page: int, size: int) -> Dict[str, Any]:
@@ -206,8 +439,31 @@ def get_doc(uuid: str) -> Optional[Dict[str, Any]]:
 # ==== vector ====
 
 
+def _embedding_body(kb_uuid: str, doc_uuid: str, item: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "uuid": item["uuid"],
+        "kb_uuid": kb_uuid,
+        "doc_uuid": doc_uuid,
+        "chunk": item["chunk"],
+        "chunk_hash": item.get("chunk_hash"),
+        "dedup_hash": item.get("dedup_hash"),
+        "ref_doc_uuids": item.get("ref_doc_uuids") or [],
+        "embedding": item["embedding"],
+        "create_at": item["create_at"],
+    }
+
+
+def _embedding_action(index: str, kb_uuid: str, doc_uuid: str, item: Dict[str, Any]) -> Dict[str, Any]:
+    """bulk index action, the vector uuid is the ES _id so a rewrite of the same chunk is idempotent"""
+    return {"_index": index, "_id": item["uuid"], "_source": _embedding_body(kb_uuid, doc_uuid, item)}
+
+
 def upsert_doc_embeddings(
-    kb_uuid: str, doc_uuid: str, chunks_with_embeddings: List[Dict[str, Any]]
+    kb_uuid: str,
+    doc_uuid: str,
+    chunks_with_embeddings: List[Dict[str, Any]],
+    index: str = KB_DOC_EMBED_INDEX,
+    bump: bool = True,
 ) -> None:
     """
     write/update vector information for doc:
@@ -218,71 +474,540 @@ def upsert_doc_embeddings(
     _ensure_indices(client)
     # delete old
     client.delete_by_query(
-        index=KB_DOC_EMBED_INDEX,
+        index=index,
         body={"query": {"term": {"doc_uuid": doc_uuid}}},
     )
     # 写入新的
-    for item in chunks_with_embeddings:
-        body = {
-            "uuid": item["uuid"],
-            "kb_uuid": kb_uuid,
-            "doc_uuid": doc_uuid,
-            "chunk": item["chunk"],
-            "embedding": item["embedding"],
-            "create_at": item["create_at"],
+    actions = [_embedding_action(index, kb_uuid, doc_uuid, item) for item in chunks_with_embeddings]
+    if actions:
+        bulk(client, actions)
+    if bump:
+        _bump_generation(client, kb_uuid)
+
+
+def list_doc_chunks(doc_uuid: str, index: str = KB_DOC_EMBED_INDEX) -> List[Dict[str, Any]]:
+    """
+    get the chunk list of a doc without the vectors, each item carries its ES _id.
+    includes the deduplicated chunks the doc references (their doc_uuid is another doc).
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.search(
+        index=index,
+        size=10000,
+        query={
+            "bool": {
+                "should": [{"term": {"doc_uuid": doc_uuid}}, {"term": {"ref_doc_uuids": doc_uuid}}],
+                "minimum_should_match": 1,
+            }
+        },
+        _source_includes=["uuid", "doc_uuid", "chunk", "chunk_hash", "dedup_hash", "ref_doc_uuids"],
+    )
+    hits = res.get("hits", {}).get("hits", [])
+    return [{"_id": hit["_id"], **hit["_source"]} for hit in hits]
+
+
+def apply_doc_embedding_changes(
+    kb_uuid: str,
+    doc_uuid: str,
+    added: List[Dict[str, Any]],
+    stale_ids: List[str],
+    index: str = KB_DOC_EMBED_INDEX,
+    bump: bool = True,
+) -> None:
+    """
+    incremental vector update for doc: index the added chunks and release the
+    stale vector docs (by ES _id) in a single bulk request. a stale vector is
+    deleted unless other docs reference it, then it moves to one of them.
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    actions: List[Dict[str, Any]] = [
+        {
+            "_op_type": "update",
+            "_index": index,
+            "_id": doc_id,
+            "script": {"source": _RELEASE_REFS_SCRIPT, "params": {"doc_uuids": [doc_uuid]}},
+            "retry_on_conflict": 3,
         }
-        client.index(index=KB_DOC_EMBED_INDEX, document=body)
+        for doc_id in stale_ids
+    ]
+    actions.extend(_embedding_action(index, kb_uuid, doc_uuid, item) for item in added)
+    if actions:
+        bulk(client, actions)
+        if bump:
+            _bump_generation(client, kb_uuid)
+
+
+def find_embeddings_by_hash(
+    kb_uuid: str, dedup_hashes: List[str], index: str = KB_DOC_EMBED_INDEX
+) -> Dict[str, Dict[str, Any]]:
+    """existing vectors of a kb by dedup hash, {hash: {"_id", "uuid", "doc_uuid"}}, one per hash"""
+    client = get_es_client()
+    _ensure_indices(client)
+    found: Dict[str, Dict[str, Any]] = {}
+    unique = list(dict.fromkeys(dedup_hashes))
+    for start in range(0, len(unique), 1000):
+        batch = unique[start:start + 1000]
+        res = client.search(
+            index=index,
+            size=len(batch),
+            query={"bool": {"filter": [{"term": {"kb_uuid": kb_uuid}}, {"terms": {"dedup_hash": batch}}]}},
+            collapse={"field": "dedup_hash"},
+            _source_includes=["uuid", "doc_uuid", "dedup_hash"],
+        )
+        for hit in res.get("hits", {}).get("hits", []):
+            source = hit["_source"]
+            found[source["dedup_hash"]] = {"_id": hit["_id"], "uuid": source["uuid"], "doc_uuid": source["doc_uuid"]}
+    return found
+
+
+def add_embedding_refs(refs: List[Tuple[str, str]], index: str = KB_DOC_EMBED_INDEX) -> List[Tuple[str, str]]:
+    """
+    let docs reference existing vectors instead of storing a copy, refs are (ES _id, doc_uuid).
+    returns the refs that failed (e.g. the vector was deleted meanwhile).
+    """
+    if not refs:
+        return []
+    client = get_es_client()
+    _ensure_indices(client)
+    results = streaming_bulk(
+        client,
+        [
+            {
+                "_op_type": "update",
+                "_index": index,
+                "_id": doc_id,
+                "script": {"source": _ADD_REF_SCRIPT, "params": {"doc_uuid": doc_uuid}},
+                "retry_on_conflict": 3,
+            }
+            for doc_id, doc_uuid in refs
+        ],
+        raise_on_error=False,
+    )
+    # results come back in the order of the actions
+    return [ref for ref, (ok, _) in zip(refs, results) if not ok]
+
+
+def list_shared_embeddings(doc_uuids: List[str], index: str = KB_DOC_EMBED_INDEX) -> List[Dict[str, Any]]:
+    """vectors owned by these docs that other docs reference, with their embeddings"""
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.search(
+        index=index,
+        size=10000,
+        query={"bool": {"filter": [{"terms": {"doc_uuid": doc_uuids}}, {"exists": {"field": "ref_doc_uuids"}}]}},
+        _source_includes=["uuid", "doc_uuid", "chunk", "embedding", "ref_doc_uuids"],
+    )
+    return [hit["_source"] for hit in res.get("hits", {}).get("hits", [])]
+
+
+def _release_shared_embeddings(client: Elasticsearch, doc_uuids: List[str]) -> None:
+    """
+    before docs are deleted: drop them from every reference list and hand the vectors
+    they own that other docs reference over to those docs.
+    """
+    client.update_by_query(
+        index=ALL_EMBED_INDICES,
+        body={
+            "query": {
+                "bool": {
+                    "should": [
+                        {"terms": {"ref_doc_uuids": doc_uuids}},
+                        {
+                            "bool": {
+                                "filter": [
+                                    {"terms": {"doc_uuid": doc_uuids}},
+                                    {"exists": {"field": "ref_doc_uuids"}},
+                                ]
+                            }
+                        },
+                    ],
+                    "minimum_should_match": 1,
+                }
+            },
+            "script": {"source": _RELEASE_REFS_SCRIPT, "params": {"doc_uuids": doc_uuids}},
+        },
+        refresh=True,
+    )
+
+
+def count_doc_embeddings(kb_uuid: str, index: str = KB_DOC_EMBED_INDEX) -> int:
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.count(index=index, query={"term": {"kb_uuid": kb_uuid}})
+    return res.get("count", 0)
 
 
-def list_doc_embeddings(kb_uuid: str) -> List[Dict[str, Any]]:
+def embedding_uuid_hash(vector_uuid: str) -> int:
+    """java String.hashCode of a vector uuid, the per-vector term of embedding_fingerprint"""
+    code = 0
+    data = vector_uuid.encode("utf-16-be")
+    for pos in range(0, len(data), 2):
+        code = (31 * code + (data[pos] << 8 | data[pos + 1])) & 0xFFFFFFFF
+    return code - (1 << 32) if code & 0x80000000 else code
+
+
+def embedding_fingerprint(kb_uuid: str, index: str = KB_DOC_EMBED_INDEX) -> Tuple[int, int]:
     """
-    get all doc vectors under a kb (simple implementation: fetch all at once, suitable for small data量）。
+    (count, sum of embedding_uuid_hash) of the vectors of a kb, order independent so a
+    local copy can keep it up to date incrementally. exact below ~4M vectors per kb.
     """
     client = get_es_client()
     _ensure_indices(client)
     res = client.search(
-        index=KB_DOC_EMBED_INDEX,
-        size=1000,
+        index=index,
         query={"term": {"kb_uuid": kb_uuid}},
+        size=0,
+        track_total_hits=True,
+        aggs={
+            "uuid_hash": {
+                "sum": {
+                    "script": {
+                        "source": "doc['uuid'].size() == 0 ? 0 : doc['uuid'].value.hashCode()",
+                    }
+                }
+            }
+        },
     )
-    hits = res.get("hits", {}).get("hits", [])
-    return [hit["_source"] for hit in hits]
+    return res["hits"]["total"]["value"], int(round(res["aggregations"]["uuid_hash"]["value"] or 0))
+
+
+def embedding_delta(
+    kb_uuid: str, since_ms: int, index: str = KB_DOC_EMBED_INDEX, limit: int = EMBEDDING_SCAN_PAGE_SIZE
+) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, List[str]]]]:
+    """
+    what a local copy of the kb needs to catch up with writes since since_ms: the vectors
+    created since then (uuid, doc_uuid, chunk, embedding) and the vector uuids every doc
+    they belong to owns now. None when more than limit vectors were created.
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.search(
+        index=index,
+        size=limit,
+        track_total_hits=limit + 1,
+        query={"bool": {"filter": [{"term": {"kb_uuid": kb_uuid}}, {"range": {"create_at": {"gte": since_ms}}}]}},
+        _source_includes=["uuid", "doc_uuid", "chunk", "embedding"],
+    )
+    if res["hits"]["total"]["value"] > limit:
+        return None
+    created = [hit["_source"] for hit in res["hits"]["hits"]]
+    owned: Dict[str, List[str]] = {item["doc_uuid"]: [] for item in created}
+    if owned:
+        res = client.search(
+            index=index,
+            size=10000,
+            query={"bool": {"filter": [{"term": {"kb_uuid": kb_uuid}}, {"terms": {"doc_uuid": list(owned)}}]}},
+            _source_includes=["uuid", "doc_uuid"],
+        )
+        for hit in res["hits"]["hits"]:
+            owned[hit["_source"]["doc_uuid"]].append(hit["_source"]["uuid"])
+    return created, owned
+
+
+def index_embeddings(kb_uuid: str, items: List[Dict[str, Any]], index: str) -> None:
+    """bulk index vectors of many docs of a kb, every item carries its doc_uuid"""
+    client = get_es_client()
+    _ensure_indices(client)
+    bulk(client, [_embedding_action(index, kb_uuid, item["doc_uuid"], item) for item in items])
+
+
+def delete_embeddings(vector_uuids: List[str], index: str) -> None:
+    """delete vectors by uuid, only for indices written with _id = uuid"""
+    client = get_es_client()
+    _ensure_indices(client)
+    bulk(
+        client,
+        [{"_op_type": "delete", "_index": index, "_id": vector_uuid} for vector_uuid in vector_uuids],
+        raise_on_error=False,
+    )
+
+
+def refresh_index(index: str) -> None:
+    get_es_client().indices.refresh(index=index)
+
+
+def delete_kb_embeddings(kb_uuid: str, index: str) -> None:
+    """drop every vector of a kb from one vector index"""
+    client = get_es_client()
+    _ensure_indices(client)
+    client.delete_by_query(index=index, body={"query": {"term": {"kb_uuid": kb_uuid}}}, refresh=True)
+
+
+def iter_doc_embeddings(
+    kb_uuid: str,
+    page_size: int = EMBEDDING_SCAN_PAGE_SIZE,
+    source_includes: Optional[List[str]] = None,
+    index: str = KB_DOC_EMBED_INDEX,
+) -> Iterator[Dict[str, Any]]:
+    """
+    stream every vector doc of a kb, page by page, through a point in time
+    and search_after so the scan sees one consistent snapshot however large the kb is.
+    source_includes limits the returned fields (e.g. leave out "embedding").
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    pit_id = client.open_point_in_time(index=index, keep_alive=EMBEDDING_SCAN_KEEP_ALIVE)["id"]
+    search_after: Optional[List[Any]] = None
+    try:
+        while True:
+            body: Dict[str, Any] = {
+                "size": page_size,
+                "query": {"term": {"kb_uuid": kb_uuid}},
+                "pit": {"id": pit_id, "keep_alive": EMBEDDING_SCAN_KEEP_ALIVE},
+                "sort": [{"_shard_doc": "asc"}],
+                "track_total_hits": False,
+            }
+            if source_includes is not None:
+                body["_source"] = source_includes
+            if search_after is not None:
+                body["search_after"] = search_after
+            res = client.search(body=body)
+            pit_id = res.get("pit_id", pit_id)
+            hits = res.get("hits", {}).get("hits", [])
+            for hit in hits:
+                yield hit["_source"]
+            if len(hits) < page_size:
+                break
+            search_after = hits[-1]["sort"]
+    finally:
+        try:
+            client.close_point_in_time(body={"id": pit_id})
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] failed to close point in time: {exc}")
+
+
+def sample_embeddings(size: int, index: str = ALL_EMBED_INDICES) -> List[List[float]]:
+    """the oldest stored vectors of every kb (the ones written before any migration)"""
+    client = get_es_client()
+    _ensure_indices(client)
+    res = client.search(
+        index=index,
+        size=size,
+        sort=[{"create_at": {"order": "asc", "unmapped_type": "long"}}],
+        _source_includes=["embedding"],
+        track_total_hits=False,
+    )
+    return [hit["_source"]["embedding"] for hit in res.get("hits", {}).get("hits", []) if hit["_source"].get("embedding")]
 
 
 def search_doc_embeddings_by_vector(
     kb_uuid: str,
     query_vector: List[float],
     top_k: int = 5,
+    index: str = KB_DOC_EMBED_INDEX,
 ) -> List[Dict[str, Any]]:
     """
-    Server-side vector similarity search using script_score cosine similarity.
-    Returns top_k chunks with their scores.
+    Server-side vector similarity search, returns top_k chunks with their cosine scores.
+    VECTOR_SEARCH_MODE=knn uses approximate HNSW search; when the cluster or the
+    index mapping does not support it, falls back to exact script_score.
     """
     client = get_es_client()
     _ensure_indices(client)
-    response = client.search(
-        index=KB_DOC_EMBED_INDEX,
-        size=top_k,
-        query={
+    if _use_knn(index):
+        try:
+            return _search_embeddings_knn(client, kb_uuid, query_vector, top_k, index)
+        except Exception as exc:  # pylint: disable=broad-except
+            _knn_failed(index, exc, isinstance(exc, RequestError))
+    return _search_embeddings_script_score(client, kb_uuid, query_vector, top_k, index)
+
+
+# vector indices the cluster rejected knn queries for (e.g. ES 7 or a mapping without
+# HNSW), they are searched with script_score for the rest of the process
+_knn_unsupported: set = set()
+
+
+def _use_knn(index: str) -> bool:
+    return VECTOR_SEARCH_MODE == "knn" and index not in _knn_unsupported
+
+
+def _knn_failed(index: str, error: Any, rejected: bool) -> None:
+    """
+    a knn search failed: a rejected query (400) will keep failing, so the index is
+    remembered and the fallback is logged once; other errors only skip this request
+    """
+    if rejected:
+        _knn_unsupported.add(index)
+        print(f"[WARN] ES rejected knn search on {index}, using script_score from now on: {error}")
+    else:
+        print(f"[WARN] ES knn search failed, falling back to script_score: {error}")
+
+
+def _knn_body(kb_uuid: str, query_vector: List[float], top_k: int) -> Dict[str, Any]:
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": query_vector,
+            "k": top_k,
+            "num_candidates": max(KNN_NUM_CANDIDATES, top_k),
+            "filter": {"term": {"kb_uuid": kb_uuid}},
+        },
+        "size": top_k,
+        "_source": {"excludes": ["embedding"]},
+    }
+
+
+def _script_score_body(kb_uuid: str, query_vector: List[float], top_k: int) -> Dict[str, Any]:
+    return {
+        "size": top_k,
+        "query": {
             "script_score": {
                 "query": {"term": {"kb_uuid": kb_uuid}},
                 "script": {
-                    "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
+                    "source": _SCRIPT_SCORE_SOURCES[VECTOR_SIMILARITY],
                     "params": {"query_vector": query_vector},
                 },
             }
         },
-    )
+        "_source": {"excludes": ["embedding"]},
+    }
+
+
+def _vector_hits(response: Dict[str, Any], knn: bool) -> List[Dict[str, Any]]:
     hits = response.get("hits", {}).get("hits", [])
     results: List[Dict[str, Any]] = []
     for hit in hits:
         source = hit.get("_source", {})
-        score = hit.get("_score", 0.0) - 1.0  # remove +1 offset
-        source["score"] = score
+        if knn:
+            # knn cosine/dot_product _score is (1 + similarity) / 2
+            source["score"] = hit.get("_score", 0.0) * 2 - 1.0
+        else:
+            source["score"] = hit.get("_score", 0.0) - 1.0  # remove +1 offset
         results.append(source)
     return results
 
 
+def _search_embeddings_knn(
+    client: Elasticsearch, kb_uuid: str, query_vector: List[float], top_k: int, index: str
+) -> List[Dict[str, Any]]:
+    response = client.search(index=index, body=_knn_body(kb_uuid, query_vector, top_k))
+    return _vector_hits(response, knn=True)
+
+
+def _search_embeddings_script_score(
+    client: Elasticsearch, kb_uuid: str, query_vector: List[float], top_k: int, index: str
+) -> List[Dict[str, Any]]:
+    response = client.search(index=index, body=_script_score_body(kb_uuid, query_vector, top_k))
+    return _vector_hits(response, knn=False)
+
+
+def search_chunks_hybrid(
+    kb_uuid: str,
+    query: str,
+    query_vector: List[float],
+    size: int = 20,
+    index: str = KB_DOC_EMBED_INDEX,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    vector and BM25 search over the chunks of a kb in a single msearch round trip.
+    returns (vector hits with cosine scores, keyword hits with BM25 scores), both ranked.
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    knn = _use_knn(index)
+    vector_body = _knn_body(kb_uuid, query_vector, size) if knn else _script_score_body(kb_uuid, query_vector, size)
+    text_body = {
+        "size": size,
+        "query": {
+            "bool": {
+                "filter": [{"term": {"kb_uuid": kb_uuid}}],
+                "must": [{"match": {"chunk": {"query": query}}}],
+            }
+        },
+        "_source": {"excludes": ["embedding"]},
+    }
+    res = client.msearch(
+        body=[{"index": index}, vector_body, {"index": index}, text_body]
+    )
+    vector_res, text_res = res.get("responses", [{}, {}])
+    if "error" in text_res:
+        raise RuntimeError(f"ES keyword search failed: {text_res['error']}")
+    if "error" not in vector_res:
+        vector_hits = _vector_hits(vector_res, knn=knn)
+    elif knn:
+        _knn_failed(index, vector_res["error"], vector_res.get("status") == 400)
+        vector_hits = _search_embeddings_script_score(client, kb_uuid, query_vector, size, index)
+    else:
+        raise RuntimeError(f"ES vector search failed: {vector_res['error']}")
+
+    text_hits: List[Dict[str, Any]] = []
+    for hit in text_res.get("hits", {}).get("hits", []):
+        source = hit.get("_source", {})
+        source["score"] = hit.get("_score", 0.0)
+        text_hits.append(source)
+    return vector_hits, text_hits
+
+
+def rewrite_embeddings(
+    transform: Callable[[List[float]], Optional[List[float]]],
+    batch_size: int = 500,
+) -> Dict[str, int]:
+    """
+    scan every vector doc (of every vector index) and bulk-update the embedding
+    to transform(embedding), docs for which transform returns None are left untouched.
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    scanned = 0
+    actions: List[Dict[str, Any]] = []
+    updated = 0
+    for hit in scan(
+        client,
+        index=ALL_EMBED_INDICES,
+        query={"query": {"match_all": {}}},
+        _source=["embedding"],
+        size=batch_size,
+    ):
+        scanned += 1
+        embedding = hit["_source"].get("embedding")
+        new_embedding = transform(embedding) if embedding else None
+        if new_embedding is None:
+            continue
+        actions.append(
+            {"_op_type": "update", "_index": hit["_index"], "_id": hit["_id"], "doc": {"embedding": new_embedding}}
+        )
+        if len(actions) >= batch_size:
+            updated += bulk(client, actions)[0]
+            actions = []
+    if actions:
+        updated += bulk(client, actions)[0]
+    return {"scanned": scanned, "updated": updated}
+
+
+def reindex_embed_index() -> Dict[str, Any]:
+    """
+    migrate kb_doc_embed_index to a fresh index built with the current mapping
+    (e.g. HNSW-indexed vectors after switching VECTOR_SEARCH_MODE to knn).
+    kb_doc_embed_index becomes an alias of the new index; the swap and the
+    removal of the old index happen in one atomic alias update.
+    vectors written while the copy runs are not carried over, run it in a quiet window.
+    """
+    client = get_es_client()
+    _ensure_indices(client)
+    if client.indices.exists_alias(name=KB_DOC_EMBED_INDEX):
+        old_indices = list(client.indices.get_alias(name=KB_DOC_EMBED_INDEX).keys())
+    else:
+        old_indices = [KB_DOC_EMBED_INDEX]
+
+    new_index = f"{KB_DOC_EMBED_INDEX}_{int(time.time())}"
+    client.indices.create(index=new_index, mappings=_embed_index_mappings())
+    result = client.reindex(
+        body={"source": {"index": KB_DOC_EMBED_INDEX}, "dest": {"index": new_index}},
+        wait_for_completion=True,
+        refresh=True,
+        request_timeout=3600,
+    )
+    if result.get("failures"):
+        client.indices.delete(index=new_index)
+        raise RuntimeError(f"reindex failed: {result['failures'][:3]}")
+
+    actions: List[Dict[str, Any]] = [{"add": {"index": new_index, "alias": KB_DOC_EMBED_INDEX}}]
+    actions.extend({"remove_index": {"index": index}} for index in old_indices)
+    client.indices.update_aliases(body={"actions": actions})
+    return {"from": old_indices, "to": new_index, "copied": result.get("total", 0)}
+
+
 def search_docs_fulltext(
     kb_uuid: str,
     query: str,
@@ -7,3 +7,127 @@ JWT_SECRET = os.getenv("JWT_SECRET", "kb-secret")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL", "http://127.0.0.1:9200")
 
+# embedding batching (OpenAI caps a request at 2048 inputs / ~300k tokens)
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "256"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+
+# persistent embedding cache keyed by (model, sha256(text))
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+# a hit only rewrites last_used once it is older than this, reads stay read-only otherwise
+EMBEDDING_CACHE_TOUCH_SECONDS = float(os.getenv("EMBEDDING_CACHE_TOUCH_SECONDS", "600"))
+
+# OpenAI http connection pool and timeouts (seconds)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+
+# OpenAI request scheduler: rate limits, concurrency and retries
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "3000"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "1000000"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_INTERACTIVE_RESERVED_SLOTS = int(os.getenv("OPENAI_INTERACTIVE_RESERVED_SLOTS", "4"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+
+# in-process LRU/TTL cache of query embeddings (ttl in seconds)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "3600"))
+
+# opt-in per-KB semantic answer cache (ttl in seconds)
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES_PER_KB = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES_PER_KB", "128"))
+ANSWER_CACHE_MAX_KBS = int(os.getenv("ANSWER_CACHE_MAX_KBS", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+
+# prompt token budgets (context/history are packed under these)
+QA_PROMPT_TOKEN_BUDGET = int(os.getenv("QA_PROMPT_TOKEN_BUDGET", "3000"))
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "6000"))
+
+# background write-back of qa/chat answers into the kb
+WRITEBACK_SPOOL_PATH = os.getenv("WRITEBACK_SPOOL_PATH", "data/writeback.sqlite3")
+WRITEBACK_CAPACITY = int(os.getenv("WRITEBACK_CAPACITY", "1000"))
+WRITEBACK_WORKERS = int(os.getenv("WRITEBACK_WORKERS", "2"))
+WRITEBACK_MAX_ATTEMPTS = int(os.getenv("WRITEBACK_MAX_ATTEMPTS", "8"))
+
+# server-sent events heartbeat interval for streaming chat (seconds)
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+
+# vector search: "script_score" (exact, any cluster) or "knn" (HNSW, ES 8+)
+VECTOR_SEARCH_MODE = os.getenv("VECTOR_SEARCH_MODE", "script_score").lower()
+KNN_NUM_CANDIDATES = int(os.getenv("KNN_NUM_CANDIDATES", "100"))
+
+# retrieval engine for semantic search / qa context:
+# "es", "local" (per-kb HNSW, needs hnswlib) or "exact" (per-kb numpy matrix)
+RETRIEVAL_ENGINE = os.getenv("RETRIEVAL_ENGINE", "es").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "data/local_index")
+LOCAL_INDEX_M = int(os.getenv("LOCAL_INDEX_M", "16"))
+LOCAL_INDEX_EF_CONSTRUCTION = int(os.getenv("LOCAL_INDEX_EF_CONSTRUCTION", "200"))
+LOCAL_INDEX_EF_SEARCH = int(os.getenv("LOCAL_INDEX_EF_SEARCH", "64"))
+# local copies of a kb (local index, mmap store) catch up with writes of other workers by
+# fetching the vectors created since their last sync (minus the slack: vectors are stamped
+# when chunked, before they are written); the full check against ES runs in the background
+LOCAL_COPY_DELTA_SLACK_MS = int(os.getenv("LOCAL_COPY_DELTA_SLACK_MS", "60000"))
+LOCAL_COPY_VERIFY_SECONDS = float(os.getenv("LOCAL_COPY_VERIFY_SECONDS", "300"))
+
+# paging of full-kb vector scans (export, local index builds, fallback scoring)
+EMBEDDING_SCAN_PAGE_SIZE = int(os.getenv("EMBEDDING_SCAN_PAGE_SIZE", "500"))
+EMBEDDING_SCAN_KEEP_ALIVE = os.getenv("EMBEDDING_SCAN_KEEP_ALIVE", "2m")
+
+# on-disk mmap embedding store per kb, serves local fallback scoring and export
+VECTOR_STORE_ENABLED = os.getenv("VECTOR_STORE_ENABLED", "false").lower() == "true"
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", "data/vector_store")
+VECTOR_STORE_COMPACT_RATIO = float(os.getenv("VECTOR_STORE_COMPACT_RATIO", "0.3"))
+
+# vector quantization of the local mmap store: "none" or "int8" (candidates on int8 code
+# files next to the float32 ones, float32 rescoring). only local search and export use it,
+# ES keeps full float32 vectors
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none").lower()
+QUANTIZATION_OVERSAMPLE = int(os.getenv("QUANTIZATION_OVERSAMPLE", "4"))
+# dense_vector index_options type for knn mode, e.g. "int8_hnsw"; empty keeps the ES default.
+# int8_hnsw (ES 8.12+) is the only setting that shrinks the vector memory of ES
+ES_VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "")
+
+# vector similarity: "cosine" works on any stored vectors; "dot_product" is cheaper but
+# ranks correctly only on unit vectors, opt in after manage.py normalize-embeddings
+# (new vectors are normalized at write time, startup warns about unnormalized ones)
+VECTOR_SIMILARITY = os.getenv("VECTOR_SIMILARITY", "cosine").lower()
+
+# hybrid BM25 + vector retrieval fused by reciprocal rank fusion
+QA_RETRIEVAL_MODE = os.getenv("QA_RETRIEVAL_MODE", "vector").lower()  # "vector" or "hybrid"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+# embedding model of new kbs, dims only shorten text-embedding-3-* outputs
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "1536"))
+# dense_vector size limit of the cluster (2048 up to ES 8.9)
+MAX_VECTOR_DIMS = int(os.getenv("MAX_VECTOR_DIMS", "2048"))
+
+# background jobs (kb re-embedding)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "256"))
+# a re-embed migration whose worker sent no heartbeat for REEMBED_STALE_SECONDS is
+# abandoned: writes stop dual-writing to it and another worker may take it over
+REEMBED_HEARTBEAT_SECONDS = float(os.getenv("REEMBED_HEARTBEAT_SECONDS", "15"))
+REEMBED_STALE_SECONDS = float(os.getenv("REEMBED_STALE_SECONDS", "120"))
+
+# retrieval result cache keyed by kb generation; results are only cached once
+# the last write is older than the settle window (covers the ES refresh interval).
+# the ttl bounds how long results stay stale when a generation bump failed
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_SETTLE_MS = int(os.getenv("RETRIEVAL_CACHE_SETTLE_MS", "2000"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "300"))
+
+# compaction of auto-saved Q/A docs: answers at or above this cosine are merged into the newest
+QA_COMPACTION_THRESHOLD = float(os.getenv("QA_COMPACTION_THRESHOLD", "0.95"))
+
+# ingest-time chunk dedup within a kb by normalized chunk hash
+CHUNK_DEDUP_ENABLED = os.getenv("CHUNK_DEDUP_ENABLED", "true").lower() == "true"
+
+# chunking of new kbs: "sentence" packs headings/paragraphs/sentences up to
+# CHUNK_TOKENS with CHUNK_OVERLAP_TOKENS of overlap, "fixed" is the legacy 400-char slicing
+CHUNKING_STRATEGY = os.getenv("CHUNKING_STRATEGY", "sentence")
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
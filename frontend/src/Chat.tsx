@@ -308,45 +308,62 @@ const ChatPage = ({
     const reader = response.body?.getReader();
     const decoder = new TextDecoder();
 
+    const appendContent = (text: string) => {
+      if (!text) return;
+      setMessages((prev) =>
+        prev.map((msg) =>
+          msg.id === assistantId
+            ? { ...msg, content: msg.content + text }
+            : msg
+        )
+      );
+    };
+
+    // server-sent events: "event: token|done|error" + one JSON "data:" line,
+    // separated by a blank line; ":" lines are heartbeats
+    const handleEvent = (raw: string) => {
+      let event = "message";
+      const dataLines: string[] = [];
+      for (const line of raw.split("\n")) {
+        if (line.startsWith("event:")) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          dataLines.push(line.slice(5).trim());
+        }
+      }
+      if (!dataLines.length) return;
+      const data = JSON.parse(dataLines.join("\n"));
+      if (event === "token") {
+        appendContent(data.content || "");
+      } else if (event === "error") {
+        throw new Error(data.msg || "Stream failed");
+      }
+    };
+
     try {
       if (!reader) {
         const text = await response.text();
-        if (text) {
-          setMessages((prev) =>
-            prev.map((msg) =>
-              msg.id === assistantId
-                ? { ...msg, content: msg.content + text }
-                : msg
-            )
-          );
-        }
+        text.split("\n\n").forEach(handleEvent);
         return;
       }
 
+      let pending = "";
       while (true) {
         const { value, done } = await reader.read();
         if (done) {
           break;
         }
-        const chunk = decoder.decode(value, { stream: true });
-        if (!chunk) continue;
-        setMessages((prev) =>
-          prev.map((msg) =>
-            msg.id === assistantId
-              ? { ...msg, content: msg.content + chunk }
-              : msg
-          )
-        );
+        pending += decoder.decode(value, { stream: true });
+        let boundary = pending.indexOf("\n\n");
+        while (boundary !== -1) {
+          handleEvent(pending.slice(0, boundary));
+          pending = pending.slice(boundary + 2);
+          boundary = pending.indexOf("\n\n");
+        }
       }
-      const remaining = decoder.decode();
-      if (remaining) {
-        setMessages((prev) =>
-          prev.map((msg) =>
-            msg.id === assistantId
-              ? { ...msg, content: msg.content + remaining }
-              : msg
-          )
-        );
+      pending += decoder.decode();
+      if (pending.trim()) {
+        handleEvent(pending);
       }
     } catch (err) {
       setMessages((prev) => prev.filter((msg) => msg.id !== assistantId));
@@ -1,12 +1,16 @@
-from typing import Any, Dict, List
+import asyncio
+import json
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List
 
-from fastapi import APIRouter, Depends, Query, HTTPException
+import anyio
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from middleware.auth import get_current_user, UserClaim
 from models.chat import ChatCreate, ChatMessageCreate, ChatReply, ChatMessage
 from service import chat as chat_service
+from define import SSE_HEARTBEAT_SECONDS
 
 
 class ChatUpdateRequest(BaseModel):
@@ -90,29 +94,64 @@ async def send_message(
     req: ChatMessageCreate,
     current_user: UserClaim = Depends(get_current_user),
 ) -> ChatReply:
-    reply = chat_service.send_message_service(current_user.uuid, chat_uuid, req)
+    reply = await chat_service.send_message_service(current_user.uuid, chat_uuid, req)
     if not reply:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "chat not found"})
     return reply
 
 
-@router.post("/chat/{chat_uuid}/message/stream", summary="send message with streaming response")
+@router.post("/chat/{chat_uuid}/message/stream", summary="send message with streaming response (SSE)")
 async def send_message_stream(
     chat_uuid: str,
     req: ChatMessageCreate,
+    request: Request,
     current_user: UserClaim = Depends(get_current_user),
 ):
-    generator = chat_service.stream_message_service(
+    stream = await chat_service.stream_message_service(
         current_user.uuid, chat_uuid, req
     )
-    if not generator:
+    if not stream:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "chat not found"})
 
-    def iter_chunks():
-        for chunk in generator:
-            if chunk:
-                yield chunk.encode("utf-8")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(
+        _sse_events(stream, request), media_type="text/event-stream", headers=headers
+    )
+
 
-    return StreamingResponse(iter_chunks(), media_type="text/plain; charset=utf-8")
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
+async def _sse_events(stream: AsyncGenerator[str, None], request: Request) -> AsyncIterator[str]:
+    """
+    frame reply chunks as server-sent events, with a comment heartbeat while
+    the model is silent; stops (and closes the reply stream) once the client is gone.
+    """
+    next_chunk = asyncio.ensure_future(stream.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_chunk}, timeout=SSE_HEARTBEAT_SECONDS)
+            if await request.is_disconnected():
+                return
+            if not done:
+                yield ": ping\n\n"
+                continue
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            except Exception as exc:  # pylint: disable=broad-except
+                yield _sse_event("error", {"msg": str(exc)})
+                return
+            yield _sse_event("token", {"content": chunk})
+            next_chunk = asyncio.ensure_future(stream.__anext__())
+        yield _sse_event("done", {})
+    finally:
+        if not next_chunk.done():
+            # cancelling the pending read runs the reply stream's cleanup
+            next_chunk.cancel()
+            with anyio.CancelScope(shield=True):
+                await asyncio.wait({next_chunk})
+        with anyio.CancelScope(shield=True):
+            await stream.aclose()
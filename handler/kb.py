@@ -1,5 +1,6 @@
+import asyncio
 import io
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from fastapi import APIRouter, Depends, Query, HTTPException, UploadFile, File
 from fastapi.responses import StreamingResponse
@@ -8,6 +9,7 @@ from middleware.auth import get_current_user, UserClaim
 from models.kb import (
     KnowledgeBaseCreate,
     KnowledgeBaseUpdate,
+    KnowledgeBaseReembedRequest,
     KnowledgeDocumentCreate,
     KnowledgeDocumentUpdate,
     KnowledgeQARequest,
@@ -27,7 +29,10 @@ async def create_kb(
     req: KnowledgeBaseCreate,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    kb = kb_service.create_kb_service(current_user.uuid, req)
+    try:
+        kb = await asyncio.to_thread(kb_service.create_kb_service, current_user.uuid, req)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail={"code": 400, "msg": str(exc)})
     return {"code": 200, "data": kb}
 
 
@@ -37,7 +42,7 @@ async def list_kb(
     size: int = Query(10, description="data per page"),
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    data = kb_service.list_kb_service(current_user.uuid, page, size)
+    data = await asyncio.to_thread(kb_service.list_kb_service, current_user.uuid, page, size)
     return {"code": 200, "data": data}
 
 
@@ -47,7 +52,10 @@ async def update_kb(
     req: KnowledgeBaseUpdate,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    kb = kb_service.update_kb_service(current_user.uuid, kb_uuid, req)
+    try:
+        kb = await asyncio.to_thread(kb_service.update_kb_service, current_user.uuid, kb_uuid, req)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail={"code": 400, "msg": str(exc)})
     if not kb:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return {"code": 200, "data": kb}
@@ -58,12 +66,54 @@ async def delete_kb(
     kb_uuid: str,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    ok = kb_service.delete_kb_service(current_user.uuid, kb_uuid)
+    ok = await asyncio.to_thread(kb_service.delete_kb_service, current_user.uuid, kb_uuid)
     if not ok:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return {"code": 200, "msg": "delete success"}
 
 
+@router.post("/kb/{kb_uuid}/reembed", summary="re-embed kb with another embedding model")
+async def reembed_kb(
+    kb_uuid: str,
+    req: KnowledgeBaseReembedRequest,
+    current_user: UserClaim = Depends(get_current_user),
+) -> Dict[str, Any]:
+    try:
+        job = await asyncio.to_thread(kb_service.reembed_kb_service, current_user.uuid, kb_uuid, req)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail={"code": 400, "msg": str(exc)})
+    if not job:
+        raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
+    return {"code": 200, "data": job}
+
+
+@router.post("/kb/{kb_uuid}/compact-qa", summary="merge near-duplicate auto-saved Q/A docs")
+async def compact_qa(
+    kb_uuid: str,
+    threshold: Optional[float] = Query(None, description="answer cosine to merge at, default QA_COMPACTION_THRESHOLD"),
+    dry_run: bool = Query(False, description="only report what would be reclaimed"),
+    include_legacy: bool = Query(False, description="also merge Q/A docs saved before docs had a source"),
+    current_user: UserClaim = Depends(get_current_user),
+) -> Dict[str, Any]:
+    job = await asyncio.to_thread(
+        kb_service.compact_qa_service, current_user.uuid, kb_uuid, threshold, dry_run, include_legacy
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
+    return {"code": 200, "data": job}
+
+
+@router.get("/kb/jobs/{job_id}", summary="background job status")
+async def get_job(
+    job_id: str,
+    current_user: UserClaim = Depends(get_current_user),
+) -> Dict[str, Any]:
+    job = await asyncio.to_thread(kb_service.get_job_service, current_user.uuid, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail={"code": 404, "msg": "job not found"})
+    return {"code": 200, "data": job}
+
+
 # ==== 文档管理 ====
 
 
@@ -73,7 +123,7 @@ async def create_doc(
     req: KnowledgeDocumentCreate,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    doc = kb_service.create_doc_service(current_user.uuid, kb_uuid, req)
+    doc = await asyncio.to_thread(kb_service.create_doc_service, current_user.uuid, kb_uuid, req)
     if not doc:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return {"code": 200, "data": doc}
@@ -86,7 +136,7 @@ async def list_docs(
     size: int = Query(10, description="data per page"),
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    data = kb_service.list_docs_service(current_user.uuid, kb_uuid, page, size)
+    data = await asyncio.to_thread(kb_service.list_docs_service, current_user.uuid, kb_uuid, page, size)
     return {"code": 200, "data": data}
 
 
@@ -96,7 +146,7 @@ async def update_doc(
     req: KnowledgeDocumentUpdate,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    doc = kb_service.update_doc_service(current_user.uuid, doc_uuid, req)
+    doc = await asyncio.to_thread(kb_service.update_doc_service, current_user.uuid, doc_uuid, req)
     if not doc:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "doc not found"})
     return {"code": 200, "data": doc}
@@ -107,7 +157,7 @@ async def delete_doc(
     doc_uuid: str,
     current_user: UserClaim = Depends(get_current_user),
 ) -> Dict[str, Any]:
-    ok = kb_service.delete_doc_service(current_user.uuid, doc_uuid)
+    ok = await asyncio.to_thread(kb_service.delete_doc_service, current_user.uuid, doc_uuid)
     if not ok:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "doc not found"})
     return {"code": 200, "msg": "delete success"}
@@ -121,8 +171,8 @@ async def import_docs(
 ) -> Dict[str, Any]:
     content = await file.read()
     try:
-        summary = kb_service.import_kb_file_service(
-            current_user.uuid, kb_uuid, file.filename or "", content
+        summary = await asyncio.to_thread(
+            kb_service.import_kb_file_service, current_user.uuid, kb_uuid, file.filename or "", content
         )
     except ValueError as exc:
         raise HTTPException(status_code=400, detail={"code": 400, "msg": str(exc)})
@@ -136,7 +186,7 @@ async def export_kb(
     kb_uuid: str,
     current_user: UserClaim = Depends(get_current_user),
 ):
-    bundle = kb_service.export_kb_service(current_user.uuid, kb_uuid)
+    bundle = await asyncio.to_thread(kb_service.export_kb_service, current_user.uuid, kb_uuid)
     if not bundle:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     bytes_io = io.BytesIO(bundle["content"])
@@ -155,7 +205,7 @@ async def kb_qa(
     req: KnowledgeQARequest,
     current_user: UserClaim = Depends(get_current_user),
 ) -> KnowledgeQAReply:
-    result = kb_service.qa_service(current_user.uuid, kb_uuid, req.question, req.top_k)
+    result = await kb_service.qa_service(current_user.uuid, kb_uuid, req.question, req.top_k)
     if not result:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return result
@@ -171,13 +221,18 @@ class FullTextSearchRequest(BaseModel):
     top_k: int = 5
 
 
+class HybridSearchRequest(BaseModel):
+    query: str
+    top_k: int = 5
+
+
 @router.post("/kb/{kb_uuid}/semantic-search", summary="kb vector semantic search")
 async def semantic_search(
     kb_uuid: str,
     req: SemanticSearchRequest,
     current_user: UserClaim = Depends(get_current_user),
 ):
-    result = kb_service.semantic_search_service(current_user.uuid, kb_uuid, req.query, req.top_k)
+    result = await kb_service.semantic_search_service(current_user.uuid, kb_uuid, req.query, req.top_k)
     if result is None:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return {"code": 200, "data": result}
@@ -189,9 +244,21 @@ async def fulltext_search(
     req: FullTextSearchRequest,
     current_user: UserClaim = Depends(get_current_user),
 ):
-    result = kb_service.fulltext_search_service(current_user.uuid, kb_uuid, req.query, req.top_k)
+    result = await asyncio.to_thread(
+        kb_service.fulltext_search_service, current_user.uuid, kb_uuid, req.query, req.top_k
+    )
     if result is None:
         raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
     return {"code": 200, "data": result}
 
 
+@router.post("/kb/{kb_uuid}/hybrid-search", summary="kb hybrid keyword + vector search")
+async def hybrid_search(
+    kb_uuid: str,
+    req: HybridSearchRequest,
+    current_user: UserClaim = Depends(get_current_user),
+):
+    result = await kb_service.hybrid_search_service(current_user.uuid, kb_uuid, req.query, req.top_k)
+    if result is None:
+        raise HTTPException(status_code=404, detail={"code": 404, "msg": "kb not found"})
+    return {"code": 200, "data": result}
@@ -0,0 +1,15 @@
+from typing import Any, Dict
+
+from fastapi import APIRouter, Depends
+
+from middleware.auth import get_current_user, UserClaim
+from service.metrics import collect_metrics
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", summary="cache and OpenAI traffic metrics")
+async def get_metrics(
+    current_user: UserClaim = Depends(get_current_user),
+) -> Dict[str, Any]:
+    return {"code": 200, "data": collect_metrics()}
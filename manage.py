@@ -0,0 +1,86 @@
+import argparse
+import json
+
+import numpy as np
+
+from dao.kb_dao import reindex_embed_index
+from define import QA_COMPACTION_THRESHOLD
+from service.kb import compact_qa_docs, kb_vector_index, normalize_stored_embeddings
+from service.local_index import load_kb_vectors
+from service.vector_ops import quantization_report
+
+
+def _reindex_embeddings(_: argparse.Namespace) -> None:
+    print(json.dumps(reindex_embed_index(), indent=2))
+
+
+def _normalize_embeddings(_: argparse.Namespace) -> None:
+    print(json.dumps(normalize_stored_embeddings(), indent=2))
+
+
+def _quant_report(args: argparse.Namespace) -> None:
+    matrix, _ = load_kb_vectors(args.kb, kb_vector_index(args.kb))
+    if matrix.shape[0] < 2:
+        print(json.dumps({"kb_uuid": args.kb, "vectors": matrix.shape[0], "msg": "not enough vectors"}))
+        return
+    # held-out stored vectors serve as queries against the rest of the kb
+    rng = np.random.default_rng(args.seed)
+    held_out = rng.choice(matrix.shape[0], size=min(args.queries, matrix.shape[0] // 2), replace=False)
+    keep = np.ones(matrix.shape[0], dtype=bool)
+    keep[held_out] = False
+    oversample = [int(factor) for factor in args.oversample.split(",") if factor]
+    report = quantization_report(matrix[keep], matrix[held_out], args.k, oversample)
+    print(json.dumps({"kb_uuid": args.kb, **report}, indent=2))
+
+
+def _compact_qa(args: argparse.Namespace) -> None:
+    print(json.dumps(compact_qa_docs(args.kb, args.threshold, args.dry_run, include_legacy=args.include_legacy), indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="knowledge base maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reindex = commands.add_parser(
+        "reindex-embeddings",
+        help="rebuild kb_doc_embed_index with the current mapping (e.g. for VECTOR_SEARCH_MODE=knn)",
+    )
+    reindex.set_defaults(func=_reindex_embeddings)
+
+    normalize = commands.add_parser(
+        "normalize-embeddings",
+        help="L2-normalize stored vectors (run before reindex-embeddings when using knn with dot_product)",
+    )
+    normalize.set_defaults(func=_normalize_embeddings)
+
+    quant = commands.add_parser(
+        "quant-report",
+        help="recall vs memory of int8 quantized search for one kb (to choose VECTOR_QUANTIZATION)",
+    )
+    quant.add_argument("--kb", required=True, help="kb uuid")
+    quant.add_argument("--queries", type=int, default=200, help="number of held-out vectors used as queries")
+    quant.add_argument("--k", type=int, default=10)
+    quant.add_argument("--oversample", default="1,2,4,8", help="comma separated rescoring oversample factors")
+    quant.add_argument("--seed", type=int, default=0)
+    quant.set_defaults(func=_quant_report)
+
+    compact = commands.add_parser(
+        "compact-qa",
+        help="delete near-duplicate auto-saved Q/A docs of one kb, keeping the newest of each cluster",
+    )
+    compact.add_argument("--kb", required=True, help="kb uuid")
+    compact.add_argument("--threshold", type=float, default=QA_COMPACTION_THRESHOLD, help="answer cosine to merge at")
+    compact.add_argument("--dry-run", action="store_true", help="only report what would be reclaimed")
+    compact.add_argument(
+        "--include-legacy",
+        action="store_true",
+        help="also merge Q/A docs saved before docs had a source (exact save_qa_to_kb shape only)",
+    )
+    compact.set_defaults(func=_compact_qa)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 from pydantic import BaseModel
 
@@ -43,6 +43,8 @@ class ChatReply(BaseModel):
 
     answer: str
     context: List[str]
+    prompt_tokens: Optional[int] = None  # tokens sent to the completion
+    timings: Optional[Dict[str, float]] = None  # per-stage wall time in ms
 
 
 CHAT_INDEX = "chat_index"
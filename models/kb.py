@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Any, Optional, List, Dict
 
 from pydantic import BaseModel
 
@@ -12,6 +12,18 @@ class KnowledgeBase(BaseModel):
     owner_uuid: str
     create_at: int
     update_at: int
+    answer_cache_enabled: bool = False  # opt-in semantic answer cache for qa
+    answer_cache_threshold: Optional[float] = None  # cosine threshold, None = server default
+    content_update_at: Optional[int] = None  # last time a doc was created/updated/deleted
+    embedding_model: Optional[str] = None  # None = text-embedding-ada-002 (kbs created before per-kb models)
+    embedding_dims: Optional[int] = None  # None = 1536
+    embed_index: Optional[str] = None  # vector index of the kb, None = kb_doc_embed_index
+    embed_migration: Optional[Dict[str, Any]] = None  # {"model", "dims", "index"} while a re-embed job dual-writes
+    generation: int = 0  # bumped by every doc/vector write, retrieval results are cached per generation
+    generation_at: Optional[int] = None  # when generation was last bumped
+    chunking: Optional[str] = None  # chunking strategy, None = "fixed" (kbs created before chunking policies)
+    chunk_tokens: Optional[int] = None  # target chunk size in tokens, None = server default
+    chunk_overlap: Optional[int] = None  # overlap between chunks in tokens, None = server default
 
 
 class KnowledgeBaseCreate(BaseModel):
@@ -19,6 +31,13 @@ class KnowledgeBaseCreate(BaseModel):
 
     name: str
     description: Optional[str] = None
+    answer_cache_enabled: bool = False
+    answer_cache_threshold: Optional[float] = None
+    embedding_model: Optional[str] = None  # None = server default (EMBEDDING_MODEL)
+    embedding_dims: Optional[int] = None  # None = server default (EMBEDDING_DIMS)
+    chunking: Optional[str] = None  # None = server default (CHUNKING_STRATEGY)
+    chunk_tokens: Optional[int] = None  # None = server default (CHUNK_TOKENS)
+    chunk_overlap: Optional[int] = None  # None = server default (CHUNK_OVERLAP_TOKENS)
 
 
 class KnowledgeBaseUpdate(BaseModel):
@@ -26,6 +45,19 @@ class KnowledgeBaseUpdate(BaseModel):
 
     name: Optional[str] = None
     description: Optional[str] = None
+    answer_cache_enabled: Optional[bool] = None
+    answer_cache_threshold: Optional[float] = None
+    # applies to docs written afterwards, existing docs are re-chunked when their content changes
+    chunking: Optional[str] = None
+    chunk_tokens: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+
+
+class KnowledgeBaseReembedRequest(BaseModel):
+    """re-embed kb request"""
+
+    embedding_model: str
+    embedding_dims: Optional[int] = None  # None = the model's native size
 
 
 class KnowledgeDocument(BaseModel):
@@ -37,6 +69,7 @@ class KnowledgeDocument(BaseModel):
     content: str
     create_at: int
     update_at: int
+    source: Optional[str] = None  # "qa" for Q/A docs saved from answers, None for user docs
 
 
 class KnowledgeDocumentCreate(BaseModel):
@@ -65,10 +98,16 @@ class KnowledgeQAReply(BaseModel):
 
     answer: str
     context: List[str]
+    prompt_tokens: Optional[int] = None  # tokens sent to the completion, 0 on a cache hit
+    timings: Optional[Dict[str, float]] = None  # per-stage wall time in ms
 
 
 KB_INDEX = "kb_index"
 KB_DOC_INDEX = "kb_doc_index"
 KB_DOC_EMBED_INDEX = "kb_doc_embed_index"
 
+# what kb_doc_embed_index was created for
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+DEFAULT_EMBEDDING_DIMS = 1536
+
 
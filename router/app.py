@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -5,6 +7,10 @@ from handler.user import router as user_router
 from handler.admin.user import router as admin_user_router
 from handler.kb import router as kb_router
 from handler.chat import router as chat_router
+from handler.metrics import router as metrics_router
+from service.openai_service import aclose_openai_clients
+from service.kb import check_vector_similarity, get_qa_writeback, recover_stale_migrations
+from service.local_index import get_local_engine
 
 app = FastAPI(
     title="KnowledgeBase",
@@ -28,3 +34,35 @@ app.include_router(user_router, prefix="/api/v1")
 app.include_router(admin_user_router, prefix="/api/v1/admin")
 app.include_router(kb_router, prefix="/api/v1")
 app.include_router(chat_router, prefix="/api/v1")
+app.include_router(metrics_router, prefix="/api/v1")
+
+
+@app.on_event("startup")
+async def start_writeback_workers() -> None:
+    # also replays jobs spooled by a previous process
+    get_qa_writeback().start()
+
+
+@app.on_event("startup")
+async def recover_reembed_migrations() -> None:
+    try:
+        await asyncio.to_thread(recover_stale_migrations)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] failed to recover abandoned re-embed migrations: {exc}")
+
+
+@app.on_event("startup")
+async def warn_unnormalized_vectors() -> None:
+    try:
+        await asyncio.to_thread(check_vector_similarity)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] failed to check stored vectors for VECTOR_SIMILARITY: {exc}")
+
+
+@app.on_event("shutdown")
+async def stop_background_services() -> None:
+    get_qa_writeback().stop()
+    local_engine = get_local_engine()
+    if local_engine:
+        local_engine.flush()
+    await aclose_openai_clients()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from define import (
+    ANSWER_CACHE_MAX_ENTRIES_PER_KB,
+    ANSWER_CACHE_MAX_KBS,
+    ANSWER_CACHE_TTL,
+)
+from service.vector_ops import cosine_top_k, normalize
+
+# entries of one kb and the unit question vectors of those entries, one row each.
+# a kb's pair is replaced, never mutated, so lookups score it outside the lock
+_KbEntries = Tuple[List[Dict[str, Any]], np.ndarray]
+
+
+class AnswerCache:
+    """
+    per-kb semantic answer cache: a question hits when its embedding is within
+    the cosine threshold of a cached question asked with the same top_k
+    against the same kb content stamp.
+    """
+
+    def __init__(self, max_entries_per_kb: int, max_kbs: int, ttl: float):
+        self._kbs: "OrderedDict[str, _KbEntries]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries_per_kb = max(1, max_entries_per_kb)
+        self._max_kbs = max(1, max_kbs)
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(
+        self,
+        kb_uuid: str,
+        stamp: Optional[int],
+        top_k: int,
+        vector: List[float],
+        threshold: float,
+    ) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            held = self._kbs.get(kb_uuid)
+            if held is not None:
+                self._kbs.move_to_end(kb_uuid)
+        best: Optional[Dict[str, Any]] = None
+        if held is not None:
+            entries, matrix = held
+            # entries from an older kb stamp or past ttl can never hit again
+            live = [
+                row for row, e in enumerate(entries)
+                if e["stamp"] == stamp and (not self._ttl or now - e["created"] < self._ttl)
+            ]
+            if len(live) < len(entries):
+                self._prune(kb_uuid, held, live)
+            rows = [row for row in live if entries[row]["top_k"] == top_k]
+            if rows and matrix.shape[1] == len(vector):
+                scored = cosine_top_k(matrix[rows], vector, 1, threshold)
+                if scored:
+                    best = entries[rows[scored[0][0]]]
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def _prune(self, kb_uuid: str, held: _KbEntries, live: List[int]) -> None:
+        entries, matrix = held
+        with self._lock:
+            # a store since the snapshot replaced the pair, it is pruned on the next lookup
+            if self._kbs.get(kb_uuid) is not held:
+                return
+            if live:
+                self._kbs[kb_uuid] = ([entries[row] for row in live], matrix[live])
+            else:
+                self._kbs.pop(kb_uuid, None)
+
+    def store(
+        self,
+        kb_uuid: str,
+        stamp: Optional[int],
+        top_k: int,
+        vector: List[float],
+        answer: str,
+        context: List[str],
+    ) -> None:
+        entry = {
+            "stamp": stamp,
+            "top_k": top_k,
+            "answer": answer,
+            "context": context,
+            "created": time.monotonic(),
+        }
+        row = normalize(vector)[None, :]
+        with self._lock:
+            held = self._kbs.get(kb_uuid)
+            # questions embedded with another model (another dimension) are dropped
+            if held is not None and held[1].shape[1] == row.shape[1]:
+                keep = self._max_entries_per_kb
+                entries, matrix = held[0] + [entry], np.vstack([held[1], row])
+                self._kbs[kb_uuid] = (entries[-keep:], matrix[-keep:])
+            else:
+                self._kbs[kb_uuid] = ([entry], row)
+            self._kbs.move_to_end(kb_uuid)
+            while len(self._kbs) > self._max_kbs:
+                self._kbs.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "kbs": len(self._kbs),
+                "entries": sum(len(entries) for entries, _ in self._kbs.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES_PER_KB, ANSWER_CACHE_MAX_KBS, ANSWER_CACHE_TTL)
@@ -1,6 +1,9 @@
+import asyncio
 import uuid
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncGenerator, Tuple
+
+import anyio
 
 from dao.chat_dao import (
     create_chat,
@@ -12,8 +15,11 @@ from dao.chat_dao import (
     list_messages,
 )
 from models.chat import Chat, ChatCreate, ChatMessage, ChatMessageCreate, ChatReply
-from service.kb import save_qa_to_kb, get_owned_kb
-from service.openai_service import chat_completion, stream_chat_completion
+from service.kb import enqueue_save_qa, get_owned_kb
+from service.openai_service import achat_completion, astream_chat_completion
+from service.tokenizer import count_message_tokens, message_tokens
+from service.timing import StageTimer
+from define import CHAT_PROMPT_TOKEN_BUDGET
 
 
 DEFAULT_CHAT_TITLE = "Untitled chat"
@@ -107,18 +113,17 @@ def list_messages_service(
     return [ChatMessage(**d) for d in docs]
 
 
-def send_message_service(
+async def send_message_service(
     user_uuid: str, chat_uuid: str, req: ChatMessageCreate
 ) -> Optional[ChatReply]:
-    chat_data = get_chat(chat_uuid)
+    timer = StageTimer()
+    chat_data = await timer.run("chat_lookup", asyncio.to_thread(get_chat, chat_uuid))
     if not chat_data or chat_data.get("user_uuid") != user_uuid:
         return None
 
     chat_obj = Chat(**chat_data)
 
-    _apply_auto_title(chat_obj, req.content)
-
-    # 1. insert user message
+    # 1. insert user message, while fetching history and checking the bound kb
     user_msg = ChatMessage(
         uuid=str(uuid.uuid4()),
         chat_uuid=chat_uuid,
@@ -126,27 +131,23 @@ def send_message_service(
         content=req.content,
         create_at=_now_ms(),
     )
-    append_message(user_msg.dict())
+    history_docs, kb_owned = await _prepare_turn(chat_obj, user_msg, timer)
 
     # 2. generate reply (with kb RAG)
-    reply = _generate_and_store_reply(chat_obj, req.content)
-
-    # 3. 更新对话更新时间
-    update_chat(chat_uuid, {"update_at": _now_ms(), "title": chat_obj.title})
-
+    reply = await _generate_and_store_reply(chat_obj, req.content, history_docs, kb_owned, timer)
+    reply.timings = timer.finish()
     return reply
 
 
-def stream_message_service(
+async def stream_message_service(
     user_uuid: str, chat_uuid: str, req: ChatMessageCreate
-):
-    chat_data = get_chat(chat_uuid)
+) -> Optional[AsyncGenerator[str, None]]:
+    chat_data = await asyncio.to_thread(get_chat, chat_uuid)
     if not chat_data or chat_data.get("user_uuid") != user_uuid:
         return None
 
     chat_obj = Chat(**chat_data)
 
-    _apply_auto_title(chat_obj, req.content)
     user_msg = ChatMessage(
         uuid=str(uuid.uuid4()),
         chat_uuid=chat_uuid,
@@ -154,27 +155,57 @@ def stream_message_service(
         content=req.content,
         create_at=_now_ms(),
     )
-    append_message(user_msg.dict())
+    history_docs, _ = await _prepare_turn(chat_obj, user_msg, StageTimer())
+
+    return stream_reply_generator(chat_obj, req.content, history_docs)
+
+
+async def _prepare_turn(
+    chat_obj: Chat, user_msg: ChatMessage, timer: StageTimer
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    independent I/O before the completion runs concurrently: auto title,
+    persisting the user message, fetching history and the bound kb check.
+    history may or may not contain the new message yet,
+    _build_completion_messages handles both.
+    """
 
-    def generator():
-        for chunk in stream_reply_generator(chat_obj, req.content):
-            if chunk:
-                yield chunk
-        update_chat(chat_uuid, {"update_at": _now_ms(), "title": chat_obj.title})
+    async def store_user_message() -> None:
+        await asyncio.gather(
+            asyncio.to_thread(_apply_auto_title, chat_obj, user_msg.content),
+            asyncio.to_thread(append_message, user_msg.dict()),
+        )
 
-    return generator()
+    async def check_kb() -> bool:
+        if not chat_obj.kb_uuid:
+            return False
+        return bool(await asyncio.to_thread(get_owned_kb, chat_obj.kb_uuid, chat_obj.user_uuid))
+
+    _, history_docs, kb_owned = await asyncio.gather(
+        timer.run("store_user_message", store_user_message()),
+        timer.run("history", asyncio.to_thread(list_messages, chat_obj.uuid, limit=20)),
+        timer.run("kb_lookup", check_kb()),
+    )
+    return history_docs, kb_owned
 
 
-def _generate_and_store_reply(chat_obj: Chat, question: str) -> ChatReply:
+async def _generate_and_store_reply(
+    chat_obj: Chat,
+    question: str,
+    history_docs: List[Dict[str, Any]],
+    kb_owned: bool,
+    timer: StageTimer,
+) -> ChatReply:
     """
     Use conversation history to generate reply.
     If kb_uuid is bound, still write Q&A into KB for later retrieval.
     """
-    history_docs = list_messages(chat_obj.uuid, limit=20)
     messages = _build_completion_messages(history_docs, question)
-    answer = chat_completion(messages)
+    prompt_tokens = count_message_tokens(messages)
+    answer = await timer.run("completion", achat_completion(messages))
 
-    # 2. insert assistant message
+    # 2. insert assistant message, 3. if kb_uuid is bound, write Q&A as doc into the kb
+    # (vector for the answer generated in the background), 4. 更新对话更新时间
     assistant_msg = ChatMessage(
         uuid=str(uuid.uuid4()),
         chat_uuid=chat_obj.uuid,
@@ -182,45 +213,73 @@ def _generate_and_store_reply(chat_obj: Chat, question: str) -> ChatReply:
         content=answer,
         create_at=_now_ms(),
     )
-    append_message(assistant_msg.dict())
-
-    # 3. if kb_uuid is bound, write Q&A as doc into the kb, and generate vector for the answer
-    if chat_obj.kb_uuid:
-        if get_owned_kb(chat_obj.kb_uuid, chat_obj.user_uuid):
-            save_qa_to_kb(chat_obj.kb_uuid, question, answer)
+    persist = [
+        asyncio.to_thread(append_message, assistant_msg.dict()),
+        asyncio.to_thread(
+            update_chat, chat_obj.uuid, {"update_at": _now_ms(), "title": chat_obj.title}
+        ),
+    ]
+    if kb_owned:
+        persist.append(asyncio.to_thread(enqueue_save_qa, chat_obj.kb_uuid, question, answer))
+    await timer.run("store_reply", asyncio.gather(*persist))
 
     # currently context is conversation history, already used by model
-    return ChatReply(answer=answer, context=[])
+    return ChatReply(answer=answer, context=[], prompt_tokens=prompt_tokens)
 
 
-def stream_reply_generator(chat_obj: Chat, question: str):
-    history_docs = list_messages(chat_obj.uuid, limit=20)
+async def stream_reply_generator(
+    chat_obj: Chat, question: str, history_docs: Optional[List[Dict[str, Any]]] = None
+) -> AsyncGenerator[str, None]:
+    """
+    Stream the assistant reply.
+    When the stream ends, fails or is cancelled because the client went away,
+    the upstream completion is closed and the (possibly partial) reply is
+    persisted exactly once. Only complete replies are written back to the KB.
+    """
+    if history_docs is None:
+        history_docs = await asyncio.to_thread(list_messages, chat_obj.uuid, limit=20)
     messages = _build_completion_messages(history_docs, question)
-    buffer = ""
-    for chunk in stream_chat_completion(messages):
-        if chunk:
-            buffer += chunk
+    parts: List[str] = []
+    completed = False
+    stream = astream_chat_completion(messages)
+    try:
+        async for chunk in stream:
+            parts.append(chunk)
             yield chunk
-    if buffer:
+        completed = True
+    finally:
+        # cleanup must finish even though the surrounding task is being cancelled
+        with anyio.CancelScope(shield=True):
+            await stream.aclose()
+            await asyncio.to_thread(
+                _store_stream_reply, chat_obj, question, "".join(parts), completed
+            )
+
+
+def _store_stream_reply(chat_obj: Chat, question: str, answer: str, completed: bool) -> None:
+    if answer:
         assistant_msg = ChatMessage(
             uuid=str(uuid.uuid4()),
             chat_uuid=chat_obj.uuid,
             role="assistant",
-            content=buffer,
+            content=answer,
             create_at=_now_ms(),
         )
         append_message(assistant_msg.dict())
-        if chat_obj.kb_uuid and get_owned_kb(chat_obj.kb_uuid, chat_obj.user_uuid):
-            save_qa_to_kb(chat_obj.kb_uuid, question, buffer)
+        if completed and chat_obj.kb_uuid and get_owned_kb(chat_obj.kb_uuid, chat_obj.user_uuid):
+            enqueue_save_qa(chat_obj.kb_uuid, question, answer)
+    update_chat(chat_obj.uuid, {"update_at": _now_ms(), "title": chat_obj.title})
 
 
 def _build_completion_messages(
     history_docs: List[Dict[str, Any]],
     current_question: str,
     max_turns: int = 10,
+    token_budget: int = CHAT_PROMPT_TOKEN_BUDGET,
 ) -> List[Dict[str, str]]:
     """
     Convert stored chat history into OpenAI chat completion format.
+    History is packed newest first under token_budget, older turns are dropped.
     """
     base_prompt = (
         "You are a helpful assistant. Use the previous conversation context to answer. "
@@ -228,7 +287,7 @@ def _build_completion_messages(
     )
     messages: List[Dict[str, str]] = [{"role": "system", "content": base_prompt}]
 
-    last_content = None
+    history: List[Dict[str, str]] = []
     if history_docs:
         trimmed = history_docs[-max_turns:]
         for doc in trimmed:
@@ -238,12 +297,26 @@ def _build_completion_messages(
             content = doc.get("content", "")
             if not content:
                 continue
-            messages.append({"role": role, "content": content})
-            last_content = content
+            history.append({"role": role, "content": content})
 
     current_question = (current_question or "").strip()
-    if current_question and current_question != last_content:
-        messages.append({"role": "user", "content": current_question})
+    tail: List[Dict[str, str]] = []
+    if history and history[-1]["content"] == current_question:
+        # the question is already stored as the latest message
+        tail.append(history.pop())
+    elif current_question:
+        tail.append({"role": "user", "content": current_question})
+
+    remaining = token_budget - count_message_tokens(messages + tail)
+    kept: List[Dict[str, str]] = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if cost > remaining:
+            break
+        kept.append(message)
+        remaining -= cost
+    messages.extend(reversed(kept))
+    messages.extend(tail)
 
     return messages
 
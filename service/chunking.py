@@ -0,0 +1,202 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from service.tokenizer import count_tokens
+
+# a chunking policy is {"strategy", "tokens", "overlap", "model"}:
+# target chunk size and overlap in tokens of the kb's embedding model
+ChunkingPolicy = Dict[str, Any]
+
+# (kind, text, tokens, paragraph number) of a structural unit of a doc
+_Unit = Tuple[str, str, int, int]
+
+# chunk size of kbs created before chunking policies
+FIXED_CHUNK_CHARS = 400
+
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s+\S")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|(?<=[。．！？；])\s*")
+# chinese/japanese text has no spaces between sentences (hangul does, it is left out)
+_CJK_END = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff01-\uff60]$")
+_CJK_START = re.compile(r"^[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+# break points of the fixed windows, strongest first
+_FIXED_BREAKS = [
+    _PARAGRAPH_BREAK,
+    re.compile(r"\n"),
+    re.compile(r"[.!?]\s+|[。．！？；]"),
+    re.compile(r"\s+"),
+]
+
+
+def _fixed_chunks(content: str, policy: ChunkingPolicy) -> List[str]:
+    """
+    slicing into windows of at most FIXED_CHUNK_CHARS characters. a window ends at the
+    last paragraph, line, sentence or word break of its second half, so boundaries
+    depend on the text around them, not on the offset: after an edit they fall back
+    onto the old ones at the next break and only the chunks around the edit change.
+    text without breaks is cut at FIXED_CHUNK_CHARS.
+    """
+    chunks: List[str] = []
+    start = 0
+    while start < len(content):
+        end = min(start + FIXED_CHUNK_CHARS, len(content))
+        if end < len(content):
+            end = _fixed_boundary(content, start + FIXED_CHUNK_CHARS // 2, end)
+        chunks.append(content[start:end])
+        start = end
+    return chunks
+
+
+def _fixed_boundary(content: str, low: int, high: int) -> int:
+    """end of the strongest break in content[low:high], high when there is none"""
+    window = content[low:high]
+    for pattern in _FIXED_BREAKS:
+        matches = list(pattern.finditer(window))
+        if matches:
+            return low + matches[-1].end()
+    return high
+
+
+def _split_long(text: str, max_tokens: int, model: str) -> List[str]:
+    """cut a sentence longer than max_tokens at word boundaries, or at characters when it has none"""
+    pieces: List[str] = []
+    current = ""
+    for word in text.split():
+        candidate = f"{current} {word}".strip()
+        if current and count_tokens(candidate, model) > max_tokens:
+            pieces.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+
+    out: List[str] = []
+    for piece in pieces:
+        tokens = count_tokens(piece, model)
+        if tokens <= max_tokens:
+            out.append(piece)
+            continue
+        step = max(1, len(piece) * max_tokens // tokens)
+        out.extend(piece[start:start + step] for start in range(0, len(piece), step))
+    return out
+
+
+def _units(content: str, max_tokens: int, model: str) -> List[_Unit]:
+    """
+    structural units of content: "heading" lines, "paragraph"s that fit
+    max_tokens, and the "sentence"s of longer paragraphs. no unit exceeds max_tokens.
+    """
+    paragraphs: List[Tuple[str, str]] = []
+    for block in _PARAGRAPH_BREAK.split(content):
+        lines: List[str] = []
+        for line in block.strip().splitlines():
+            if _HEADING.match(line):
+                if lines:
+                    paragraphs.append(("paragraph", "\n".join(lines)))
+                    lines = []
+                paragraphs.append(("heading", line.strip()))
+            elif line.strip():
+                lines.append(line.rstrip())
+        if lines:
+            paragraphs.append(("paragraph", "\n".join(lines)))
+
+    units: List[_Unit] = []
+    for number, (kind, text) in enumerate(paragraphs):
+        tokens = count_tokens(text, model)
+        if tokens <= max_tokens:
+            units.append((kind, text, tokens, number))
+            continue
+        if kind == "heading":
+            # no sentences to split at, a heading line this long is cut like a long sentence
+            for piece in _split_long(text, max_tokens, model):
+                units.append(("heading", piece, count_tokens(piece, model), number))
+            continue
+        for sentence in _SENTENCE_BREAK.split(text):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            for piece in _split_long(sentence, max_tokens, model):
+                units.append(("sentence", piece, count_tokens(piece, model), number))
+    return units
+
+
+def _sentence_chunks(content: str, policy: ChunkingPolicy) -> List[str]:
+    """
+    pack headings, paragraphs and sentences greedily into chunks of at most
+    policy["tokens"]. a heading starts a new chunk once the current one is half
+    full, so sections stay together without leaving tiny chunks. a chunk that
+    continues a section repeats the trailing sentences of the previous one, up to
+    policy["overlap"] tokens.
+    """
+    max_tokens = max(1, int(policy["tokens"]))
+    overlap = max(0, min(int(policy["overlap"]), max_tokens // 2))
+    model = policy["model"]
+
+    chunks: List[str] = []
+    current: List[_Unit] = []
+    size = 0
+    fresh = 0  # units of current not carried over from the previous chunk
+
+    def flush(carry: bool) -> None:
+        nonlocal current, size, fresh
+        chunks.append(_join(current))
+        tail: List[_Unit] = []
+        if carry and overlap:
+            kept = 0
+            for unit in reversed(current):
+                if unit[0] == "heading" or kept + unit[2] > overlap:
+                    break
+                tail.insert(0, unit)
+                kept += unit[2]
+        current = tail
+        size = sum(unit[2] for unit in tail)
+        fresh = 0
+
+    for unit in _units(content, max_tokens, model):
+        if fresh and unit[0] == "heading" and size >= max_tokens // 2:
+            flush(carry=False)
+        elif fresh and size + unit[2] > max_tokens:
+            flush(carry=True)
+        if size + unit[2] > max_tokens:
+            # the overlap leaves no room for the unit
+            current, size = [], 0
+        current.append(unit)
+        size += unit[2]
+        fresh += 1
+    if fresh:
+        flush(carry=False)
+    return chunks
+
+
+def _join(units: List[_Unit]) -> str:
+    """
+    sentences of one paragraph are joined by a space (nothing around cjk text),
+    everything else by a blank line
+    """
+    text = ""
+    previous: Optional[_Unit] = None
+    for unit in units:
+        if previous is None:
+            text = unit[1]
+        elif unit[0] == "sentence" and previous[0] == "sentence" and unit[3] == previous[3]:
+            separator = "" if _CJK_END.search(text) or _CJK_START.match(unit[1]) else " "
+            text = f"{text}{separator}{unit[1]}"
+        else:
+            text = f"{text}\n\n{unit[1]}"
+        previous = unit
+    return text
+
+
+CHUNKERS: Dict[str, Callable[[str, ChunkingPolicy], List[str]]] = {
+    "fixed": _fixed_chunks,
+    "sentence": _sentence_chunks,
+}
+
+
+def chunk_text(content: str, policy: ChunkingPolicy) -> List[str]:
+    """split doc content into the chunks that get embedded, with the strategy of policy"""
+    content = content.strip()
+    if not content:
+        return []
+    return CHUNKERS[policy["strategy"]](content, policy)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Optional, List, Dict, Any
+
+from define import (
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CACHE_TOUCH_SECONDS,
+)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    content-addressed embedding cache stored in a local sqlite file.
+    key is (model, sha256(text)), vectors are stored as float32 blobs,
+    least recently used rows are evicted once max_entries is exceeded.
+    last_used is kept to touch_seconds precision, so most hits do not write.
+    """
+
+    def __init__(self, path: str, max_entries: int, touch_seconds: float = EMBEDDING_CACHE_TOUCH_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            " model TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used INTEGER NOT NULL,"
+            " PRIMARY KEY (model, hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._touch_ms = int(touch_seconds * 1000)
+        # rows in the file as last counted; other processes may share the file
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """return cached vectors in order, None for misses"""
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        now = int(time.time() * 1000)
+        stale: List[str] = []
+        with self._lock:
+            unique = list(set(hashes))
+            # stay under sqlite's bound parameter limit
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT hash, vector, last_used FROM embedding_cache WHERE model = ? AND hash IN (%s)"
+                    % ",".join("?" * len(part)),
+                    [model, *part],
+                ).fetchall()
+                for row_hash, blob, last_used in rows:
+                    found[row_hash] = array("f", blob).tolist()
+                    if now - last_used >= self._touch_ms:
+                        stale.append(row_hash)
+            if stale:
+                self._conn.executemany(
+                    "UPDATE embedding_cache SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in stale],
+                )
+                self._conn.commit()
+            results = [found.get(h) for h in hashes]
+            hit_count = sum(1 for item in results if item is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        if not texts:
+            return
+        now = int(time.time() * 1000)
+        rows = [
+            (model, text_hash(text), array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embedding_cache (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            if self._conn.total_changes > before:
+                # the per-process size misses rows other processes wrote, count the file
+                self._size = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+                if self._size > self._max_entries:
+                    self._evict(self._size - self._max_entries)
+            self._conn.commit()
+
+    def _evict(self, count: int) -> None:
+        cursor = self._conn.execute(
+            "DELETE FROM embedding_cache WHERE rowid IN ("
+            " SELECT rowid FROM embedding_cache ORDER BY last_used ASC LIMIT ?)",
+            (count,),
+        )
+        self._size -= cursor.rowcount
+        self.evictions += cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "max_entries": self._max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """get embedding cache (singleton pattern), None when disabled"""
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+    return _cache
@@ -0,0 +1,118 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from define import JOB_WORKERS, JOB_HISTORY_SIZE
+
+# job handlers get a report(**progress) callback as first argument
+ProgressReporter = Callable[..., None]
+
+# identifies this process as the owner of state it keeps in ES for a running job
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class JobRunner:
+    """
+    in-process background jobs on a small thread pool, polled by job id.
+    a job with the same dedupe key as a queued/running one is not started twice,
+    the running job is returned instead. finished jobs are kept for history_size
+    submissions so their result can still be polled.
+    """
+
+    def __init__(self, workers: int, history_size: int):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._active: Dict[Hashable, str] = {}
+        self._lock = threading.Lock()
+        self._history_size = max(1, history_size)
+
+    def submit(
+        self,
+        kind: str,
+        handler: Callable[..., Any],
+        *args: Any,
+        owner_uuid: Optional[str] = None,
+        key: Optional[Hashable] = None,
+    ) -> Dict[str, Any]:
+        with self._lock:
+            if key is not None and key in self._active:
+                return dict(self._jobs[self._active[key]])
+            job = {
+                "id": str(uuid.uuid4()),
+                "kind": kind,
+                "owner_uuid": owner_uuid,
+                "state": "queued",
+                "progress": {},
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            self._jobs[job["id"]] = job
+            if key is not None:
+                self._active[key] = job["id"]
+            self._trim()
+            snapshot = dict(job)
+        self._executor.submit(self._run, job["id"], key, handler, args)
+        return snapshot
+
+    def get(self, job_id: str, owner_uuid: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or (owner_uuid and job["owner_uuid"] != owner_uuid):
+                return None
+            return {**job, "progress": dict(job["progress"])}
+
+    def _run(self, job_id: str, key: Optional[Hashable], handler: Callable[..., Any], args: tuple) -> None:
+        self._update(job_id, state="running", started_at=time.time())
+
+        def report(**progress: Any) -> None:
+            with self._lock:
+                self._jobs[job_id]["progress"].update(progress)
+
+        try:
+            result = handler(report, *args)
+            self._update(job_id, state="succeeded", result=result)
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] job {job_id} failed: {exc}\n{traceback.format_exc()}")
+            self._update(job_id, state="failed", error=str(exc))
+        finally:
+            with self._lock:
+                self._jobs[job_id]["finished_at"] = time.time()
+                if key is not None and self._active.get(key) == job_id:
+                    del self._active[key]
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _trim(self) -> None:
+        """drop the oldest finished jobs beyond history_size"""
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[: max(0, len(self._jobs) - self._history_size)]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            states: Dict[str, int] = {}
+            for job in self._jobs.values():
+                states[job["state"]] = states.get(job["state"], 0) + 1
+            return {"jobs": len(self._jobs), "states": states}
+
+
+_job_runner: Optional[JobRunner] = None
+
+
+def get_job_runner() -> JobRunner:
+    """get the background job runner (singleton pattern)"""
+    global _job_runner
+    if _job_runner is None:
+        _job_runner = JobRunner(JOB_WORKERS, JOB_HISTORY_SIZE)
+    return _job_runner
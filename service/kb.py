@@ -1,14 +1,18 @@
-import uuid
+import asyncio
 import math
+import threading
+import time
+import uuid
 import io
 import json
 import zipfile
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 from pathlib import Path
 import re
 from collections import Counter
 
+import numpy as np
 import pandas as pd
 from docx import Document as DocxDocument
 from pptx import Presentation
@@ -20,46 +24,301 @@ from pptx import Presentation
 from pdfminer.high_level import extract_text as extract_pdf_text
 
 from dao.kb_dao import (
+    embed_index_name,
+    ensure_embed_index,
     create_kb,
     update_kb,
     delete_kb,
     list_kb,
     get_kb,
     create_doc,
+    create_doc_once,
     update_doc,
     delete_doc,
+    delete_docs,
+    iter_kb_docs,
     list_docs,
     get_doc,
     upsert_doc_embeddings,
-    list_doc_embeddings,
+    list_doc_chunks,
+    apply_doc_embedding_changes,
+    iter_doc_embeddings,
+    rewrite_embeddings,
     search_doc_embeddings_by_vector,
+    search_chunks_hybrid,
     search_docs_fulltext,
+    count_doc_embeddings,
+    index_embeddings,
+    delete_embeddings,
+    delete_kb_embeddings,
+    refresh_index,
+    bump_kb_generation,
+    find_embeddings_by_hash,
+    add_embedding_refs,
+    list_shared_embeddings,
+    claim_kb_migration,
+    update_kb_if_migration_owner,
+    list_migrating_kbs,
+    sample_embeddings,
 )
 from models.kb import (
     KnowledgeBase,
     KnowledgeBaseCreate,
     KnowledgeBaseUpdate,
+    KnowledgeBaseReembedRequest,
     KnowledgeDocument,
     KnowledgeDocumentCreate,
     KnowledgeDocumentUpdate,
     KnowledgeQAReply,
+    KB_DOC_EMBED_INDEX,
+    DEFAULT_EMBEDDING_DIMS,
+)
+from service.openai_service import (
+    achat_completion,
+    acreate_embeddings,
+    create_embeddings_batch,
+    DEFAULT_EMBEDDING_MODEL,
 )
-from service.openai_service import chat_completion, create_embeddings
+from service.openai_scheduler import PRIORITY_BULK
+from service.embedding_cache import text_hash
+from service.cache import LRUCache
+from service.answer_cache import answer_cache
+from service.tokenizer import count_tokens, count_message_tokens, truncate_to_tokens
+from service.writeback import WriteBackQueue
+from service.singleflight import SingleFlight
+from service.timing import StageTimer
+from service.jobs import WORKER_ID, ProgressReporter, get_job_runner
+from service.local_index import get_local_engine, load_kb_vectors
+from service.vector_store import get_vector_store
+from service.chunking import CHUNKERS, ChunkingPolicy, chunk_text
+from service.vector_ops import cosine_top_k, greedy_clusters, normalize_rows, unit_vector
+from define import (
+    EMBEDDING_BATCH_MAX_INPUTS,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_TTL,
+    ANSWER_CACHE_THRESHOLD,
+    QA_PROMPT_TOKEN_BUDGET,
+    WRITEBACK_SPOOL_PATH,
+    WRITEBACK_CAPACITY,
+    WRITEBACK_WORKERS,
+    WRITEBACK_MAX_ATTEMPTS,
+    QA_RETRIEVAL_MODE,
+    HYBRID_CANDIDATES,
+    HYBRID_RRF_K,
+    EMBEDDING_MODEL,
+    EMBEDDING_DIMS,
+    MAX_VECTOR_DIMS,
+    REEMBED_HEARTBEAT_SECONDS,
+    REEMBED_STALE_SECONDS,
+    RETRIEVAL_CACHE_SIZE,
+    RETRIEVAL_CACHE_SETTLE_MS,
+    RETRIEVAL_CACHE_TTL,
+    QA_COMPACTION_THRESHOLD,
+    CHUNK_DEDUP_ENABLED,
+    CHUNKING_STRATEGY,
+    CHUNK_TOKENS,
+    CHUNK_OVERLAP_TOKENS,
+    VECTOR_SIMILARITY,
+)
+
+# a context chunk is only truncated into the prompt when this many tokens are left
+MIN_TRUNCATED_CHUNK_TOKENS = 64
+
+# repeated searches/questions reuse the query vector instead of calling OpenAI
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE, ttl=QUERY_EMBEDDING_CACHE_TTL)
+
+# retrieval results keyed by (kind, kb_uuid, generation, query, top_k, ...): every write
+# bumps the kb generation, the ttl only bounds staleness after a bump that failed
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+
+_qa_writeback: Optional[WriteBackQueue] = None
+
+qa_flights = SingleFlight("qa")
+
+# in-process retrieval index manager, None when RETRIEVAL_ENGINE=es
+_local_engine = get_local_engine()
+# local vector copies kept in sync with every vector write of this process
+_local_sinks = [sink for sink in (_local_engine, get_vector_store()) if sink is not None]
+
+# output size of the embedding models, text-embedding-3-* can be shortened below it
+_NATIVE_EMBEDDING_DIMS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+# (model, dims) last seen per kb, a query is embedded before its kb lookup returns
+_kb_embedding_hints = LRUCache(4096)
 
 
 def _now_ms() -> int:
     return int(datetime.utcnow().timestamp() * 1000)
 
 
-def _cosine_similarity(a: List[float], b: List[float]) -> float:
-    if len(a) != len(b):
-        return 0.0
-    dot = sum(x * y for x, y in zip(a, b))
-    norm_a = math.sqrt(sum(x * x for x in a))
-    norm_b = math.sqrt(sum(y * y for y in b))
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    return dot / (norm_a * norm_b)
+def _normalize_query(text: str) -> str:
+    """whitespace-collapsed query; case is kept, the embedding (and so the results) depends on it"""
+    return " ".join((text or "").split())
+
+
+async def _embed_query(
+    text: str, model: str = DEFAULT_EMBEDDING_MODEL, dims: int = DEFAULT_EMBEDDING_DIMS
+) -> List[float]:
+    # whitespace variants of a query share the cache entry; casing carries meaning
+    # (acronyms, names) for the model, "US" and "us" are embedded separately
+    normalized = _normalize_query(text)
+    key = (model, dims, normalized)
+    cached = query_embedding_cache.get(key)
+    if cached is not None:
+        return cached
+    # unit length, so dot product against the stored (unit) vectors is the cosine
+    vector = unit_vector(
+        await acreate_embeddings(normalized, model=model, dimensions=_api_dimensions(model, dims))
+    )
+    query_embedding_cache.set(key, vector)
+    return vector
+
+
+async def _get_owned_kb_and_query_vector(
+    kb_uuid: str, owner_uuid: str, text: str, timer: Optional[StageTimer] = None
+) -> Tuple[Optional[KnowledgeBase], List[float]]:
+    """
+    kb lookup and query embedding run concurrently: the query is embedded with the
+    model last seen for the kb and embedded again only if the kb was re-embedded since.
+    """
+    model, dims = _kb_embedding_hints.get(kb_uuid) or (DEFAULT_EMBEDDING_MODEL, DEFAULT_EMBEDDING_DIMS)
+    lookup = asyncio.to_thread(_get_owned_kb, kb_uuid, owner_uuid)
+    embed = _embed_query(text, model, dims)
+    if timer is not None:
+        lookup, embed = timer.run("kb_lookup", lookup), timer.run("embed", embed)
+    kb, query_vector = await asyncio.gather(lookup, embed)
+    if kb is None:
+        return None, query_vector
+    spec = _kb_embedding(kb)
+    if (spec["model"], spec["dims"]) != (model, dims):
+        _kb_embedding_hints.set(kb_uuid, (spec["model"], spec["dims"]))
+        embed = _embed_query(text, spec["model"], spec["dims"])
+        query_vector = await (timer.run("embed_retry", embed) if timer is not None else embed)
+    return kb, query_vector
+
+
+def _api_dimensions(model: str, dims: int) -> Optional[int]:
+    """the dimensions request parameter, only text-embedding-3-* models accept it"""
+    return dims if model.startswith("text-embedding-3") else None
+
+
+def _embedding_spec(model: str, dims: Optional[int] = None) -> Dict[str, Any]:
+    """validated {"model", "dims", "index"} of an embedding model, dims None = native size"""
+    native = _NATIVE_EMBEDDING_DIMS.get(model)
+    dims = dims or native
+    if not dims or dims <= 0:
+        raise ValueError(f"embedding_dims is required for model {model}")
+    if native and dims > native:
+        raise ValueError(f"{model} outputs at most {native} dimensions")
+    if dims != native and _api_dimensions(model, dims) is None:
+        raise ValueError(f"{model} does not support shortened embeddings")
+    if dims > MAX_VECTOR_DIMS:
+        raise ValueError(f"vector indices hold at most {MAX_VECTOR_DIMS} dimensions, set a smaller embedding_dims")
+    return {"model": model, "dims": dims, "index": embed_index_name(model, dims)}
+
+
+def _kb_embedding(kb: KnowledgeBase) -> Dict[str, Any]:
+    """the {"model", "dims", "index"} a kb is searched with"""
+    return {
+        "model": kb.embedding_model or DEFAULT_EMBEDDING_MODEL,
+        "dims": kb.embedding_dims or DEFAULT_EMBEDDING_DIMS,
+        "index": kb.embed_index or KB_DOC_EMBED_INDEX,
+    }
+
+
+def _migration_stale(migration: Dict[str, Any]) -> bool:
+    """the worker of a re-embed migration sent no heartbeat within REEMBED_STALE_SECONDS"""
+    return (migration.get("heartbeat_at") or 0) < _now_ms() - REEMBED_STALE_SECONDS * 1000
+
+
+def _write_targets(kb: KnowledgeBase) -> List[Dict[str, Any]]:
+    """every vector write goes to the live index, and to the re-embed target while a job runs"""
+    targets = [_kb_embedding(kb)]
+    if kb.embed_migration and not _migration_stale(kb.embed_migration):
+        targets.append(kb.embed_migration)
+    return targets
+
+
+def _chunking_fields(
+    strategy: Optional[str], tokens: Optional[int], overlap: Optional[int], kb: Optional[KnowledgeBase] = None
+) -> Dict[str, Any]:
+    """
+    validated chunking fields of a kb, raises ValueError. on an update the overlap
+    is checked against the kb's stored chunk size (or overlap) left out of the request.
+    """
+    if strategy is not None and strategy not in CHUNKERS:
+        raise ValueError(f"unsupported chunking {strategy}, expected one of {sorted(CHUNKERS)}")
+    if tokens is not None and tokens < 16:
+        raise ValueError("chunk_tokens must be at least 16")
+    if overlap is not None and overlap < 0:
+        raise ValueError("chunk_overlap must not be negative")
+    checked_overlap = overlap if overlap is not None or kb is None else kb.chunk_overlap
+    checked_tokens = tokens or (kb.chunk_tokens if kb is not None else None) or CHUNK_TOKENS
+    changed = tokens is not None or overlap is not None
+    if changed and checked_overlap is not None and checked_overlap * 2 > checked_tokens:
+        raise ValueError("chunk_overlap must be at most half of chunk_tokens")
+    fields = {"chunking": strategy, "chunk_tokens": tokens, "chunk_overlap": overlap}
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def _check_answer_cache_threshold(threshold: Optional[float]) -> None:
+    """cosine thresholds outside 0..1 can never, or always, hit; raises ValueError"""
+    if threshold is not None and not 0.0 <= threshold <= 1.0:
+        raise ValueError("answer_cache_threshold must be between 0 and 1")
+
+
+def _chunking_policy(kb: KnowledgeBase) -> ChunkingPolicy:
+    """how the docs of kb are chunked, tokens are counted with the kb's embedding model"""
+    return {
+        "strategy": kb.chunking or "fixed",
+        "tokens": kb.chunk_tokens or CHUNK_TOKENS,
+        "overlap": CHUNK_OVERLAP_TOKENS if kb.chunk_overlap is None else kb.chunk_overlap,
+        "model": _kb_embedding(kb)["model"],
+    }
+
+
+def _embed_texts(texts: List[str], spec: Dict[str, Any]) -> List[List[float]]:
+    return create_embeddings_batch(
+        texts,
+        model=spec["model"],
+        priority=PRIORITY_BULK,
+        dimensions=_api_dimensions(spec["model"], spec["dims"]),
+    )
+
+
+def _retrieval_generation(kb: KnowledgeBase) -> Optional[int]:
+    """
+    the generation to cache retrieval results of kb under, None while the last write
+    may not be searchable yet: a result read then must not be cached as current.
+    """
+    if kb.generation_at and _now_ms() - kb.generation_at < RETRIEVAL_CACHE_SETTLE_MS:
+        return None
+    return kb.generation
+
+
+def _cached_retrieval(key: Optional[Tuple]) -> Optional[List[Dict[str, Any]]]:
+    if key is None:
+        return None
+    cached = retrieval_cache.get(key)
+    return [dict(item) for item in cached] if cached is not None else None
+
+
+def _store_retrieval(key: Optional[Tuple], results: List[Dict[str, Any]]) -> None:
+    if key is not None:
+        retrieval_cache.set(key, [dict(item) for item in results])
+
+
+def _retrieval_key(kind: str, kb: Optional[KnowledgeBase], query: str, top_k: int, *extra: Any) -> Optional[Tuple]:
+    if kb is None:
+        return None
+    generation = _retrieval_generation(kb)
+    if generation is None:
+        return None
+    return (kind, kb.uuid, generation, _normalize_query(query), top_k, *extra)
 
 
 def _get_owned_kb(kb_uuid: str, owner_uuid: str) -> Optional[KnowledgeBase]:
@@ -77,6 +336,13 @@ def get_owned_kb(kb_uuid: str, owner_uuid: str) -> Optional[KnowledgeBase]:
 
 
 def create_kb_service(owner_uuid: str, req: KnowledgeBaseCreate) -> KnowledgeBase:
+    if req.embedding_model:
+        spec = _embedding_spec(req.embedding_model, req.embedding_dims)
+    else:
+        spec = _embedding_spec(EMBEDDING_MODEL, req.embedding_dims or EMBEDDING_DIMS)
+    chunking = _chunking_fields(req.chunking or CHUNKING_STRATEGY, req.chunk_tokens, req.chunk_overlap)
+    _check_answer_cache_threshold(req.answer_cache_threshold)
+    ensure_embed_index(spec["index"], spec["dims"])
     kb = KnowledgeBase(
         uuid=str(uuid.uuid4()),
         name=req.name,
@@ -84,6 +350,12 @@ def create_kb_service(owner_uuid: str, req: KnowledgeBaseCreate) -> KnowledgeBas
         owner_uuid=owner_uuid,
         create_at=_now_ms(),
         update_at=_now_ms(),
+        answer_cache_enabled=req.answer_cache_enabled,
+        answer_cache_threshold=req.answer_cache_threshold,
+        embedding_model=spec["model"],
+        embedding_dims=spec["dims"],
+        embed_index=spec["index"],
+        **chunking,
     )
     create_kb(kb.dict())
     return kb
@@ -99,6 +371,12 @@ def update_kb_service(owner_uuid: str, uuid_: str, req: KnowledgeBaseUpdate) ->
         fields["name"] = req.name
     if req.description is not None:
         fields["description"] = req.description
+    if req.answer_cache_enabled is not None:
+        fields["answer_cache_enabled"] = req.answer_cache_enabled
+    if req.answer_cache_threshold is not None:
+        _check_answer_cache_threshold(req.answer_cache_threshold)
+        fields["answer_cache_threshold"] = req.answer_cache_threshold
+    fields.update(_chunking_fields(req.chunking, req.chunk_tokens, req.chunk_overlap, kb))
     if not fields:
         return kb
 
@@ -114,20 +392,397 @@ def delete_kb_service(owner_uuid: str, uuid_: str) -> bool:
     if not kb:
         return False
     delete_kb(uuid_)
+    for sink in _local_sinks:
+        sink.drop(uuid_)
     return True
 
 
+def _touch_kb_content(kb_uuid: str) -> None:
+    """
+    stamp a user-driven doc change on the kb, cached answers of older stamps stop matching.
+    qa write-back docs do not touch the stamp, they never change what a question retrieves
+    from the user's own documents.
+    """
+    update_kb(kb_uuid, {"content_update_at": _now_ms()})
+
+
+def _content_settling(kb: KnowledgeBase) -> bool:
+    """the last doc change of kb may not be searchable yet"""
+    return bool(kb.content_update_at) and _now_ms() - kb.content_update_at < RETRIEVAL_CACHE_SETTLE_MS
+
+
 def list_kb_service(owner_uuid: str, page: int, size: int) -> Dict[str, Any]:
     return list_kb(page, size, owner_uuid)
 
 
+# ==== re-embedding ====
+
+_REEMBED_FIELDS = ["uuid", "doc_uuid", "chunk", "chunk_hash", "dedup_hash", "ref_doc_uuids", "create_at"]
+
+
+def reembed_kb_service(
+    owner_uuid: str, kb_uuid: str, req: KnowledgeBaseReembedRequest
+) -> Optional[Dict[str, Any]]:
+    """
+    start a background job moving the kb to another embedding model / dims.
+    raises ValueError for an unsupported size or the model the kb already uses.
+    """
+    kb = _get_owned_kb(kb_uuid, owner_uuid)
+    if not kb:
+        return None
+    target = _embedding_spec(req.embedding_model, req.embedding_dims)
+    if target["index"] == _kb_embedding(kb)["index"]:
+        raise ValueError(f"kb is already embedded with {target['model']} ({target['dims']} dims)")
+    migration = kb.embed_migration
+    if migration and migration.get("owner") != WORKER_ID and not _migration_stale(migration):
+        raise ValueError("a re-embed of this kb is already running on another worker")
+    return get_job_runner().submit(
+        "reembed", _reembed_kb, kb_uuid, target, owner_uuid=owner_uuid, key=("reembed", kb_uuid)
+    )
+
+
+def compact_qa_service(
+    owner_uuid: str,
+    kb_uuid: str,
+    threshold: Optional[float] = None,
+    dry_run: bool = False,
+    include_legacy: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """start a background Q/A compaction of the kb, see compact_qa_docs"""
+    if not _get_owned_kb(kb_uuid, owner_uuid):
+        return None
+    return get_job_runner().submit(
+        "compact_qa",
+        _compact_qa_job,
+        kb_uuid,
+        QA_COMPACTION_THRESHOLD if threshold is None else threshold,
+        dry_run,
+        include_legacy,
+        owner_uuid=owner_uuid,
+        key=("compact_qa", kb_uuid),
+    )
+
+
+def get_job_service(owner_uuid: str, job_id: str) -> Optional[Dict[str, Any]]:
+    return get_job_runner().get(job_id, owner_uuid=owner_uuid)
+
+
+def _reembed_kb(report: ProgressReporter, kb_uuid: str, target: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    re-embed every vector of the kb into the target index without downtime:
+    1. mark the migration on the kb, from then on every vector write goes to both indices
+    2. backfill the target from a point-in-time scan of the live index
+    3. reconcile the vector uuids of both indices (writes racing the backfill)
+    4. cut over with a single update of the kb doc, then drop the old vectors
+    searches keep using the live index until step 4.
+    """
+    kb_data = get_kb(kb_uuid)
+    if not kb_data:
+        raise ValueError("kb not found")
+    kb = KnowledgeBase(**kb_data)
+    source = _kb_embedding(kb)
+    ensure_embed_index(target["index"], target["dims"])
+    migration = {**target, "owner": WORKER_ID, "heartbeat_at": _now_ms()}
+    if not claim_kb_migration(kb_uuid, migration, _now_ms() - int(REEMBED_STALE_SECONDS * 1000)):
+        raise RuntimeError("a re-embed of this kb is already running on another worker")
+    # leftovers of an earlier failed or abandoned run
+    abandoned = kb.embed_migration
+    if abandoned and abandoned.get("index") not in (target["index"], source["index"]):
+        delete_kb_embeddings(kb_uuid, abandoned["index"])
+    delete_kb_embeddings(kb_uuid, target["index"])
+    with _MigrationLease(kb_uuid, migration) as lease:
+        try:
+            report(phase="backfill", total=count_doc_embeddings(kb_uuid, index=source["index"]), done=0)
+            done = 0
+            page: List[Dict[str, Any]] = []
+            for item in iter_doc_embeddings(kb_uuid, source_includes=_REEMBED_FIELDS, index=source["index"]):
+                page.append(item)
+                if len(page) >= EMBEDDING_BATCH_MAX_INPUTS:
+                    lease.check()
+                    done += _reembed_vectors(kb_uuid, page, target)
+                    page = []
+                    report(done=done)
+            if page:
+                done += _reembed_vectors(kb_uuid, page, target)
+                report(done=done)
+
+            report(phase="reconcile")
+            refresh_index(source["index"])
+            refresh_index(target["index"])
+            added, removed = _reconcile_embeddings(kb_uuid, source, target)
+            lease.check()
+        except Exception:
+            # a worker that took the migration over owns the target vectors now
+            if update_kb_if_migration_owner(kb_uuid, WORKER_ID, {"embed_migration": None}):
+                delete_kb_embeddings(kb_uuid, target["index"])
+            raise
+
+        report(phase="cutover")
+        for sink in _local_sinks:
+            sink.drop(kb_uuid)
+        now = _now_ms()
+        # content_update_at invalidates the answers cached for vectors of the old model
+        switched = update_kb_if_migration_owner(
+            kb_uuid,
+            WORKER_ID,
+            {
+                "embedding_model": target["model"],
+                "embedding_dims": target["dims"],
+                "embed_index": target["index"],
+                "embed_migration": None,
+                "content_update_at": now,
+                "update_at": now,
+            },
+        )
+    if not switched:
+        raise RuntimeError("re-embed migration was taken over by another worker before the cutover")
+    bump_kb_generation(kb_uuid)
+    _kb_embedding_hints.set(kb_uuid, (target["model"], target["dims"]))
+    for sink in _local_sinks:
+        sink.drop(kb_uuid)
+
+    report(phase="cleanup")
+    delete_kb_embeddings(kb_uuid, source["index"])
+    report(phase="done")
+    return {
+        "model": target["model"],
+        "dims": target["dims"],
+        "index": target["index"],
+        "previous_index": source["index"],
+        "backfilled": done,
+        "reconciled_added": added,
+        "reconciled_removed": removed,
+    }
+
+
+class _MigrationLease:
+    """
+    keeps the heartbeat of a claimed re-embed migration fresh from a background thread.
+    the lease is lost once another worker took the migration over, or when heartbeats
+    failed for the stale window (other workers may treat the migration as abandoned).
+    """
+
+    def __init__(self, kb_uuid: str, migration: Dict[str, Any]):
+        self._kb_uuid = kb_uuid
+        self._migration = migration
+        self._renewed_at = time.monotonic()
+        self._lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"reembed-heartbeat-{kb_uuid}", daemon=True)
+
+    def __enter__(self) -> "_MigrationLease":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(REEMBED_HEARTBEAT_SECONDS):
+            migration = {**self._migration, "heartbeat_at": _now_ms()}
+            try:
+                if not update_kb_if_migration_owner(self._kb_uuid, WORKER_ID, {"embed_migration": migration}):
+                    self._lost = True
+                    return
+                self._renewed_at = time.monotonic()
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"[WARN] re-embed heartbeat of kb {self._kb_uuid} failed: {exc}")
+
+    def check(self) -> None:
+        """raise when the migration may no longer be ours"""
+        if self._lost or time.monotonic() - self._renewed_at > REEMBED_STALE_SECONDS:
+            raise RuntimeError("re-embed migration lease lost, another worker may have taken it over")
+
+
+def recover_stale_migrations() -> int:
+    """
+    clear re-embed migrations whose worker died (no heartbeat for REEMBED_STALE_SECONDS):
+    writes already stopped dual-writing to them, their half-filled target vectors are
+    dropped here. a re-submitted re-embed starts over. returns the number cleared.
+    """
+    cleared = 0
+    for kb_data in list_migrating_kbs():
+        migration = kb_data.get("embed_migration") or {}
+        if not _migration_stale(migration):
+            continue
+        stale_before = _now_ms() - int(REEMBED_STALE_SECONDS * 1000)
+        claim = {**migration, "owner": WORKER_ID, "heartbeat_at": _now_ms()}
+        if not claim_kb_migration(kb_data["uuid"], claim, stale_before):
+            continue
+        if not update_kb_if_migration_owner(kb_data["uuid"], WORKER_ID, {"embed_migration": None}):
+            continue
+        delete_kb_embeddings(kb_data["uuid"], migration["index"])
+        print(f"[WARN] cleared abandoned re-embed of kb {kb_data['uuid']} to {migration['index']}")
+        cleared += 1
+    return cleared
+
+
+def _reembed_vectors(kb_uuid: str, items: List[Dict[str, Any]], target: Dict[str, Any]) -> int:
+    """embed stored chunks with the target model, keeping their vector uuids"""
+    embeddings = _embed_texts([item.get("chunk", "") for item in items], target)
+    index_embeddings(
+        kb_uuid,
+        [_with_embedding(item, embedding) for item, embedding in zip(items, embeddings)],
+        target["index"],
+    )
+    return len(items)
+
+
+def _legacy_qa_answer(doc: Dict[str, Any]) -> Optional[str]:
+    """
+    the answer of a doc stored by save_qa_to_kb before docs had a source field,
+    None when doc does not have exactly that shape (title = question[:50]).
+    imported FAQ docs can share the Q:/A: layout, the caller must also check the
+    doc's vectors: a single one embedding just the answer.
+    """
+    if "source" in doc:
+        return None
+    content = doc.get("content") or ""
+    if not content.startswith("Q: ") or "\n\nA: " not in content:
+        return None
+    question, answer = content[len("Q: "):].split("\n\nA: ", 1)
+    if doc.get("title") != question[:50]:
+        return None
+    return answer
+
+
+def kb_vector_index(kb_uuid: str) -> str:
+    """the vector index a kb is searched in, for maintenance code without a KnowledgeBase at hand"""
+    kb_data = get_kb(kb_uuid)
+    if not kb_data:
+        return KB_DOC_EMBED_INDEX
+    return _kb_embedding(KnowledgeBase(**kb_data))["index"]
+
+
+def _compact_qa_job(
+    report: ProgressReporter, kb_uuid: str, threshold: float, dry_run: bool, include_legacy: bool
+) -> Dict[str, Any]:
+    return compact_qa_docs(kb_uuid, threshold, dry_run, report, include_legacy=include_legacy)
+
+
+def compact_qa_docs(
+    kb_uuid: str,
+    threshold: float = QA_COMPACTION_THRESHOLD,
+    dry_run: bool = False,
+    report: Optional[ProgressReporter] = None,
+    include_legacy: bool = False,
+) -> Dict[str, Any]:
+    """
+    collapse near-duplicate auto-saved Q/A docs of a kb: docs with source "qa" are
+    clustered by the cosine of their answer vectors (greedy, newest first), the newest
+    doc of every cluster is kept and the others are deleted in bulk with their vectors.
+    include_legacy also takes docs saved before the source field that have exactly the
+    save_qa_to_kb shape (see _legacy_qa_answer), other docs are never touched.
+    returns what was (or with dry_run would be) reclaimed.
+    """
+    report = report or (lambda **_: None)
+    report(phase="scan")
+    qa_docs: Dict[str, Dict[str, Any]] = {}
+    legacy_answers: Dict[str, str] = {}
+    for doc in iter_kb_docs(kb_uuid, source_includes=["uuid", "title", "content", "source", "create_at"]):
+        if doc.get("source") == "qa":
+            qa_docs[doc["uuid"]] = doc
+            continue
+        answer = _legacy_qa_answer(doc) if include_legacy else None
+        if answer is not None:
+            qa_docs[doc["uuid"]] = doc
+            legacy_answers[doc["uuid"]] = answer
+    embed_index = kb_vector_index(kb_uuid)
+    vectors: Dict[str, List[float]] = {}
+    chunk_counts: Counter = Counter()
+    for item in iter_doc_embeddings(
+        kb_uuid, source_includes=["doc_uuid", "chunk", "embedding"], index=embed_index
+    ):
+        doc_uuid = item.get("doc_uuid")
+        if doc_uuid not in qa_docs or not item.get("embedding"):
+            continue
+        chunk_counts[doc_uuid] += 1
+        vectors.setdefault(doc_uuid, item["embedding"])
+        if doc_uuid in legacy_answers and item.get("chunk") != legacy_answers[doc_uuid]:
+            chunk_counts[doc_uuid] = -1  # embeds more than the answer, not a saved Q/A
+    for doc_uuid in legacy_answers:
+        if chunk_counts[doc_uuid] != 1:
+            qa_docs.pop(doc_uuid)
+            vectors.pop(doc_uuid, None)
+
+    # newest first, so the kept doc of a cluster carries the latest answer
+    order = sorted(vectors, key=lambda doc_uuid: qa_docs[doc_uuid].get("create_at") or 0, reverse=True)
+    summary: Dict[str, Any] = {
+        "kb_uuid": kb_uuid,
+        "threshold": threshold,
+        "dry_run": dry_run,
+        "include_legacy": include_legacy,
+        "qa_docs": len(qa_docs),
+        "clusters": 0,
+        "deleted_docs": 0,
+        "deleted_chunks": 0,
+        "content_bytes": 0,
+        "vector_bytes": 0,
+        "bytes_reclaimed": 0,
+    }
+    if not order:
+        return summary
+
+    report(phase="cluster", qa_docs=len(order))
+    matrix = normalize_rows(np.asarray([vectors[doc_uuid] for doc_uuid in order], dtype=np.float32))
+    clusters = greedy_clusters(matrix, threshold)
+    redundant = [order[row] for cluster in clusters for row in cluster[1:]]
+    summary["clusters"] = len(clusters)
+    summary["deleted_docs"] = len(redundant)
+    summary["deleted_chunks"] = sum(chunk_counts[doc_uuid] for doc_uuid in redundant)
+    summary["content_bytes"] = sum(len((qa_docs[doc_uuid].get("content") or "").encode("utf-8")) for doc_uuid in redundant)
+    # float32 dense_vector doc values, the _source copy of the vector comes on top
+    summary["vector_bytes"] = summary["deleted_chunks"] * matrix.shape[1] * 4
+    summary["bytes_reclaimed"] = summary["content_bytes"] + summary["vector_bytes"]
+    if dry_run or not redundant:
+        return summary
+
+    report(phase="delete", deleted_docs=len(redundant))
+    for start in range(0, len(redundant), EMBEDDING_BATCH_MAX_INPUTS):
+        batch = redundant[start:start + EMBEDDING_BATCH_MAX_INPUTS]
+        shared = list_shared_embeddings(batch, index=embed_index) if _local_sinks else []
+        delete_docs(kb_uuid, batch)
+        for sink in _local_sinks:
+            for doc_uuid in batch:
+                sink.remove_doc(kb_uuid, doc_uuid)
+        _rehome_shared_locally(kb_uuid, shared, set(batch))
+    return summary
+
+
+def _reconcile_embeddings(
+    kb_uuid: str, source: Dict[str, Any], target: Dict[str, Any]
+) -> Tuple[int, int]:
+    """
+    embed the vectors the target misses and drop the ones the live index no longer has,
+    returns (added, removed).
+    """
+    present = {
+        item.get("uuid")
+        for item in iter_doc_embeddings(kb_uuid, source_includes=["uuid"], index=target["index"])
+    }
+    live = set()
+    missing: List[Dict[str, Any]] = []
+    for item in iter_doc_embeddings(kb_uuid, source_includes=_REEMBED_FIELDS, index=source["index"]):
+        live.add(item.get("uuid"))
+        if item.get("uuid") not in present:
+            missing.append(item)
+    for start in range(0, len(missing), EMBEDDING_BATCH_MAX_INPUTS):
+        _reembed_vectors(kb_uuid, missing[start:start + EMBEDDING_BATCH_MAX_INPUTS], target)
+    stale = [vector_uuid for vector_uuid in present - live if vector_uuid]
+    if stale:
+        delete_embeddings(stale, target["index"])
+    return len(missing), len(stale)
+
+
 # ==== doc ====
 
 
 def create_doc_service(
     owner_uuid: str, kb_uuid: str, req: KnowledgeDocumentCreate
 ) -> Optional[KnowledgeDocument]:
-    if not _get_owned_kb(kb_uuid, owner_uuid):
+    kb = _get_owned_kb(kb_uuid, owner_uuid)
+    if not kb:
         return None
 
     doc = KnowledgeDocument(
@@ -141,7 +796,8 @@ def create_doc_service(
     create_doc(doc.dict())
 
     # generate embedding and write into
-    _generate_and_store_embeddings_for_doc(doc)
+    _generate_and_store_embeddings_for_doc(doc, _write_targets(kb), _chunking_policy(kb))
+    _touch_kb_content(kb_uuid)
 
     return doc
 
@@ -153,7 +809,8 @@ def update_doc_service(
     if not doc_data:
         return None
     kb_uuid = doc_data.get("kb_uuid")
-    if not kb_uuid or not _get_owned_kb(kb_uuid, owner_uuid):
+    kb = _get_owned_kb(kb_uuid, owner_uuid) if kb_uuid else None
+    if not kb:
         return None
 
     fields: Dict[str, Any] = {}
@@ -169,18 +826,25 @@ def update_doc_service(
     doc_data.update(fields)
     doc = KnowledgeDocument(**doc_data)
 
-    # if content has changed, regenerate embedding
+    # if content has changed, re-embed the chunks that changed
     if req.content is not None:
-        _generate_and_store_embeddings_for_doc(doc)
+        _sync_doc_embeddings(doc, _write_targets(kb), _chunking_policy(kb))
+        _touch_kb_content(kb_uuid)
 
     return doc
 
 
 def delete_doc_service(owner_uuid: str, uuid_: str) -> bool:
     doc_data = get_doc(uuid_)
-    if not doc_data or not _get_owned_kb(doc_data.get("kb_uuid", ""), owner_uuid):
+    kb = _get_owned_kb(doc_data.get("kb_uuid", ""), owner_uuid) if doc_data else None
+    if not kb:
         return False
+    shared = list_shared_embeddings([uuid_], index=_kb_embedding(kb)["index"]) if _local_sinks else []
     delete_doc(uuid_)
+    for sink in _local_sinks:
+        sink.remove_doc(kb.uuid, uuid_)
+    _rehome_shared_locally(kb.uuid, shared, {uuid_})
+    _touch_kb_content(kb.uuid)
     return True
 
 
@@ -190,109 +854,449 @@ def list_docs_service(owner_uuid: str, kb_uuid: str, page: int, size: int) -> Di
     return list_docs(kb_uuid, page, size)
 
 
-def _chunk_text(content: str, max_chars: int = 400) -> List[str]:
+def _generate_and_store_embeddings_for_doc(
+    doc: KnowledgeDocument, targets: List[Dict[str, Any]], chunking: ChunkingPolicy
+) -> int:
+    return _generate_and_store_embeddings_for_docs([doc], targets, chunking)
+
+
+def _generate_and_store_embeddings_for_docs(
+    docs: List[KnowledgeDocument],
+    targets: List[Dict[str, Any]],
+    chunking: ChunkingPolicy,
+    dedup: bool = CHUNK_DEDUP_ENABLED,
+    doc_texts: Optional[List[List[str]]] = None,
+) -> int:
     """
-    currently kb is mainly used for ES query, not fed to OpenAI.
-    keep a simple chunking function for future extension.
+    write the vectors of docs (see _write_docs_embeddings), then bump the kb generation
+    once for the whole batch instead of once per doc and target
     """
-    content = content.strip()
-    if not content:
-        return []
-    chunks: List[str] = []
-    start = 0
-    while start < len(content):
-        end = min(start + max_chars, len(content))
-        chunks.append(content[start:end])
-        start = end
-    return chunks
-
+    try:
+        return _write_docs_embeddings(docs, targets, chunking, dedup, doc_texts)
+    finally:
+        if docs:
+            bump_kb_generation(docs[0].kb_uuid)
+
+
+def _write_docs_embeddings(
+    docs: List[KnowledgeDocument],
+    targets: List[Dict[str, Any]],
+    chunking: ChunkingPolicy,
+    dedup: bool,
+    doc_texts: Optional[List[List[str]]] = None,
+) -> int:
+    """
+    chunk every doc (all of one kb) with the kb's chunking policy, embed all chunks with batched requests,
+    then write the vectors back per doc, once per write target.
+    a chunk keeps the same vector uuid in every target index.
+    with dedup a chunk whose normalized text already has a vector in the kb (or
+    earlier in the batch) is neither embedded nor written, its doc references
+    the existing vector. returns the number of deduplicated chunks.
+    doc_texts are the chunk texts of docs when the caller chunked them already.
+    """
+    if doc_texts is None:
+        doc_texts = [chunk_text(doc.content, chunking) for doc in docs]
+    doc_chunks = [(doc, [_new_chunk(chunk) for chunk in texts]) for doc, texts in zip(docs, doc_texts)]
+    if not any(chunks for _, chunks in doc_chunks):
+        return 0
+
+    refs: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
+    deduplicated = 0
+    if dedup:
+        known = find_embeddings_by_hash(
+            docs[0].kb_uuid,
+            [item["dedup_hash"] for _, chunks in doc_chunks for item in chunks],
+            index=targets[0]["index"],
+        )
+        unique_chunks = []
+        for doc, chunks in doc_chunks:
+            fresh = []
+            for item in chunks:
+                owner = known.get(item["dedup_hash"])
+                if owner is None:
+                    known[item["dedup_hash"]] = {"_id": item["uuid"], "uuid": item["uuid"], "doc_uuid": doc.uuid}
+                    fresh.append(item)
+                    continue
+                deduplicated += 1
+                if owner["doc_uuid"] != doc.uuid:
+                    refs.append((owner, doc.uuid, item))
+            unique_chunks.append((doc, fresh))
+        doc_chunks = unique_chunks
+    items = [item for _, chunks in doc_chunks for item in chunks]
+
+    for position, target in enumerate(targets):
+        # new vectors are written with _id = uuid, pre-existing ones of the live index may not be
+        target_refs = [(owner["_id"] if position == 0 else owner["uuid"], doc_uuid) for owner, doc_uuid, _ in refs]
+        if items:
+            embeddings = _embed_texts([item["chunk"] for item in items], target)
+            offset = 0
+            for doc, chunks in doc_chunks:
+                if not chunks:
+                    continue
+                vectors = [
+                    _with_embedding(item, embedding)
+                    for item, embedding in zip(chunks, embeddings[offset:offset + len(chunks)])
+                ]
+                offset += len(chunks)
+                _store_doc_vectors(
+                    doc.kb_uuid, doc.uuid, vectors, target["index"], local=position == 0, bump=False
+                )
+        failed = set(add_embedding_refs(target_refs, index=target["index"]))
+        if not failed:
+            continue
+        # the referenced vector went away meanwhile: the doc gets its own copy, here and in later targets
+        print(f"[WARN] {len(failed)} deduplicated chunks could not reference their vector, embedding them")
+        lost = [ref for ref, target_ref in zip(refs, target_refs) if target_ref in failed]
+        refs = [ref for ref, target_ref in zip(refs, target_refs) if target_ref not in failed]
+        deduplicated -= len(lost)
+        for doc_uuid, copies in _group_copies(lost).items():
+            _add_doc_vectors(docs[0].kb_uuid, doc_uuid, copies, targets[position:], local=position == 0)
+    return deduplicated
+
+
+def _group_copies(refs: List[Tuple[Dict[str, Any], str, Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+    """fresh chunks per doc for refs that could not be added"""
+    copies: Dict[str, List[Dict[str, Any]]] = {}
+    for _, doc_uuid, item in refs:
+        copies.setdefault(doc_uuid, []).append(_new_chunk(item["chunk"]))
+    return copies
+
+
+def _add_doc_vectors(
+    kb_uuid: str, doc_uuid: str, chunks: List[Dict[str, Any]], targets: List[Dict[str, Any]], local: bool
+) -> None:
+    """embed chunks and add them to the vectors doc has in every target, keeping its other vectors"""
+    for position, target in enumerate(targets):
+        embeddings = _embed_texts([item["chunk"] for item in chunks], target)
+        added = [_with_embedding(item, embedding) for item, embedding in zip(chunks, embeddings)]
+        apply_doc_embedding_changes(kb_uuid, doc_uuid, added, [], index=target["index"], bump=False)
+        if local and position == 0:
+            for sink in _local_sinks:
+                sink.add(kb_uuid, doc_uuid, added)
+
+
+def _sync_doc_embeddings(doc: KnowledgeDocument, targets: List[Dict[str, Any]], chunking: ChunkingPolicy) -> None:
+    """
+    diff the stored chunks of doc against its new content:
+    only added/changed chunks are embedded, only stale vectors are deleted.
+    a re-embed target is then aligned to the live chunks by vector uuid.
+    """
+    live, *others = targets
+    current = _sync_doc_chunks(doc, live, chunking)
+    for target in others:
+        _mirror_doc_chunks(doc, current, target)
 
-def _generate_and_store_embeddings_for_doc(doc: KnowledgeDocument) -> None:
-    chunks = _chunk_text(doc.content)
-    if not chunks:
-        return
 
-    vectors: List[Dict[str, Any]] = []
+def _sync_doc_chunks(
+    doc: KnowledgeDocument, target: Dict[str, Any], chunking: ChunkingPolicy
+) -> List[Dict[str, Any]]:
+    """incremental update of the live index, returns the chunks the doc has afterwards"""
+    chunks = chunk_text(doc.content, chunking)
+    existing = list_doc_chunks(doc.uuid, index=target["index"])
+    # own chunks match by exact hash only, a case or whitespace edit must replace the
+    # stored text; the normalized hash matches the deduplicated chunks of other docs
+    by_hash: Dict[str, List[Dict[str, Any]]] = {}
+    by_dedup_hash: Dict[str, List[Dict[str, Any]]] = {}
+    for item in existing:
+        by_hash.setdefault(item.get("chunk_hash") or text_hash(item.get("chunk", "")), []).append(item)
+        if item.get("doc_uuid", doc.uuid) != doc.uuid and item.get("dedup_hash"):
+            by_dedup_hash.setdefault(item["dedup_hash"], []).append(item)
+
+    used = set()
+    current: List[Dict[str, Any]] = []
+    added_chunks: List[Dict[str, Any]] = []
     for chunk in chunks:
-        embedding = create_embeddings(chunk)
-        vectors.append(
-            {
-                "uuid": str(uuid.uuid4()),
-                "chunk": chunk,
-                "embedding": embedding,
-                "create_at": _now_ms(),
-            }
+        kept = next(
+            (
+                item
+                for key, index in ((text_hash(chunk), by_hash), (_dedup_hash(chunk), by_dedup_hash))
+                for item in index.get(key, [])
+                if item["_id"] not in used
+            ),
+            None,
         )
-    upsert_doc_embeddings(doc.kb_uuid, doc.uuid, vectors)
+        if kept is not None:
+            used.add(kept["_id"])
+            current.append(kept)
+            continue
+        added_chunks.append(_new_chunk(chunk))
+    stale = [item for item in existing if item["_id"] not in used]
+    current.extend(added_chunks)
+    if not added_chunks and not stale:
+        return current
+
+    # stale chunks the doc only references stay with their owner; owned ones that other
+    # docs reference move to one of them (see apply_doc_embedding_changes)
+    owned_stale = [item for item in stale if item.get("doc_uuid", doc.uuid) == doc.uuid]
+    shared: List[Dict[str, Any]] = []
+    if _local_sinks and any(item.get("ref_doc_uuids") for item in owned_stale):
+        stale_uuids = {item.get("uuid") for item in owned_stale}
+        shared = [
+            item
+            for item in list_shared_embeddings([doc.uuid], index=target["index"])
+            if item["uuid"] in stale_uuids
+        ]
 
+    embeddings = _embed_texts([item["chunk"] for item in added_chunks], target)
+    added = [_with_embedding(item, embedding) for item, embedding in zip(added_chunks, embeddings)]
+    apply_doc_embedding_changes(
+        doc.kb_uuid, doc.uuid, added, [item["_id"] for item in stale], index=target["index"]
+    )
+    for sink in _local_sinks:
+        sink.remove(
+            doc.kb_uuid,
+            [item["uuid"] for item in owned_stale if item.get("uuid") and not item.get("ref_doc_uuids")],
+        )
+        sink.add(doc.kb_uuid, doc.uuid, added)
+    _rehome_shared_locally(doc.kb_uuid, shared, {doc.uuid})
+    return current
+
+
+def _mirror_doc_chunks(doc: KnowledgeDocument, current: List[Dict[str, Any]], target: Dict[str, Any]) -> None:
+    """make the vectors of doc in target match current (by uuid), embedding only what is missing"""
+    existing = {item.get("uuid"): item for item in list_doc_chunks(doc.uuid, index=target["index"])}
+    wanted = {item.get("uuid") for item in current}
+    missing = [item for item in current if item.get("uuid") not in existing]
+    stale = [item["_id"] for vector_uuid, item in existing.items() if vector_uuid not in wanted]
+    # deduplicated chunks owned by another doc are referenced, not copied
+    referenced = [item for item in missing if item.get("doc_uuid", doc.uuid) != doc.uuid]
+    failed = set(add_embedding_refs([(item["uuid"], doc.uuid) for item in referenced], index=target["index"]))
+    missing = [item for item in missing if item.get("doc_uuid", doc.uuid) == doc.uuid]
+    # a vector the doc could not reference is copied under a new uuid, the next sync retries the reference
+    copies = [_new_chunk(item["chunk"]) for item in referenced if (item["uuid"], doc.uuid) in failed]
+    if not missing and not stale and not copies:
+        return
+    embeddings = _embed_texts([item["chunk"] for item in missing + copies], target)
+    added = [
+        _with_embedding({**_new_chunk(item["chunk"]), "uuid": item["uuid"]}, embedding)
+        for item, embedding in zip(missing + copies, embeddings)
+    ]
+    apply_doc_embedding_changes(doc.kb_uuid, doc.uuid, added, stale, index=target["index"])
 
-def qa_service(owner_uuid: str, kb_uuid: str, question: str, top_k: int = 3) -> Optional[KnowledgeQAReply]:
-    if not _get_owned_kb(kb_uuid, owner_uuid):
+
+def _store_doc_vectors(
+    kb_uuid: str,
+    doc_uuid: str,
+    vectors: List[Dict[str, Any]],
+    embed_index: str = KB_DOC_EMBED_INDEX,
+    local: bool = True,
+    bump: bool = True,
+) -> None:
+    """replace the vectors of doc in ES and, for the live index, in the local copies of its kb"""
+    upsert_doc_embeddings(kb_uuid, doc_uuid, vectors, index=embed_index, bump=bump)
+    if not local:
+        return
+    for sink in _local_sinks:
+        sink.add(kb_uuid, doc_uuid, vectors, replace_doc=True)
+
+
+def _rehome_shared_locally(kb_uuid: str, shared: List[Dict[str, Any]], gone_docs: set) -> None:
+    """
+    local copies follow the ES hand-over of shared vectors: a vector released by gone_docs
+    moves to the first doc still referencing it.
+    """
+    for item in shared:
+        refs = [doc_uuid for doc_uuid in item.get("ref_doc_uuids") or [] if doc_uuid not in gone_docs]
+        if not refs:
+            continue
+        for sink in _local_sinks:
+            sink.remove(kb_uuid, [item["uuid"]])
+            sink.add(kb_uuid, refs[0], [item])
+
+
+def _dedup_hash(chunk: str) -> str:
+    """hash of the whitespace- and case-normalized chunk, equal for boilerplate repeats"""
+    return text_hash(" ".join(chunk.split()).casefold())
+
+
+def _new_chunk(chunk: str) -> Dict[str, Any]:
+    return {
+        "uuid": str(uuid.uuid4()),
+        "chunk": chunk,
+        "chunk_hash": text_hash(chunk),
+        "dedup_hash": _dedup_hash(chunk),
+        "create_at": _now_ms(),
+    }
+
+
+def _with_embedding(item: Dict[str, Any], embedding: List[float]) -> Dict[str, Any]:
+    """vectors are stored L2-normalized so similarity is a plain dot product"""
+    return {**item, "embedding": unit_vector(embedding)}
+
+
+async def qa_service(owner_uuid: str, kb_uuid: str, question: str, top_k: int = 3) -> Optional[KnowledgeQAReply]:
+    timer = StageTimer()
+    # ownership check and question embedding are independent round trips
+    kb, question_vector = await _get_owned_kb_and_query_vector(kb_uuid, owner_uuid, question, timer)
+    if not kb:
         return None
 
-    context_chunks = _retrieve_context_chunks(kb_uuid, question, top_k)
-    messages = _build_messages_with_context(question, context_chunks)
-    answer = chat_completion(messages)
+    # identical questions arriving together share one retrieval + completion
+    reply = await qa_flights.do(
+        (kb_uuid, _normalize_query(question), top_k),
+        lambda: _answer_question(kb, question, question_vector, top_k),
+    )
+    timings = {**timer.timings, **(reply.timings or {})}
+    timings["total"] = timer.finish()["total"]
+    return reply.copy(update={"timings": timings})
+
+
+async def _answer_question(
+    kb: KnowledgeBase, question: str, question_vector: List[float], top_k: int
+) -> KnowledgeQAReply:
+    timer = StageTimer()
+    kb_uuid = kb.uuid
+    if kb.answer_cache_enabled:
+        threshold = ANSWER_CACHE_THRESHOLD if kb.answer_cache_threshold is None else kb.answer_cache_threshold
+        cached = answer_cache.lookup(
+            kb_uuid, kb.content_update_at, top_k, question_vector, threshold
+        )
+        if cached:
+            return KnowledgeQAReply(answer=cached["answer"], context=cached["context"], prompt_tokens=0)
+
+    context_chunks = await timer.run(
+        "search",
+        _retrieve_context_chunks(
+            kb_uuid, question, top_k, query_vector=question_vector, embedding=_kb_embedding(kb), kb=kb
+        ),
+    )
+    messages, context_chunks = _build_messages_with_context(question, context_chunks)
+    prompt_tokens = count_message_tokens(messages)
+    answer = await timer.run("completion", achat_completion(messages))
 
-    # write current Q&A into kb, and generate vector for the answer
-    save_qa_to_kb(kb_uuid, question, answer)
+    # write current Q&A into kb in the background, and generate vector for the answer
+    await timer.run("writeback", asyncio.to_thread(enqueue_save_qa, kb_uuid, question, answer))
 
     context_texts = [item["chunk"] for item in context_chunks]
-    return KnowledgeQAReply(answer=answer, context=context_texts)
+    # right after a doc change the retrieval may still miss it (ES refresh), an answer
+    # cached now would be kept under the new content stamp
+    if kb.answer_cache_enabled and not _content_settling(kb):
+        answer_cache.store(
+            kb_uuid, kb.content_update_at, top_k, question_vector, answer, context_texts
+        )
+    return KnowledgeQAReply(
+        answer=answer, context=context_texts, prompt_tokens=prompt_tokens, timings=timer.timings
+    )
 
 
-def save_qa_to_kb(kb_uuid: str, question: str, answer: str) -> None:
+def save_qa_to_kb(
+    kb_uuid: str,
+    question: str,
+    answer: str,
+    doc_uuid: Optional[str] = None,
+    create_at: Optional[int] = None,
+) -> None:
     """
-    write current Q&A into kb, and generate vector for the answer
+    write current Q&A into kb, and generate vector for the answer.
+    with a fixed doc_uuid the call is safe to retry: the doc is only created once.
     """
     doc = KnowledgeDocument(
-        uuid=str(uuid.uuid4()),
+        uuid=doc_uuid or str(uuid.uuid4()),
         kb_uuid=kb_uuid,
         title=question[:50],
         content=f"Q: {question}\n\nA: {answer}",
-        create_at=_now_ms(),
-        update_at=_now_ms(),
+        create_at=create_at or _now_ms(),
+        update_at=create_at or _now_ms(),
+        source="qa",
     )
-    create_doc(doc.dict())
+    kb_data = get_kb(kb_uuid)
+    if not kb_data:
+        print(f"[WARN] kb {kb_uuid} no longer exists, qa not saved")
+        return
+    # the doc uuid is its ES id: a retry finds the doc created and only rewrites the vector
+    create_doc_once(doc.dict(), bump=False)
 
-    # only generate embedding for the answer text
-    embedding = create_embeddings(answer)
-    upsert_doc_embeddings(
-        kb_uuid,
-        doc.uuid,
-        [
-            {
-                "uuid": str(uuid.uuid4()),
-                "chunk": answer,
-                "embedding": embedding,
-                "create_at": _now_ms(),
-            }
-        ],
+    # only generate embedding for the answer text; one generation bump for the doc and its vectors
+    item = _new_chunk(answer)
+    try:
+        for position, target in enumerate(_write_targets(KnowledgeBase(**kb_data))):
+            embedding = _embed_texts([answer], target)[0]
+            _store_doc_vectors(
+                kb_uuid,
+                doc.uuid,
+                [_with_embedding(item, embedding)],
+                target["index"],
+                local=position == 0,
+                bump=False,
+            )
+    finally:
+        bump_kb_generation(kb_uuid)
+
+
+def _persist_qa_job(payload: Dict[str, Any]) -> None:
+    save_qa_to_kb(
+        payload["kb_uuid"],
+        payload["question"],
+        payload["answer"],
+        doc_uuid=payload["doc_uuid"],
+        create_at=payload["create_at"],
     )
 
 
-def semantic_search_service(owner_uuid: str, kb_uuid: str, query: str, top_k: int = 5) -> Optional[List[Dict[str, Any]]]:
+def get_qa_writeback() -> WriteBackQueue:
+    """get the qa write-back queue (singleton pattern)"""
+    global _qa_writeback
+    if _qa_writeback is None:
+        _qa_writeback = WriteBackQueue(
+            "qa",
+            _persist_qa_job,
+            spool_path=WRITEBACK_SPOOL_PATH,
+            capacity=WRITEBACK_CAPACITY,
+            workers=WRITEBACK_WORKERS,
+            max_attempts=WRITEBACK_MAX_ATTEMPTS,
+        )
+    return _qa_writeback
+
+
+def enqueue_save_qa(kb_uuid: str, question: str, answer: str) -> None:
+    """
+    persist the Q&A off the request path; when the write-back queue is full
+    the caller pays for the write itself instead of dropping it.
+    """
+    payload = {
+        "kb_uuid": kb_uuid,
+        "question": question,
+        "answer": answer,
+        "doc_uuid": str(uuid.uuid4()),
+        "create_at": _now_ms(),
+    }
+    if not get_qa_writeback().submit(payload):
+        print("[WARN] qa write-back queue is full, saving inline")
+        _persist_qa_job(payload)
+
+
+async def semantic_search_service(owner_uuid: str, kb_uuid: str, query: str, top_k: int = 5) -> Optional[List[Dict[str, Any]]]:
     """
     do vector semantic search for the specified kb:
     - generate embedding for the query
-    - fetch all vectors under the kb from kb_doc_embed_index
-    - calculate cosine similarity, return top_k chunks + scores
+    - search the kb vectors with the configured retrieval engine (ES or local index)
+    - return top_k chunks + cosine scores
     """
-    if not _get_owned_kb(kb_uuid, owner_uuid):
+    kb, query_vector = await _get_owned_kb_and_query_vector(kb_uuid, owner_uuid, query)
+    if not kb:
         return None
 
-    query_vector = create_embeddings(query)
+    cache_key = _retrieval_key("semantic", kb, query, top_k)
+    cached = _cached_retrieval(cache_key)
+    if cached is not None:
+        return cached
+
+    embed_index = _kb_embedding(kb)["index"]
     results: List[Dict[str, Any]] = []
     try:
-        results = search_doc_embeddings_by_vector(kb_uuid, query_vector, top_k)
+        results = await asyncio.to_thread(
+            _search_vectors, kb_uuid, query_vector, top_k, embed_index, _retrieval_generation(kb)
+        )
     except Exception as exc:  # pylint: disable=broad-except
         print(f"[WARN] ES vector search failed, falling back to local scoring: {exc}")
-        vectors = list_doc_embeddings(kb_uuid)
-        results = _score_vectors_locally(
-            vectors,
+        results = await asyncio.to_thread(
+            _score_vectors_locally,
+            kb_uuid,
             query_vector,
             top_k=top_k,
             score_threshold=0.0,
+            embed_index=embed_index,
+            generation=_retrieval_generation(kb),
         )
 
     formatted: List[Dict[str, Any]] = []
@@ -305,9 +1309,28 @@ def semantic_search_service(owner_uuid: str, kb_uuid: str, query: str, top_k: in
                 "score": item.get("score", 0.0),
             }
         )
+    _store_retrieval(cache_key, formatted)
     return formatted
 
 
+async def hybrid_search_service(
+    owner_uuid: str, kb_uuid: str, query: str, top_k: int = 5
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    keyword + vector search over kb chunks in one ES round trip, merged by reciprocal rank fusion.
+    """
+    kb, query_vector = await _get_owned_kb_and_query_vector(kb_uuid, owner_uuid, query)
+    if not kb:
+        return None
+    cache_key = _retrieval_key("hybrid", kb, query, top_k)
+    cached = _cached_retrieval(cache_key)
+    if cached is not None:
+        return cached
+    results = await _hybrid_retrieve(kb_uuid, query, query_vector, top_k, embed_index=_kb_embedding(kb)["index"])
+    _store_retrieval(cache_key, results)
+    return results
+
+
 def fulltext_search_service(
     owner_uuid: str,
     kb_uuid: str,
@@ -317,9 +1340,16 @@ def fulltext_search_service(
     """
     Keyword-based full-text search with ES highlighting.
     """
-    if not _get_owned_kb(kb_uuid, owner_uuid):
+    kb = _get_owned_kb(kb_uuid, owner_uuid)
+    if not kb:
         return None
-    return search_docs_fulltext(kb_uuid, query, top_k)
+    cache_key = _retrieval_key("fulltext", kb, query, top_k)
+    cached = _cached_retrieval(cache_key)
+    if cached is not None:
+        return cached
+    results = search_docs_fulltext(kb_uuid, query, top_k)
+    _store_retrieval(cache_key, results)
+    return results
 
 
 def import_kb_file_service(
@@ -332,17 +1362,26 @@ def import_kb_file_service(
     Parse uploaded file(s) and insert docs into KB.
     Supports markdown/txt/csv/docx/pptx/pdf.
     """
-    if not _get_owned_kb(kb_uuid, owner_uuid):
+    kb = _get_owned_kb(kb_uuid, owner_uuid)
+    if not kb:
         return None
+    targets = _write_targets(kb)
+    chunking = _chunking_policy(kb)
 
     docs = _extract_docs_from_upload(filename, file_bytes)
     summary = {
         "total": len(docs),
         "success": 0,
         "failed": 0,
+        "deduplicated": 0,  # chunks that reuse an existing vector of the kb
         "errors": [],
     }
 
+    # docs are created one by one, but their chunks are embedded in shared
+    # batches so a large import costs one request per batch, not per chunk
+    pending: List[KnowledgeDocument] = []
+    pending_texts: List[List[str]] = []  # chunks of the pending docs, embedded as they are
+    pending_chunks = 0
     for idx, payload in enumerate(docs, start=1):
         title = (payload.get("title") or f"Imported {idx}").strip()
         content = (payload.get("content") or "").strip()
@@ -351,106 +1390,303 @@ def import_kb_file_service(
             if len(summary["errors"]) < 20:
                 summary["errors"].append(f"{title or 'Document'} has empty content, skipped")
             continue
+        doc = KnowledgeDocument(
+            uuid=str(uuid.uuid4()),
+            kb_uuid=kb_uuid,
+            title=title or f"Imported {idx}",
+            content=content,
+            create_at=_now_ms(),
+            update_at=_now_ms(),
+        )
         try:
-            create_doc_service(
-                owner_uuid,
-                kb_uuid,
-                KnowledgeDocumentCreate(title=title or f"Imported {idx}", content=content),
-            )
-            summary["success"] += 1
+            # the generation is bumped once per batch, when its vectors are written
+            create_doc(doc.dict(), bump=False)
         except Exception as exc:  # pylint: disable=broad-except
             summary["failed"] += 1
             if len(summary["errors"]) < 20:
                 summary["errors"].append(f"{title[:50] or 'Document'}: {exc}")
+            continue
+        pending.append(doc)
+        pending_texts.append(chunk_text(content, chunking))
+        pending_chunks += len(pending_texts[-1])
+        if pending_chunks >= EMBEDDING_BATCH_MAX_INPUTS:
+            _flush_import_batch(pending, pending_texts, targets, chunking, summary)
+            pending, pending_texts = [], []
+            pending_chunks = 0
+
+    if pending:
+        _flush_import_batch(pending, pending_texts, targets, chunking, summary)
+    if summary["success"]:
+        _touch_kb_content(kb_uuid)
 
     return summary
 
 
-def _retrieve_context_chunks(
+def _flush_import_batch(
+    docs: List[KnowledgeDocument],
+    doc_texts: List[List[str]],
+    targets: List[Dict[str, Any]],
+    chunking: ChunkingPolicy,
+    summary: Dict[str, Any],
+) -> None:
+    try:
+        summary["deduplicated"] += _generate_and_store_embeddings_for_docs(
+            docs, targets, chunking, doc_texts=doc_texts
+        )
+        summary["success"] += len(docs)
+    except Exception as exc:  # pylint: disable=broad-except
+        summary["failed"] += len(docs)
+        if len(summary["errors"]) < 20:
+            summary["errors"].append(f"{len(docs)} documents failed to embed: {exc}")
+
+
+async def _retrieve_context_chunks(
     kb_uuid: str,
     question: str,
     top_k: int = 3,
     score_threshold: float = 0.2,
+    query_vector: Optional[List[float]] = None,
+    mode: str = QA_RETRIEVAL_MODE,
+    embedding: Optional[Dict[str, Any]] = None,
+    kb: Optional[KnowledgeBase] = None,
 ) -> List[Dict[str, Any]]:
     """
     Retrieve top_k most relevant chunks from KB embeddings.
+    mode="hybrid" fuses vector and keyword hits, see _hybrid_retrieve.
+    embedding is the kb's {"model", "dims", "index"}, None = the ada-002 default index.
+    results are cached per kb generation when the kb is given.
     Falls back gracefully if no embeddings exist or ES vector search fails.
     """
-    query_vector = create_embeddings(question)
+    cache_key = _retrieval_key("context", kb, question, top_k, score_threshold, mode)
+    cached = _cached_retrieval(cache_key)
+    if cached is not None:
+        return cached
+
+    embedding = embedding or _embedding_spec(DEFAULT_EMBEDDING_MODEL)
+    if query_vector is None:
+        query_vector = await _embed_query(question, embedding["model"], embedding["dims"])
     scored: List[Dict[str, Any]] = []
 
+    if mode == "hybrid":
+        try:
+            scored = await _hybrid_retrieve(
+                kb_uuid, question, query_vector, top_k, score_threshold, embedding["index"]
+            )
+            _store_retrieval(cache_key, scored)
+            return scored
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] ES hybrid search failed, falling back to vector search: {exc}")
+
     try:
         scored = [
             item
-            for item in search_doc_embeddings_by_vector(
+            for item in await asyncio.to_thread(
+                _search_vectors,
                 kb_uuid,
                 query_vector,
                 top_k=max(top_k, 5),
+                embed_index=embedding["index"],
+                generation=_retrieval_generation(kb) if kb else None,
             )
             if item.get("score", 0.0) >= score_threshold
         ]
     except Exception as exc:  # pylint: disable=broad-except
         print(f"[WARN] ES vector search failed, fallback to local scoring: {exc}")
-        vectors = list_doc_embeddings(kb_uuid)
-        scored = _score_vectors_locally(
-            vectors,
+        scored = await asyncio.to_thread(
+            _score_vectors_locally,
+            kb_uuid,
             query_vector,
             top_k=max(top_k, 5),
             score_threshold=score_threshold,
+            embed_index=embedding["index"],
+            generation=_retrieval_generation(kb) if kb else None,
         )
 
+    _store_retrieval(cache_key, scored[:top_k])
     return scored[:top_k]
 
 
+async def _hybrid_retrieve(
+    kb_uuid: str,
+    query: str,
+    query_vector: List[float],
+    top_k: int,
+    score_threshold: float = 0.0,
+    embed_index: str = KB_DOC_EMBED_INDEX,
+) -> List[Dict[str, Any]]:
+    """
+    vector + BM25 chunk retrieval in one ES msearch, fused by reciprocal rank.
+    vector hits below score_threshold do not take part in the fusion.
+    """
+    vector_hits, text_hits = await asyncio.to_thread(
+        search_chunks_hybrid, kb_uuid, query, query_vector, max(HYBRID_CANDIDATES, top_k), embed_index
+    )
+    vector_hits = [item for item in vector_hits if item.get("score", 0.0) >= score_threshold]
+    return _reciprocal_rank_fusion(vector_hits, text_hits)[:top_k]
+
+
+def _reciprocal_rank_fusion(
+    vector_hits: List[Dict[str, Any]], text_hits: List[Dict[str, Any]], k: int = HYBRID_RRF_K
+) -> List[Dict[str, Any]]:
+    """
+    merge two ranked chunk lists by sum(1 / (k + rank)). score is rescaled so a
+    chunk ranked first in both lists gets 1.0; the original scores are kept
+    as vector_score / text_score.
+    """
+    fused: Dict[str, Dict[str, Any]] = {}
+    for field, hits in (("vector_score", vector_hits), ("text_score", text_hits)):
+        for rank, item in enumerate(hits, start=1):
+            key = item.get("uuid") or item.get("chunk", "")
+            entry = fused.setdefault(
+                key,
+                {
+                    "kb_uuid": item.get("kb_uuid"),
+                    "doc_uuid": item.get("doc_uuid"),
+                    "chunk": item.get("chunk", ""),
+                    "rrf": 0.0,
+                    "vector_score": None,
+                    "text_score": None,
+                },
+            )
+            entry["rrf"] += 1.0 / (k + rank)
+            entry[field] = item.get("score", 0.0)
+    best = 2.0 / (k + 1)
+    results = sorted(fused.values(), key=lambda x: x["rrf"], reverse=True)
+    for entry in results:
+        entry["score"] = entry.pop("rrf") / best
+    return results
+
+
+def _search_vectors(
+    kb_uuid: str,
+    query_vector: List[float],
+    top_k: int,
+    embed_index: str = KB_DOC_EMBED_INDEX,
+    generation: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    top_k chunks by cosine score from the configured retrieval engine.
+    RETRIEVAL_ENGINE=local/exact answers from the in-process HNSW/exact index of the kb,
+    validated against generation (see _retrieval_generation),
+    ES stays the fallback when hnswlib is missing, the local index fails or is not
+    current yet (it is refreshed in the background then).
+    """
+    if _local_engine:
+        try:
+            hits = _local_engine.search(kb_uuid, query_vector, top_k, embed_index, generation)
+            if hits is not None:
+                return hits
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] local vector index failed, falling back to ES: {exc}")
+    return search_doc_embeddings_by_vector(kb_uuid, query_vector, top_k, index=embed_index)
+
+
 def _build_messages_with_context(
-    question: str, context_chunks: List[Dict[str, Any]]
-) -> List[Dict[str, str]]:
+    question: str,
+    context_chunks: List[Dict[str, Any]],
+    token_budget: int = QA_PROMPT_TOKEN_BUDGET,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
     """
     Construct system/user messages. Encourage the model to use KB context when available.
+    Context chunks are packed by score under token_budget: a chunk that does not fit
+    is truncated when enough budget is left, otherwise dropped.
+    Returns the messages and the chunks that made it into the prompt.
     """
     base_instruction = (
         "You are a helpful assistant. Use the provided knowledge base snippets when they are relevant. "
         "If the context does not contain sufficient information, clearly state that you are not sure "
         "instead of fabricating details."
     )
+    context_header = "Knowledge base context:\n"
 
     messages: List[Dict[str, str]] = [{"role": "system", "content": base_instruction}]
+    remaining = token_budget - count_message_tokens(
+        messages + [{"role": "system", "content": context_header}, {"role": "user", "content": question}]
+    )
+
+    packed: List[Dict[str, Any]] = []
+    for item in sorted(context_chunks, key=lambda x: x.get("score", 0.0), reverse=True):
+        prefix = f"[Score {item['score']:.2f}] "
+        # +1 for the blank line joining snippets
+        cost = count_tokens(prefix + item["chunk"]) + 1
+        if cost <= remaining:
+            packed.append(item)
+            remaining -= cost
+            continue
+        room = remaining - count_tokens(prefix) - 1
+        if room >= MIN_TRUNCATED_CHUNK_TOKENS:
+            packed.append({**item, "chunk": truncate_to_tokens(item["chunk"], room)})
+            remaining = 0
 
-    if context_chunks:
+    if packed:
         context_text = "\n\n".join(
-            f"[Score {item['score']:.2f}] {item['chunk']}" for item in context_chunks
+            f"[Score {item['score']:.2f}] {item['chunk']}" for item in packed
         )
-        messages.append({"role": "system", "content": f"Knowledge base context:\n{context_text}"})
+        messages.append({"role": "system", "content": f"{context_header}{context_text}"})
 
     messages.append({"role": "user", "content": question})
-    return messages
+    return messages, packed
+
+
+def normalize_stored_embeddings() -> Dict[str, int]:
+    """one-off migration: L2-normalize every vector written before write-time normalization"""
+
+    def transform(embedding: List[float]) -> Optional[List[float]]:
+        norm = math.sqrt(sum(x * x for x in embedding))
+        if norm == 0 or abs(norm - 1.0) < 1e-4:
+            return None
+        return unit_vector(embedding)
+
+    return rewrite_embeddings(transform)
+
+
+def check_vector_similarity(sample_size: int = 200) -> int:
+    """
+    with VECTOR_SIMILARITY=dot_product, count the unnormalized vectors among the oldest
+    stored ones and warn: dot_product ranks them wrong until normalize-embeddings ran
+    """
+    if VECTOR_SIMILARITY != "dot_product":
+        return 0
+    unnormalized = sum(
+        1 for embedding in sample_embeddings(sample_size) if abs(math.sqrt(sum(x * x for x in embedding)) - 1.0) >= 1e-3
+    )
+    if unnormalized:
+        print(
+            f"[WARN] VECTOR_SIMILARITY=dot_product but {unnormalized} of the oldest stored vectors are not "
+            "unit length, run manage.py normalize-embeddings or use VECTOR_SIMILARITY=cosine"
+        )
+    return unnormalized
 
 
 def _score_vectors_locally(
-    vectors: List[Dict[str, Any]],
+    kb_uuid: str,
     query_vector: List[float],
     top_k: int,
     score_threshold: float,
+    embed_index: str = KB_DOC_EMBED_INDEX,
+    generation: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
-    """Fallback cosine scoring executed in Python."""
-    scored: List[Dict[str, Any]] = []
-    for item in vectors:
-        emb = item.get("embedding") or []
-        if not emb:
-            continue
-        score = _cosine_similarity(query_vector, emb)
-        if score < score_threshold:
-            continue
-        scored.append(
-            {
-                "kb_uuid": item.get("kb_uuid"),
-                "doc_uuid": item.get("doc_uuid"),
-                "chunk": item.get("chunk", ""),
-                "score": score,
-            }
-        )
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:top_k]
+    """
+    Fallback exact cosine scoring over every vector of the kb, vectorized with numpy.
+    reads the mmap vector store when enabled (validated against generation),
+    otherwise streams the vectors from ES.
+    """
+    store = get_vector_store()
+    if store is not None and store.ensure(kb_uuid, embed_index, len(query_vector), generation):
+        return store.search(kb_uuid, query_vector, top_k, score_threshold)
+    matrix, items = load_kb_vectors(kb_uuid, embed_index)
+    # vectors of another dimension (another embedding model) cannot be compared
+    if not items or matrix.shape[1] != len(query_vector):
+        return []
+    return [
+        {
+            "kb_uuid": kb_uuid,
+            "doc_uuid": items[row]["doc_uuid"],
+            "chunk": items[row]["chunk"],
+            "score": score,
+        }
+        for row, score in cosine_top_k(matrix, query_vector, top_k, score_threshold)
+    ]
 
 
 def export_kb_service(owner_uuid: str, kb_uuid: str) -> Optional[Dict[str, Any]]:
@@ -462,28 +1698,23 @@ def export_kb_service(owner_uuid: str, kb_uuid: str) -> Optional[Dict[str, Any]]
         return None
 
     kb_data = kb.dict()
+    embedding = _kb_embedding(kb)
     docs = _fetch_all_docs(kb_uuid)
-    embeddings = list_doc_embeddings(kb_uuid)
-
-    bundle = {
-        "kb": kb_data,
-        "documents": docs,
-        "embeddings": embeddings,
-        "exported_at": _now_ms(),
-    }
+    exported_at = _now_ms()
 
+    # embeddings are streamed from the vector store or ES straight into the archive,
+    # once for embeddings.json and once for bundle.json
     memory_file = io.BytesIO()
     with zipfile.ZipFile(memory_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
         zf.writestr("kb.json", json.dumps(kb_data, ensure_ascii=False, indent=2))
         zf.writestr("docs.json", json.dumps(docs, ensure_ascii=False))
-        zf.writestr(
-            "embeddings.json",
-            json.dumps(embeddings, ensure_ascii=False),
-        )
-        zf.writestr(
-            "bundle.json",
-            json.dumps(bundle, ensure_ascii=False),
-        )
+        with zf.open("embeddings.json", "w") as fp:
+            _write_json_array(fp, _iter_export_embeddings(kb, embedding))
+        with zf.open("bundle.json", "w") as fp:
+            head = json.dumps({"kb": kb_data, "documents": docs}, ensure_ascii=False)
+            fp.write(f'{head[:-1]}, "embeddings": '.encode("utf-8"))
+            _write_json_array(fp, _iter_export_embeddings(kb, embedding))
+            fp.write(f', "exported_at": {exported_at}}}'.encode("utf-8"))
 
     memory_file.seek(0)
     safe_name = re.sub(r"[^a-zA-Z0-9_-]", "-", kb_data.get("name", "kb"))
@@ -491,6 +1722,22 @@ def export_kb_service(owner_uuid: str, kb_uuid: str) -> Optional[Dict[str, Any]]
     return {"filename": filename, "content": memory_file.read()}
 
 
+def _iter_export_embeddings(kb: KnowledgeBase, embedding: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    store = get_vector_store()
+    if store is not None and store.ensure(kb.uuid, embedding["index"], embedding["dims"], _retrieval_generation(kb)):
+        return store.iter_vectors(kb.uuid)
+    return iter_doc_embeddings(kb.uuid, index=embedding["index"])
+
+
+def _write_json_array(fp: Any, items: Iterator[Dict[str, Any]]) -> None:
+    fp.write(b"[")
+    for idx, item in enumerate(items):
+        if idx:
+            fp.write(b", ")
+        fp.write(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+    fp.write(b"]")
+
+
 def _fetch_all_docs(kb_uuid: str, page_size: int = 200) -> List[Dict[str, Any]]:
     docs: List[Dict[str, Any]] = []
     page = 1
@@ -0,0 +1,610 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional dependency, RETRIEVAL_ENGINE=local needs it
+    hnswlib = None
+
+from dao.kb_dao import (
+    count_doc_embeddings,
+    embedding_delta,
+    embedding_fingerprint,
+    embedding_uuid_hash,
+    iter_doc_embeddings,
+)
+from models.kb import KB_DOC_EMBED_INDEX
+from service.vector_ops import cosine_top_k, normalize_rows
+from define import (
+    RETRIEVAL_ENGINE,
+    LOCAL_INDEX_DIR,
+    LOCAL_INDEX_M,
+    LOCAL_INDEX_EF_CONSTRUCTION,
+    LOCAL_INDEX_EF_SEARCH,
+    LOCAL_COPY_DELTA_SLACK_MS,
+    LOCAL_COPY_VERIFY_SECONDS,
+)
+
+_INITIAL_CAPACITY = 1024
+_VECTOR_FIELDS = ["uuid", "doc_uuid", "chunk", "embedding"]
+
+
+def load_kb_vectors(kb_uuid: str, index: str = KB_DOC_EMBED_INDEX) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """
+    stream the vectors of a kb into one preallocated float32 matrix and
+    normalize its rows in place. returns the matrix and the chunk metadata
+    (uuid, doc_uuid, chunk) of every row.
+    """
+    expected = count_doc_embeddings(kb_uuid, index=index)
+    matrix: Optional[np.ndarray] = None
+    items: List[Dict[str, Any]] = []
+    for item in iter_doc_embeddings(kb_uuid, source_includes=_VECTOR_FIELDS, index=index):
+        embedding = item.pop("embedding", None)
+        if not embedding:
+            continue
+        if matrix is None:
+            matrix = np.empty((max(expected, 1), len(embedding)), dtype=np.float32)
+        if len(embedding) != matrix.shape[1]:
+            continue
+        if len(items) == matrix.shape[0]:
+            # the kb grew after it was counted
+            matrix = np.concatenate([matrix, np.empty_like(matrix)])
+        matrix[len(items)] = embedding
+        items.append({"uuid": item.get("uuid", ""), "doc_uuid": item.get("doc_uuid"), "chunk": item.get("chunk", "")})
+    if matrix is None:
+        return np.zeros((0, 0), dtype=np.float32), []
+    return normalize_rows(matrix[:len(items)], inplace=True), items
+
+
+class LocalVectorIndex:
+    """
+    in-process HNSW index over the vectors of one kb.
+    hnswlib labels are ints, the chunk payload of every label is kept alongside
+    so a query never goes back to ES. removed vectors are only marked deleted,
+    their slots are reused by later inserts.
+    """
+
+    FILE_SUFFIXES = (".bin", ".json")
+
+    @staticmethod
+    def available() -> bool:
+        return hnswlib is not None
+
+    def __init__(self, kb_uuid: str, dim: int, path: Optional[str] = None):
+        self.kb_uuid = kb_uuid
+        self.dim = dim
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        if path:
+            self._index.load_index(path, allow_replace_deleted=True)
+        else:
+            self._index.init_index(
+                max_elements=_INITIAL_CAPACITY,
+                ef_construction=LOCAL_INDEX_EF_CONSTRUCTION,
+                M=LOCAL_INDEX_M,
+                allow_replace_deleted=True,
+            )
+        self._items: Dict[int, Dict[str, Any]] = {}
+        self._labels_by_uuid: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._next_label = 0
+        self._uuid_hash = 0  # running sum of embedding_uuid_hash, see fingerprint()
+        self._lock = threading.RLock()
+        self.dirty = False
+        self.generation: Optional[int] = None  # kb generation the content was last validated at
+        self.synced_at: Optional[int] = None  # ms, every vector created before it is in the index
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def fingerprint(self) -> Tuple[int, int]:
+        """same (count, uuid hash sum) as embedding_fingerprint computes in ES"""
+        with self._lock:
+            return len(self._items), self._uuid_hash
+
+    def add(self, doc_uuid: str, vectors: List[Dict[str, Any]]) -> None:
+        """vectors are the dicts written to kb_doc_embed_index (uuid, chunk, embedding)"""
+        vectors = [item for item in vectors if item.get("embedding")]
+        if not vectors:
+            return
+        with self._lock:
+            self.remove([item["uuid"] for item in vectors])
+            labels: List[int] = []
+            for _ in vectors:
+                if self._free:
+                    labels.append(self._free.pop())
+                else:
+                    labels.append(self._next_label)
+                    self._next_label += 1
+            capacity = self._index.get_max_elements()
+            if self._next_label > capacity:
+                self._index.resize_index(max(self._next_label, capacity * 2))
+            data = np.asarray([item["embedding"] for item in vectors], dtype=np.float32)
+            self._index.add_items(data, labels, replace_deleted=True)
+            for label, item in zip(labels, vectors):
+                self._items[label] = {
+                    "uuid": item["uuid"],
+                    "doc_uuid": doc_uuid,
+                    "chunk": item.get("chunk", ""),
+                }
+                self._labels_by_uuid[item["uuid"]] = label
+                self._uuid_hash += embedding_uuid_hash(item["uuid"])
+            self.dirty = True
+
+    def remove(self, vector_uuids: List[str]) -> None:
+        with self._lock:
+            for vector_uuid in vector_uuids:
+                label = self._labels_by_uuid.pop(vector_uuid, None)
+                if label is None:
+                    continue
+                self._index.mark_deleted(label)
+                self._items.pop(label, None)
+                self._free.append(label)
+                self._uuid_hash -= embedding_uuid_hash(vector_uuid)
+                self.dirty = True
+
+    def remove_doc(self, doc_uuid: str) -> None:
+        with self._lock:
+            self.remove([item["uuid"] for item in self._items.values() if item["doc_uuid"] == doc_uuid])
+
+    def doc_vector_uuids(self, doc_uuids: set) -> List[str]:
+        with self._lock:
+            return [item["uuid"] for item in self._items.values() if item["doc_uuid"] in doc_uuids]
+
+    def search(self, query_vector: List[float], top_k: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            k = min(top_k, len(self._items))
+            if k <= 0:
+                return []
+            self._index.set_ef(max(LOCAL_INDEX_EF_SEARCH, k))
+            labels, distances = self._index.knn_query(np.asarray([query_vector], dtype=np.float32), k=k)
+            results: List[Dict[str, Any]] = []
+            for label, distance in zip(labels[0], distances[0]):
+                item = self._items.get(int(label))
+                if item is None:
+                    continue
+                results.append(
+                    {
+                        "kb_uuid": self.kb_uuid,
+                        "doc_uuid": item["doc_uuid"],
+                        "chunk": item["chunk"],
+                        # hnswlib cosine distance is 1 - cosine
+                        "score": 1.0 - float(distance),
+                    }
+                )
+            return results
+
+    def save(self, directory: str) -> None:
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, self.kb_uuid)
+            self._index.save_index(f"{base}.bin.tmp")
+            meta = {
+                "dim": self.dim,
+                "generation": self.generation,
+                "synced_at": self.synced_at,
+                "next_label": self._next_label,
+                "free": self._free,
+                "items": {str(label): item for label, item in self._items.items()},
+            }
+            with open(f"{base}.json.tmp", "w", encoding="utf-8") as fp:
+                json.dump(meta, fp, ensure_ascii=False)
+            os.replace(f"{base}.bin.tmp", f"{base}.bin")
+            os.replace(f"{base}.json.tmp", f"{base}.json")
+            self.dirty = False
+
+    @classmethod
+    def load(cls, kb_uuid: str, directory: str) -> Optional["LocalVectorIndex"]:
+        base = os.path.join(directory, kb_uuid)
+        if not (os.path.exists(f"{base}.bin") and os.path.exists(f"{base}.json")):
+            return None
+        with open(f"{base}.json", encoding="utf-8") as fp:
+            meta = json.load(fp)
+        index = cls(kb_uuid, meta["dim"], path=f"{base}.bin")
+        index._next_label = meta["next_label"]
+        index._free = meta["free"]
+        index._items = {int(label): item for label, item in meta["items"].items()}
+        index._labels_by_uuid = {item["uuid"]: label for label, item in index._items.items()}
+        index._uuid_hash = sum(embedding_uuid_hash(vector_uuid) for vector_uuid in index._labels_by_uuid)
+        index.generation = meta.get("generation")
+        index.synced_at = meta.get("synced_at")
+        return index
+
+    @classmethod
+    def from_vectors(
+        cls, kb_uuid: str, matrix: np.ndarray, items: List[Dict[str, Any]]
+    ) -> "LocalVectorIndex":
+        index = cls(kb_uuid, matrix.shape[1])
+        index._index.resize_index(max(len(items), _INITIAL_CAPACITY))
+        index._index.add_items(matrix, list(range(len(items))))
+        index._items = dict(enumerate(items))
+        index._labels_by_uuid = {item["uuid"]: label for label, item in index._items.items()}
+        index._uuid_hash = sum(embedding_uuid_hash(vector_uuid) for vector_uuid in index._labels_by_uuid)
+        index._next_label = len(items)
+        index.dirty = True
+        return index
+
+
+class ExactVectorIndex:
+    """
+    exact cosine search over the vectors of one kb: a dense float32 matrix of
+    unit-length rows scored with one matrix-vector product per query.
+    a removed row is filled with the last row so the matrix stays dense.
+    """
+
+    FILE_SUFFIXES = (".npy", ".json")
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    def __init__(self, kb_uuid: str, dim: int, matrix: Optional[np.ndarray] = None):
+        self.kb_uuid = kb_uuid
+        self.dim = dim
+        self._matrix = matrix if matrix is not None else np.zeros((_INITIAL_CAPACITY, dim), dtype=np.float32)
+        self._size = 0 if matrix is None else matrix.shape[0]
+        self._items: List[Dict[str, Any]] = []
+        self._rows_by_uuid: Dict[str, int] = {}
+        self._uuid_hash = 0
+        self._lock = threading.RLock()
+        self.dirty = False
+        self.generation: Optional[int] = None
+        self.synced_at: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def fingerprint(self) -> Tuple[int, int]:
+        with self._lock:
+            return self._size, self._uuid_hash
+
+    def add(self, doc_uuid: str, vectors: List[Dict[str, Any]]) -> None:
+        vectors = [item for item in vectors if item.get("embedding")]
+        if not vectors:
+            return
+        with self._lock:
+            self.remove([item["uuid"] for item in vectors])
+            needed = self._size + len(vectors)
+            if needed > self._matrix.shape[0]:
+                grown = np.zeros((max(needed, self._matrix.shape[0] * 2), self.dim), dtype=np.float32)
+                grown[:self._size] = self._matrix[:self._size]
+                self._matrix = grown
+            rows = normalize_rows([item["embedding"] for item in vectors])
+            self._matrix[self._size:needed] = rows
+            for offset, item in enumerate(vectors):
+                self._items.append({"uuid": item["uuid"], "doc_uuid": doc_uuid, "chunk": item.get("chunk", "")})
+                self._rows_by_uuid[item["uuid"]] = self._size + offset
+                self._uuid_hash += embedding_uuid_hash(item["uuid"])
+            self._size = needed
+            self.dirty = True
+
+    def remove(self, vector_uuids: List[str]) -> None:
+        with self._lock:
+            for vector_uuid in vector_uuids:
+                row = self._rows_by_uuid.pop(vector_uuid, None)
+                if row is None:
+                    continue
+                self._uuid_hash -= embedding_uuid_hash(vector_uuid)
+                last = self._size - 1
+                if row != last:
+                    self._matrix[row] = self._matrix[last]
+                    self._items[row] = self._items[last]
+                    self._rows_by_uuid[self._items[row]["uuid"]] = row
+                self._items.pop()
+                self._size = last
+                self.dirty = True
+
+    def remove_doc(self, doc_uuid: str) -> None:
+        with self._lock:
+            self.remove([item["uuid"] for item in self._items if item["doc_uuid"] == doc_uuid])
+
+    def doc_vector_uuids(self, doc_uuids: set) -> List[str]:
+        with self._lock:
+            return [item["uuid"] for item in self._items if item["doc_uuid"] in doc_uuids]
+
+    def search(self, query_vector: List[float], top_k: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            hits = cosine_top_k(self._matrix[:self._size], query_vector, top_k)
+            return [
+                {
+                    "kb_uuid": self.kb_uuid,
+                    "doc_uuid": self._items[row]["doc_uuid"],
+                    "chunk": self._items[row]["chunk"],
+                    "score": score,
+                }
+                for row, score in hits
+            ]
+
+    def save(self, directory: str) -> None:
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, self.kb_uuid)
+            with open(f"{base}.npy.tmp", "wb") as fp:
+                np.save(fp, self._matrix[:self._size])
+            with open(f"{base}.json.tmp", "w", encoding="utf-8") as fp:
+                meta = {"dim": self.dim, "generation": self.generation, "synced_at": self.synced_at, "items": self._items}
+                json.dump(meta, fp, ensure_ascii=False)
+            os.replace(f"{base}.npy.tmp", f"{base}.npy")
+            os.replace(f"{base}.json.tmp", f"{base}.json")
+            self.dirty = False
+
+    @classmethod
+    def load(cls, kb_uuid: str, directory: str) -> Optional["ExactVectorIndex"]:
+        base = os.path.join(directory, kb_uuid)
+        if not (os.path.exists(f"{base}.npy") and os.path.exists(f"{base}.json")):
+            return None
+        with open(f"{base}.json", encoding="utf-8") as fp:
+            meta = json.load(fp)
+        index = cls(kb_uuid, meta["dim"], matrix=np.load(f"{base}.npy"))
+        index._items = meta["items"]
+        index._rows_by_uuid = {item["uuid"]: row for row, item in enumerate(index._items)}
+        index._uuid_hash = sum(embedding_uuid_hash(vector_uuid) for vector_uuid in index._rows_by_uuid)
+        index.generation = meta.get("generation")
+        index.synced_at = meta.get("synced_at")
+        return index
+
+    @classmethod
+    def from_vectors(
+        cls, kb_uuid: str, matrix: np.ndarray, items: List[Dict[str, Any]]
+    ) -> "ExactVectorIndex":
+        """matrix rows must already be unit length"""
+        index = cls(kb_uuid, matrix.shape[1], matrix=matrix)
+        index._items = list(items)
+        index._rows_by_uuid = {item["uuid"]: row for row, item in enumerate(index._items)}
+        index._uuid_hash = sum(embedding_uuid_hash(vector_uuid) for vector_uuid in index._rows_by_uuid)
+        index.dirty = True
+        return index
+
+
+def apply_embedding_delta(copy: Any, created: List[Dict[str, Any]], owned: Dict[str, List[str]]) -> None:
+    """
+    bring the vectors of the docs touched by an embedding_delta in line with ES: drop
+    the ones the docs no longer own (replaced chunks), add the created ones missing.
+    copy is a local index or the vector store view of one kb (doc_vector_uuids/remove/add).
+    """
+    present = set(copy.doc_vector_uuids(set(owned)))
+    wanted = {vector_uuid for uuids in owned.values() for vector_uuid in uuids}
+    copy.remove([vector_uuid for vector_uuid in present if vector_uuid not in wanted])
+    for doc_uuid in owned:
+        missing = [item for item in created if item["doc_uuid"] == doc_uuid and item["uuid"] not in present]
+        if missing:
+            copy.add(doc_uuid, missing)
+
+
+def catch_up(copy: Any, kb_uuid: str, embed_index: str) -> bool:
+    """
+    cheap validation of a local copy after the kb generation moved: apply the vectors
+    created since its last sync, then compare counts with ES. False when the copy could
+    not be brought up to date this way (deleted docs, large imports): it needs a full
+    check (see embedding_fingerprint), which callers run in the background.
+    """
+    synced_at = int(time.time() * 1000)
+    delta = embedding_delta(kb_uuid, (copy.synced_at or 0) - LOCAL_COPY_DELTA_SLACK_MS, embed_index)
+    if delta is None:
+        return False
+    apply_embedding_delta(copy, *delta)
+    if len(copy) != count_doc_embeddings(kb_uuid, index=embed_index):
+        return False
+    copy.synced_at = synced_at
+    return True
+
+
+class BackgroundRefresher:
+    """runs refresh(kb_uuid, *args) on a daemon thread, at most one at a time per kb"""
+
+    def __init__(self, name: str, refresh: Any):
+        self._name = name
+        self._refresh = refresh
+        self._running: set = set()
+        self._lock = threading.Lock()
+
+    def submit(self, kb_uuid: str, *args: Any) -> None:
+        with self._lock:
+            if kb_uuid in self._running:
+                return
+            self._running.add(kb_uuid)
+        threading.Thread(target=self._run, args=(kb_uuid, *args), name=f"{self._name}-{kb_uuid}", daemon=True).start()
+
+    def _run(self, kb_uuid: str, *args: Any) -> None:
+        try:
+            self._refresh(kb_uuid, *args)
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] failed to refresh {self._name} of kb {kb_uuid}: {exc}")
+        finally:
+            with self._lock:
+                self._running.discard(kb_uuid)
+
+
+class LocalIndexManager:
+    """
+    per-kb local indexes: loaded from disk on first query, built from ES in the
+    background, kept in sync by the vector write paths of this process, saved on flush().
+    every index remembers the kb generation it was last validated at. when a query
+    sees a newer generation (any write, also from another process) the index catches
+    up with the vectors created since (see catch_up) and is restamped when its count
+    matches ES. otherwise, and every LOCAL_COPY_VERIFY_SECONDS, a background refresh
+    compares it with ES by embedding_fingerprint and rebuilds it on a mismatch; queries
+    go to ES until the index is current again. the query path never builds.
+    """
+
+    def __init__(self, directory: str, index_cls: type):
+        self._directory = directory
+        self._index_cls = index_cls
+        self._indexes: Dict[str, Any] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._refresher = BackgroundRefresher("local index", self.refresh)
+        self._verified_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.queries = 0
+        self.validations = 0
+        self.refreshes = 0
+
+    def available(self) -> bool:
+        return self._index_cls.available()
+
+    def _build(self, kb_uuid: str, embed_index: str) -> Optional[Any]:
+        """build from the vectors of the kb stored in its ES vector index"""
+        synced_at = int(time.time() * 1000)
+        matrix, items = load_kb_vectors(kb_uuid, embed_index)
+        if not items:
+            return None
+        index = self._index_cls.from_vectors(kb_uuid, matrix, items)
+        index.synced_at = synced_at
+        return index
+
+    def _is_current(self, index: Any, embed_index: str, generation: Optional[int]) -> bool:
+        """
+        generation None means the last write may not be searchable in ES yet (or is
+        unknown): the index is served as is and validated by a later query.
+        """
+        if generation is None or index.generation == generation:
+            return True
+        self.validations += 1
+        if not catch_up(index, index.kb_uuid, embed_index):
+            return False
+        index.generation = generation
+        index.dirty = True
+        if time.monotonic() - self._verified_at.get(index.kb_uuid, 0.0) > LOCAL_COPY_VERIFY_SECONDS:
+            self._refresher.submit(index.kb_uuid, embed_index, generation)
+        return True
+
+    def get(
+        self, kb_uuid: str, embed_index: str = KB_DOC_EMBED_INDEX, generation: Optional[int] = None
+    ) -> Optional[Any]:
+        """
+        the index of kb_uuid if it is current as of generation (see _is_current),
+        otherwise None and a background refresh is started
+        """
+        with self._lock:
+            index = self._indexes.get(kb_uuid)
+        if index is None:
+            index = self._index_cls.load(kb_uuid, self._directory)
+            if index is not None:
+                with self._lock:
+                    index = self._indexes.setdefault(kb_uuid, index)
+        if index is not None and self._is_current(index, embed_index, generation):
+            return index
+        self._refresher.submit(kb_uuid, embed_index, generation)
+        return None
+
+    def refresh(self, kb_uuid: str, embed_index: str = KB_DOC_EMBED_INDEX, generation: Optional[int] = None) -> None:
+        """full check of the index against ES by fingerprint, rebuilding it on a mismatch"""
+        with self._lock:
+            build_lock = self._build_locks.setdefault(kb_uuid, threading.Lock())
+        with build_lock:
+            self.refreshes += 1
+            with self._lock:
+                index = self._indexes.get(kb_uuid)
+            synced_at = int(time.time() * 1000)
+            if index is not None and index.fingerprint() == embedding_fingerprint(kb_uuid, index=embed_index):
+                index.generation = generation
+                index.synced_at = synced_at
+                index.dirty = True
+            else:
+                index = self._build(kb_uuid, embed_index)
+                if index is None:
+                    with self._lock:
+                        self._indexes.pop(kb_uuid, None)
+                    return
+                index.generation = generation
+                self.builds += 1
+                index.save(self._directory)
+                with self._lock:
+                    self._indexes[kb_uuid] = index
+            self._verified_at[kb_uuid] = time.monotonic()
+
+    def search(
+        self,
+        kb_uuid: str,
+        query_vector: List[float],
+        top_k: int,
+        embed_index: str = KB_DOC_EMBED_INDEX,
+        generation: Optional[int] = None,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """the top_k hits, None when the index is not current yet (ask ES meanwhile)"""
+        self.queries += 1
+        index = self.get(kb_uuid, embed_index, generation)
+        if index is not None and index.dim != len(query_vector):
+            # the kb was re-embedded (possibly by another process), rebuild it: the vector
+            # uuids are kept by a re-embed, so the persisted copy would pass validation
+            self.drop(kb_uuid)
+            index = self.get(kb_uuid, embed_index, generation)
+        if index is None:
+            return None
+        return index.search(query_vector, top_k)
+
+    def _loaded(self, kb_uuid: str) -> Optional[Any]:
+        with self._lock:
+            return self._indexes.get(kb_uuid)
+
+    def add(self, kb_uuid: str, doc_uuid: str, vectors: List[Dict[str, Any]], replace_doc: bool = False) -> None:
+        """only indexes already loaded are updated, the others are validated on load"""
+        index = self._loaded(kb_uuid)
+        if index is None:
+            return
+        if replace_doc:
+            index.remove_doc(doc_uuid)
+        index.add(doc_uuid, vectors)
+
+    def remove(self, kb_uuid: str, vector_uuids: List[str]) -> None:
+        index = self._loaded(kb_uuid)
+        if index is not None:
+            index.remove(vector_uuids)
+
+    def remove_doc(self, kb_uuid: str, doc_uuid: str) -> None:
+        index = self._loaded(kb_uuid)
+        if index is not None:
+            index.remove_doc(doc_uuid)
+
+    def drop(self, kb_uuid: str) -> None:
+        with self._lock:
+            self._indexes.pop(kb_uuid, None)
+            self._verified_at.pop(kb_uuid, None)
+            for suffix in self._index_cls.FILE_SUFFIXES:
+                path = os.path.join(self._directory, kb_uuid + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def flush(self) -> None:
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            if index.dirty:
+                try:
+                    index.save(self._directory)
+                except Exception as exc:  # pylint: disable=broad-except
+                    print(f"[WARN] failed to save local index of kb {index.kb_uuid}: {exc}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            indexes = list(self._indexes.values())
+        return {
+            "available": self.available(),
+            "loaded": len(indexes),
+            "vectors": sum(len(index) for index in indexes),
+            "builds": self.builds,
+            "validations": self.validations,
+            "refreshes": self.refreshes,
+            "queries": self.queries,
+        }
+
+
+hnsw_indexes = LocalIndexManager(os.path.join(LOCAL_INDEX_DIR, "hnsw"), LocalVectorIndex)
+exact_indexes = LocalIndexManager(os.path.join(LOCAL_INDEX_DIR, "exact"), ExactVectorIndex)
+
+
+def get_local_engine() -> Optional[LocalIndexManager]:
+    """
+    the in-process index manager selected by RETRIEVAL_ENGINE
+    ("local" = HNSW, "exact" = numpy brute force), None when retrieval goes to ES.
+    """
+    if RETRIEVAL_ENGINE == "local" and hnsw_indexes.available():
+        return hnsw_indexes
+    if RETRIEVAL_ENGINE == "exact":
+        return exact_indexes
+    return None
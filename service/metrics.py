@@ -0,0 +1,33 @@
+from typing import Any, Dict
+
+from service.answer_cache import answer_cache
+from service.embedding_cache import get_embedding_cache
+from service.jobs import get_job_runner
+from service.local_index import get_local_engine
+from service.vector_store import get_vector_store
+from service.kb import query_embedding_cache, retrieval_cache, get_qa_writeback, qa_flights
+from service.openai_service import get_scheduler, embedding_flights
+
+
+def collect_metrics() -> Dict[str, Any]:
+    """
+    snapshot of in-process cache and OpenAI traffic counters (per worker).
+    """
+    embedding_cache = get_embedding_cache()
+    local_engine = get_local_engine()
+    vector_store = get_vector_store()
+    return {
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+        "answer_cache": answer_cache.stats(),
+        "openai_scheduler": get_scheduler().stats(),
+        "qa_writeback": get_qa_writeback().stats(),
+        "local_index": local_engine.stats() if local_engine else None,
+        "vector_store": vector_store.stats() if vector_store else None,
+        "jobs": get_job_runner().stats(),
+        "single_flight": {
+            "qa": qa_flights.stats(),
+            "embeddings": embedding_flights.stats(),
+        },
+    }
@@ -0,0 +1,224 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+_POLL_INTERVAL = 0.05
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 30.0
+
+
+class TokenBucket:
+    """token bucket refilled continuously at rate_per_minute, capacity of one minute"""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(max(1, rate_per_minute))
+        self.tokens = self.capacity
+        self._rate = self.capacity / 60.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # a request larger than the bucket only needs a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self._rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """
+    central gate for OpenAI traffic:
+    - token buckets for requests per minute and tokens per minute
+    - bounded concurrency, with slots reserved for interactive traffic
+    - bulk traffic yields while interactive requests are waiting
+    - retries on 429/5xx/timeouts, honouring retry-after with jittered backoff
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_concurrency: int,
+        interactive_reserved_slots: int,
+        max_retries: int,
+    ):
+        self._lock = threading.Lock()
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._max_concurrency = max(1, max_concurrency)
+        self._bulk_concurrency = max(1, self._max_concurrency - interactive_reserved_slots)
+        self._max_retries = max_retries
+        self._in_flight = 0
+        self._waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self._blocked_until = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def _try_acquire(self, tokens: int, priority: int) -> float:
+        """take a slot and budget, return 0 on success or the seconds to wait"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if priority == PRIORITY_BULK:
+                if self._waiting[PRIORITY_INTERACTIVE] or self._in_flight >= self._bulk_concurrency:
+                    return _POLL_INTERVAL
+            elif self._in_flight >= self._max_concurrency:
+                return _POLL_INTERVAL
+            wait = max(
+                self._request_bucket.wait_time(1, now),
+                self._token_bucket.wait_time(tokens, now),
+            )
+            if wait > 0:
+                return wait
+            self._request_bucket.take(1)
+            self._token_bucket.take(tokens)
+            self._in_flight += 1
+            return 0.0
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _set_waiting(self, priority: int, delta: int) -> None:
+        with self._lock:
+            self._waiting[priority] += delta
+
+    def _acquire(self, tokens: int, priority: int) -> None:
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                wait = self._try_acquire(tokens, priority)
+                if wait <= 0:
+                    return
+                time.sleep(min(wait, 1.0))
+        finally:
+            self._set_waiting(priority, -1)
+
+    async def _aacquire(self, tokens: int, priority: int) -> None:
+        self._set_waiting(priority, 1)
+        try:
+            while True:
+                wait = self._try_acquire(tokens, priority)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            self._set_waiting(priority, -1)
+
+    def _retry_delay(self, exc: Exception, attempt: int) -> Optional[float]:
+        """seconds to wait before retrying exc, None when it should not be retried"""
+        if attempt >= self._max_retries:
+            return None
+        if not isinstance(
+            exc,
+            (
+                openai.RateLimitError,
+                openai.APITimeoutError,
+                openai.APIConnectionError,
+                openai.InternalServerError,
+            ),
+        ):
+            return None
+        backoff = min(_BACKOFF_MAX, _BACKOFF_BASE * (2 ** attempt))
+        delay = backoff * random.uniform(0.5, 1.5)
+        retry_after = _retry_after_seconds(exc)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, backoff / 2)
+        with self._lock:
+            self.retries += 1
+            if isinstance(exc, openai.RateLimitError):
+                # the provider limit is shared, so hold back every caller
+                self.rate_limited += 1
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+    def run(self, fn: Callable[[], T], tokens: int = 0, priority: int = PRIORITY_INTERACTIVE) -> T:
+        """
+        blocking variant for worker threads. it sleeps while waiting for budget and
+        between retries, so on the event loop it would stall every request (and the
+        interactive arun callers that bulk work waits for): use arun or asyncio.to_thread.
+        """
+        _ensure_off_event_loop()
+        attempt = 0
+        while True:
+            self._acquire(tokens, priority)
+            try:
+                return fn()
+            except Exception as exc:  # pylint: disable=broad-except
+                delay = self._retry_delay(exc, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self._release()
+            attempt += 1
+            time.sleep(delay)
+
+    async def arun(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        tokens: int = 0,
+        priority: int = PRIORITY_INTERACTIVE,
+    ) -> T:
+        attempt = 0
+        while True:
+            await self._aacquire(tokens, priority)
+            try:
+                return await fn()
+            except Exception as exc:  # pylint: disable=broad-except
+                delay = self._retry_delay(exc, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self._release()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting_interactive": self._waiting[PRIORITY_INTERACTIVE],
+                "waiting_bulk": self._waiting[PRIORITY_BULK],
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+            }
+
+
+def _ensure_off_event_loop() -> None:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise RuntimeError("blocking OpenAI call on the event loop, use the async client or asyncio.to_thread")
+
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
@@ -1,8 +1,47 @@
-from openai import OpenAI
-from define import OPENAI_API_KEY
-from typing import Optional, List, Dict
+import asyncio
+from typing import Any, Optional, List, Dict, AsyncIterator
+
+import anyio
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from define import (
+    OPENAI_API_KEY,
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_TOKENS_PER_MINUTE,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_INTERACTIVE_RESERVED_SLOTS,
+    OPENAI_MAX_RETRIES,
+    EMBEDDING_BATCH_MAX_INPUTS,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    OPENAI_TIMEOUT,
+    OPENAI_CONNECT_TIMEOUT,
+)
+from service.embedding_cache import get_embedding_cache
+from service.tokenizer import count_tokens, count_message_tokens
+from service.singleflight import SingleFlight
+from service.openai_scheduler import RequestScheduler, PRIORITY_INTERACTIVE
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
 
 _client: Optional[OpenAI] = None
+_async_client: Optional[AsyncOpenAI] = None
+_scheduler: Optional[RequestScheduler] = None
+
+embedding_flights = SingleFlight("embeddings")
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
 
 
 def get_openai_client() -> OpenAI:
@@ -11,10 +50,56 @@ def get_openai_client() -> OpenAI:
     if _client is None:
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY 未配置，请在 .env 文件中设置")
-        _client = OpenAI(api_key=OPENAI_API_KEY)
+        # retries are handled by the request scheduler
+        _client = OpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=_http_timeout(),
+            max_retries=0,
+            http_client=httpx.Client(limits=_http_limits(), timeout=_http_timeout()),
+        )
     return _client
 
 
+def get_async_openai_client() -> AsyncOpenAI:
+    """get AsyncOpenAI client (singleton pattern), sharing one pooled http client"""
+    global _async_client
+    if _async_client is None:
+        if not OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY 未配置，请在 .env 文件中设置")
+        _async_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=_http_timeout(),
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout()),
+        )
+    return _async_client
+
+
+def get_scheduler() -> RequestScheduler:
+    """get the request scheduler shared by all OpenAI calls (singleton pattern)"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler(
+            requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+            tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+            max_concurrency=OPENAI_MAX_CONCURRENCY,
+            interactive_reserved_slots=OPENAI_INTERACTIVE_RESERVED_SLOTS,
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+    return _scheduler
+
+
+async def aclose_openai_clients() -> None:
+    """release pooled connections, called on application shutdown"""
+    global _client, _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
 def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-4o") -> str:
     """
     OpenAI chat completion interface
@@ -27,19 +112,19 @@ def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-4o") -> st
         the text content returned by the model
     """
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages
+    response = get_scheduler().run(
+        lambda: client.chat.completions.create(model=model, messages=messages),
+        tokens=count_message_tokens(messages, model),
     )
     return response.choices[0].message.content
 
 
 def stream_chat_completion(messages: List[Dict[str, str]], model: str = "gpt-4o"):
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        stream=True,
+    # the scheduler gates opening the stream, which is where 429s surface
+    response = get_scheduler().run(
+        lambda: client.chat.completions.create(model=model, messages=messages, stream=True),
+        tokens=count_message_tokens(messages, model),
     )
     for chunk in response:
         delta = chunk.choices[0].delta.content
@@ -47,21 +132,209 @@ def stream_chat_completion(messages: List[Dict[str, str]], model: str = "gpt-4o"
             yield delta
 
 
-def create_embeddings(text: str, model: str = "text-embedding-ada-002") -> List[float]:
+async def achat_completion(messages: List[Dict[str, str]], model: str = "gpt-4o") -> str:
+    """async variant of chat_completion"""
+    client = get_async_openai_client()
+    response = await get_scheduler().arun(
+        lambda: client.chat.completions.create(model=model, messages=messages),
+        tokens=count_message_tokens(messages, model),
+    )
+    return response.choices[0].message.content
+
+
+async def astream_chat_completion(
+    messages: List[Dict[str, str]], model: str = "gpt-4o"
+) -> AsyncIterator[str]:
+    """async variant of stream_chat_completion"""
+    client = get_async_openai_client()
+    response = await get_scheduler().arun(
+        lambda: client.chat.completions.create(model=model, messages=messages, stream=True),
+        tokens=count_message_tokens(messages, model),
+    )
+    try:
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        # closing the http response aborts the completion upstream
+        with anyio.CancelScope(shield=True):
+            await response.close()
+
+
+def create_embeddings(
+    text: str,
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    priority: int = PRIORITY_INTERACTIVE,
+    dimensions: Optional[int] = None,
+) -> List[float]:
     """
     create text embedding vector
     
     Args:
         text: the text to embed
         model: the embedding model to use, default is text-embedding-ada-002
+        priority: scheduler priority, PRIORITY_BULK for ingestion traffic
+        dimensions: output size for models that support shortening (text-embedding-3-*)
     
     Returns:
         the list of embedding vectors
     """
+    return create_embeddings_batch([text], model=model, priority=priority, dimensions=dimensions)[0]
+
+
+def _split_embedding_batches(texts: List[str], model: str) -> List[List[int]]:
+    """
+    group text indexes into batches that respect the per-request
+    input count and token limits, keeping the original order.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for idx, text in enumerate(texts):
+        tokens = count_tokens(text, model)
+        if current and (
+            len(current) >= EMBEDDING_BATCH_MAX_INPUTS
+            or current_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(idx)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _cache_model(model: str, dimensions: Optional[int]) -> str:
+    """embedding cache namespace, shortened outputs of a model are different vectors"""
+    return model if dimensions is None else f"{model}:{dimensions}"
+
+
+def _embedding_kwargs(model: str, inputs: List[str], dimensions: Optional[int]) -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = {"model": model, "input": inputs}
+    if dimensions is not None:
+        kwargs["dimensions"] = dimensions
+    return kwargs
+
+
+def create_embeddings_batch(
+    texts: List[str],
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    priority: int = PRIORITY_INTERACTIVE,
+    dimensions: Optional[int] = None,
+) -> List[List[float]]:
+    """
+    create embedding vectors for many texts with as few requests as possible,
+    texts already in the embedding cache are not sent to OpenAI again
+
+    Args:
+        texts: the texts to embed
+        model: the embedding model to use, default is text-embedding-ada-002
+        priority: scheduler priority, PRIORITY_BULK for ingestion traffic
+        dimensions: output size for models that support shortening (text-embedding-3-*)
+
+    Returns:
+        one embedding vector per text, in the same order as texts
+    """
+    if not texts:
+        return []
+    cache = get_embedding_cache()
+    if cache is None:
+        return _request_embeddings(texts, model, priority, dimensions)
+
+    cache_model = _cache_model(model, dimensions)
+    vectors = cache.get_many(cache_model, texts)
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing:
+        fresh = dict(zip(missing, _request_embeddings(missing, model, priority, dimensions)))
+        cache.put_many(cache_model, missing, [fresh[text] for text in missing])
+        vectors = [vector if vector is not None else fresh[text] for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+def _request_embeddings(
+    texts: List[str], model: str, priority: int, dimensions: Optional[int] = None
+) -> List[List[float]]:
     client = get_openai_client()
-    response = client.embeddings.create(
-        model=model,
-        input=text
+    scheduler = get_scheduler()
+    vectors: List[List[float]] = [[] for _ in texts]
+    for batch in _split_embedding_batches(texts, model):
+        inputs = [texts[idx] for idx in batch]
+        response = scheduler.run(
+            lambda: client.embeddings.create(**_embedding_kwargs(model, inputs, dimensions)),
+            tokens=sum(count_tokens(text, model) for text in inputs),
+            priority=priority,
+        )
+        # response items carry the position of their input inside the batch
+        for item in response.data:
+            vectors[batch[item.index]] = item.embedding
+    return vectors
+
+
+async def acreate_embeddings(
+    text: str,
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    priority: int = PRIORITY_INTERACTIVE,
+    dimensions: Optional[int] = None,
+) -> List[float]:
+    """async variant of create_embeddings, identical concurrent calls share one request"""
+    return await embedding_flights.do(
+        (model, dimensions, text),
+        lambda: _acreate_single_embedding(text, model, priority, dimensions),
     )
-    return response.data[0].embedding
 
+
+async def _acreate_single_embedding(
+    text: str, model: str, priority: int, dimensions: Optional[int]
+) -> List[float]:
+    return (await acreate_embeddings_batch([text], model=model, priority=priority, dimensions=dimensions))[0]
+
+
+async def acreate_embeddings_batch(
+    texts: List[str],
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    priority: int = PRIORITY_INTERACTIVE,
+    dimensions: Optional[int] = None,
+) -> List[List[float]]:
+    """async variant of create_embeddings_batch, batches are requested concurrently"""
+    if not texts:
+        return []
+    # the cache is sqlite (opened on first use): keep its calls off the event loop
+    cache = await asyncio.to_thread(get_embedding_cache)
+    if cache is None:
+        return await _arequest_embeddings(texts, model, priority, dimensions)
+
+    cache_model = _cache_model(model, dimensions)
+    vectors = await asyncio.to_thread(cache.get_many, cache_model, texts)
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing:
+        fresh = dict(zip(missing, await _arequest_embeddings(missing, model, priority, dimensions)))
+        await asyncio.to_thread(cache.put_many, cache_model, missing, [fresh[text] for text in missing])
+        vectors = [vector if vector is not None else fresh[text] for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+async def _arequest_embeddings(
+    texts: List[str], model: str, priority: int, dimensions: Optional[int] = None
+) -> List[List[float]]:
+    client = get_async_openai_client()
+    scheduler = get_scheduler()
+    batches = _split_embedding_batches(texts, model)
+
+    async def request(inputs: List[str]):
+        return await scheduler.arun(
+            lambda: client.embeddings.create(**_embedding_kwargs(model, inputs, dimensions)),
+            tokens=sum(count_tokens(text, model) for text in inputs),
+            priority=priority,
+        )
+
+    responses = await asyncio.gather(
+        *(request([texts[idx] for idx in batch]) for batch in batches)
+    )
+    vectors: List[List[float]] = [[] for _ in texts]
+    for batch, response in zip(batches, responses):
+        for item in response.data:
+            vectors[batch[item.index]] = item.embedding
+    return vectors
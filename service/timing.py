@@ -0,0 +1,32 @@
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Dict, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class StageTimer:
+    """
+    collect per-stage wall time (ms) of a request pipeline.
+    stages awaited concurrently overlap, so "total" shows the critical path.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000, 2)
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.stage(name):
+            return await awaitable
+
+    def finish(self) -> Dict[str, float]:
+        self.timings["total"] = round((time.perf_counter() - self._start) * 1000, 2)
+        return self.timings
@@ -0,0 +1,71 @@
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# chat format adds a few tokens around every message
+_MESSAGE_OVERHEAD = 4
+_REPLY_PRIMING = 3
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> Optional[Any]:
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] tiktoken encoding for {model} unavailable, estimating tokens: {exc}")
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"[WARN] tiktoken encoding unavailable, estimating tokens: {exc}")
+        return None
+
+
+def _estimate_tokens(text: str) -> int:
+    """
+    rough upper bound of the token count: ~3 utf-8 bytes per token,
+    which over-counts english and roughly matches CJK text.
+    """
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """count tokens with the local tokenizer, estimate when it is unavailable"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """cut text down to at most max_tokens tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        if _estimate_tokens(text) <= max_tokens:
+            return text
+        # invert the estimate, then trim any broken multi-byte tail
+        return text.encode("utf-8")[: max_tokens * 3].decode("utf-8", errors="ignore")
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def message_tokens(message: Dict[str, str], model: str = "gpt-4o") -> int:
+    """token cost of a single chat message"""
+    return _MESSAGE_OVERHEAD + count_tokens(message.get("content") or "", model)
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str = "gpt-4o") -> int:
+    """token count of a chat completion prompt"""
+    return _REPLY_PRIMING + sum(message_tokens(message, model) for message in messages)
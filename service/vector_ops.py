@@ -0,0 +1,172 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray, inplace: bool = False) -> np.ndarray:
+    """
+    float32 matrix with unit-length rows, all-zero rows stay zero.
+    inplace rescales a float32 matrix without allocating a copy.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    if inplace:
+        matrix /= norms
+        return matrix
+    return matrix / norms
+
+
+def normalize(vector: Sequence[float]) -> np.ndarray:
+    return normalize_rows(np.asarray(vector, dtype=np.float32)[None, :])[0]
+
+
+def unit_vector(vector: Sequence[float]) -> List[float]:
+    """L2-normalized copy of vector as a plain list, as stored in kb_doc_embed_index"""
+    return normalize(vector).tolist()
+
+
+def top_k_indices(scores: np.ndarray, k: int, threshold: float = -1.0) -> List[Tuple[int, float]]:
+    """
+    (row, score) of the k best scores at or above threshold, best first.
+    argpartition keeps the selection linear, only the k winners get sorted.
+    """
+    if k <= 0 or scores.size == 0:
+        return []
+    if k < scores.size:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    candidates = candidates[scores[candidates] >= threshold]
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [(int(row), float(scores[row])) for row in order]
+
+
+def cosine_top_k(
+    matrix: np.ndarray, query_vector: Sequence[float], k: int, threshold: float = -1.0
+) -> List[Tuple[int, float]]:
+    """exact cosine top-k of query_vector against the rows of a row-normalized matrix"""
+    if matrix.shape[0] == 0:
+        return []
+    return top_k_indices(matrix @ normalize(query_vector), k, threshold)
+
+
+def greedy_clusters(matrix: np.ndarray, threshold: float) -> List[List[int]]:
+    """
+    leader clustering of a row-normalized matrix: rows are visited in order, a row
+    not yet assigned starts a cluster and takes every unassigned row whose cosine
+    to it is >= threshold. each cluster lists its leader first.
+    """
+    assigned = np.zeros(matrix.shape[0], dtype=bool)
+    clusters: List[List[int]] = []
+    for row in range(matrix.shape[0]):
+        if assigned[row]:
+            continue
+        assigned[row] = True
+        members = np.flatnonzero(~assigned & (matrix @ matrix[row] >= threshold))
+        assigned[members] = True
+        clusters.append([row, *members.tolist()])
+    return clusters
+
+
+def quantize_int8(matrix: np.ndarray, chunk_rows: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    symmetric per-dimension int8 scalar quantization: code = round(x / scale).
+    returns the codes and the float32 scale of every dimension. works in row
+    chunks so a memmapped matrix is never materialized as a whole.
+    """
+    rows, dim = matrix.shape
+    scale = int8_scale(matrix, chunk_rows)
+    codes = np.empty((rows, dim), dtype=np.int8)
+    for start in range(0, rows, chunk_rows):
+        codes[start:start + chunk_rows] = encode_int8(matrix[start:start + chunk_rows], scale)
+    return codes, scale
+
+
+def int8_scale(matrix: np.ndarray, chunk_rows: int = 8192) -> np.ndarray:
+    """per-dimension scale mapping the largest absolute value of each dimension to 127"""
+    rows, dim = matrix.shape
+    peak = np.zeros(dim, dtype=np.float32)
+    for start in range(0, rows, chunk_rows):
+        np.maximum(peak, np.abs(matrix[start:start + chunk_rows]).max(axis=0), out=peak)
+    scale = peak / 127.0
+    scale[scale == 0] = 1.0
+    return scale
+
+
+def encode_int8(block: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """int8 codes of rows with a given scale, values beyond the scale's range are clipped"""
+    return np.clip(np.rint(np.asarray(block, dtype=np.float32) / scale), -127, 127).astype(np.int8)
+
+
+def int8_scores(codes: np.ndarray, scale: np.ndarray, query: np.ndarray, chunk_rows: int = 8192) -> np.ndarray:
+    """approximate dot products of query with the dequantized rows"""
+    scaled_query = (query * scale).astype(np.float32)
+    scores = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], chunk_rows):
+        scores[start:start + chunk_rows] = codes[start:start + chunk_rows].astype(np.float32) @ scaled_query
+    return scores
+
+
+def quantized_top_k(
+    codes: np.ndarray,
+    scale: np.ndarray,
+    matrix: np.ndarray,
+    query_vector: Sequence[float],
+    k: int,
+    oversample: int,
+    threshold: float = -1.0,
+    row_weights: Optional[np.ndarray] = None,
+) -> List[Tuple[int, float]]:
+    """
+    cosine top-k with candidates generated on int8 codes (k * oversample of them)
+    and rescored with the full-precision rows of matrix. row_weights are 1/norm
+    per row for matrices that are not row-normalized, 0 excludes a row.
+    """
+    query = normalize(query_vector)
+    approx = int8_scores(codes, scale, query)
+    if row_weights is not None:
+        approx *= row_weights
+        approx[row_weights == 0] = -np.inf
+    candidates = np.array([row for row, _ in top_k_indices(approx, k * max(1, oversample))], dtype=np.int64)
+    if candidates.size == 0:
+        return []
+    candidates.sort()  # sequential reads on a memmap
+    exact = np.asarray(matrix[candidates], dtype=np.float32) @ query
+    if row_weights is not None:
+        exact *= row_weights[candidates]
+    return [(int(candidates[idx]), score) for idx, score in top_k_indices(exact, k, threshold)]
+
+
+def quantization_report(
+    matrix: np.ndarray, queries: np.ndarray, k: int, oversample_factors: Sequence[int]
+) -> Dict[str, Any]:
+    """
+    recall@k of int8 search against exact search over a row-normalized matrix,
+    without rescoring and with rescoring at each oversample factor.
+    """
+    codes, scale = quantize_int8(matrix)
+    exact = [{row for row, _ in cosine_top_k(matrix, query, k)} for query in queries]
+
+    def recall(found: List[List[Tuple[int, float]]]) -> float:
+        hits = sum(len(truth & {row for row, _ in rows}) for truth, rows in zip(exact, found))
+        total = sum(len(truth) for truth in exact)
+        return hits / total if total else 1.0
+
+    recalls = {"int8": recall([top_k_indices(int8_scores(codes, scale, normalize(q)), k) for q in queries])}
+    for factor in oversample_factors:
+        recalls[f"int8_rescore_x{factor}"] = recall(
+            [quantized_top_k(codes, scale, matrix, q, k, factor) for q in queries]
+        )
+    float_bytes = matrix.shape[0] * matrix.shape[1] * 4
+    int8_bytes = codes.nbytes + scale.nbytes
+    return {
+        "vectors": matrix.shape[0],
+        "dim": matrix.shape[1],
+        "queries": len(queries),
+        "k": k,
+        "float32_bytes": float_bytes,
+        "int8_bytes": int8_bytes,
+        "compression": float_bytes / int8_bytes if int8_bytes else 0.0,
+        "recall": recalls,
+    }
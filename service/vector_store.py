@@ -0,0 +1,730 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from dao.kb_dao import embedding_fingerprint, embedding_uuid_hash, iter_doc_embeddings
+from models.kb import KB_DOC_EMBED_INDEX
+from service.local_index import BackgroundRefresher, catch_up
+from service.vector_ops import normalize, top_k_indices, int8_scale, encode_int8, quantized_top_k
+from define import (
+    VECTOR_STORE_ENABLED,
+    VECTOR_STORE_DIR,
+    VECTOR_STORE_COMPACT_RATIO,
+    VECTOR_QUANTIZATION,
+    QUANTIZATION_OVERSAMPLE,
+    EMBEDDING_SCAN_PAGE_SIZE,
+    LOCAL_COPY_VERIFY_SECONDS,
+)
+
+_COMPACT_MIN_ROWS = 1024
+
+
+class VectorStore:
+    """
+    on-disk columnar embedding store, one append-only float32 file per kb
+    ({kb_uuid}.f32, row-major, read through np.memmap) plus an id table in
+    sqlite mapping rows to doc/chunk uuids. removed rows are tombstoned and
+    dropped by compaction once they exceed compact_ratio of the file.
+    every process maps the same files, so workers share vectors through
+    the OS page cache; writers are serialized by the sqlite write lock.
+    a kb copy is stamped with the kb generation it was validated at and
+    carries the fingerprint of its live vector uuids (see embedding_fingerprint).
+    a newer generation is caught up with by the vectors created since the last sync
+    (see catch_up); the fingerprint check and rebuilds run in the background.
+    with quantization="int8" every float32 file has an int8 code file next to it
+    ({kb_uuid}.i8, plus the per-dimension {kb_uuid}.scale): searches scan the
+    memmapped codes and only rescore the oversampled candidates with float32 rows.
+    appends encode with the stored scale (clipping values beyond it), the scale is
+    only recomputed when the file is rewritten by a rebuild or compaction.
+    """
+
+    def __init__(self, directory: str, compact_ratio: float, quantization: str = "none", oversample: int = 4):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._compact_ratio = compact_ratio
+        self._quantization = quantization
+        self._oversample = oversample
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "ids.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vector_store_kbs ("
+            " kb_uuid TEXT PRIMARY KEY,"
+            " dim INTEGER NOT NULL,"
+            " rows INTEGER NOT NULL,"
+            " live INTEGER NOT NULL,"
+            " version INTEGER NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(vector_store_kbs)")}
+        # copies made before generation stamps fail validation once and are rebuilt
+        if "generation" not in columns:
+            self._conn.execute("ALTER TABLE vector_store_kbs ADD COLUMN generation INTEGER")
+        if "uuid_hash" not in columns:
+            self._conn.execute("ALTER TABLE vector_store_kbs ADD COLUMN uuid_hash INTEGER NOT NULL DEFAULT 0")
+        if "synced_at" not in columns:
+            self._conn.execute("ALTER TABLE vector_store_kbs ADD COLUMN synced_at INTEGER")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vector_store_rows ("
+            " kb_uuid TEXT NOT NULL,"
+            " row INTEGER NOT NULL,"
+            " uuid TEXT NOT NULL,"
+            " doc_uuid TEXT,"
+            " chunk TEXT,"
+            " chunk_hash TEXT,"
+            " create_at INTEGER,"
+            " norm REAL NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (kb_uuid, row))"
+        )
+        # rows of a rebuild in progress, swapped into vector_store_rows when it completes
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vector_store_staging ("
+            " kb_uuid TEXT NOT NULL,"
+            " row INTEGER NOT NULL,"
+            " uuid TEXT NOT NULL,"
+            " doc_uuid TEXT,"
+            " chunk TEXT,"
+            " chunk_hash TEXT,"
+            " create_at INTEGER,"
+            " norm REAL NOT NULL,"
+            " PRIMARY KEY (kb_uuid, row))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS vector_store_rows_uuid ON vector_store_rows (kb_uuid, uuid)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS vector_store_rows_doc ON vector_store_rows (kb_uuid, doc_uuid)"
+        )
+        self._lock = threading.RLock()
+        # kb_uuid -> (version, file identity, memmap, per-row 1/norm with 0 for tombstones)
+        self._views: Dict[str, Tuple[int, Tuple[int, int], np.ndarray, np.ndarray]] = {}
+        # kb_uuid -> (code file identity, memmapped int8 codes, per-dimension scale)
+        self._codes: Dict[str, Tuple[Tuple[int, int], np.ndarray, np.ndarray]] = {}
+        self._refresher = BackgroundRefresher("vector store", self.refresh)
+        self._verified_at: Dict[str, float] = {}
+        self.rebuilds = 0
+        self.compactions = 0
+
+    def _path(self, kb_uuid: str) -> str:
+        return os.path.join(self._directory, f"{kb_uuid}.f32")
+
+    def _codes_paths(self, kb_uuid: str) -> Tuple[str, str]:
+        return os.path.join(self._directory, f"{kb_uuid}.i8"), os.path.join(self._directory, f"{kb_uuid}.scale")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _meta(self, kb_uuid: str) -> Optional[Tuple[int, int, int, int]]:
+        """(dim, rows, live, version) of a tracked kb"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT dim, rows, live, version FROM vector_store_kbs WHERE kb_uuid = ?", (kb_uuid,)
+            ).fetchone()
+
+    def _stamp(self, kb_uuid: str) -> Optional[Tuple[Optional[int], int, int]]:
+        """(generation, live, uuid_hash) of a tracked kb"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT generation, live, uuid_hash FROM vector_store_kbs WHERE kb_uuid = ?", (kb_uuid,)
+            ).fetchone()
+
+    @contextmanager
+    def _build_lock(self, kb_uuid: str) -> Iterator[None]:
+        """one rebuild per kb at a time, across threads and processes"""
+        with open(f"{self._path(kb_uuid)}.lock", "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    # ==== writes ====
+
+    def _append(self, kb_uuid: str, items: List[Dict[str, Any]]) -> None:
+        """append rows inside a transaction, items carry doc_uuid and embedding"""
+        meta = self._meta(kb_uuid)
+        if meta is None:
+            return
+        dim, rows, _, _ = meta
+        items = [item for item in items if len(item.get("embedding") or []) == dim]
+        if not items:
+            return
+        self._tombstone(kb_uuid, "uuid", [item["uuid"] for item in items])
+        data = np.asarray([item["embedding"] for item in items], dtype=np.float32)
+        norms = np.linalg.norm(data, axis=1)
+        with open(self._path(kb_uuid), "ab") as fp:
+            # drop bytes of an append that never committed
+            fp.truncate(rows * dim * 4)
+            fp.write(data.tobytes())
+        self._append_codes(kb_uuid, rows, dim, data)
+        self._conn.executemany(
+            "INSERT INTO vector_store_rows"
+            " (kb_uuid, row, uuid, doc_uuid, chunk, chunk_hash, create_at, norm)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    kb_uuid,
+                    rows + offset,
+                    item["uuid"],
+                    item.get("doc_uuid"),
+                    item.get("chunk", ""),
+                    item.get("chunk_hash"),
+                    item.get("create_at"),
+                    float(norm),
+                )
+                for offset, (item, norm) in enumerate(zip(items, norms))
+            ],
+        )
+        self._conn.execute(
+            "UPDATE vector_store_kbs SET rows = rows + ?, live = live + ?, uuid_hash = uuid_hash + ?,"
+            " version = version + 1 WHERE kb_uuid = ?",
+            (len(items), len(items), sum(embedding_uuid_hash(item["uuid"]) for item in items), kb_uuid),
+        )
+
+    def _append_codes(self, kb_uuid: str, rows: int, dim: int, data: np.ndarray) -> None:
+        """
+        extend the code file with the stored scale. a missing or short code file is left
+        to _quantized, which re-encodes the kb once; without quantization stale codes are
+        removed so that enabling it later cannot pick them up.
+        """
+        codes_path, scale_path = self._codes_paths(kb_uuid)
+        if self._quantization != "int8":
+            self._remove_codes(kb_uuid)
+            return
+        if not os.path.exists(scale_path) or not os.path.exists(codes_path):
+            return
+        scale = np.fromfile(scale_path, dtype=np.float32)
+        if scale.shape[0] != dim or os.path.getsize(codes_path) < rows * dim:
+            return
+        with open(codes_path, "ab") as fp:
+            fp.truncate(rows * dim)
+            fp.write(encode_int8(data, scale).tobytes())
+
+    def _write_codes(self, source_path: str, rows: int, dim: int, codes_path: str, scale_path: str) -> None:
+        """quantize a float32 file page by page into a code file and its scale file"""
+        if rows:
+            matrix = np.memmap(source_path, dtype=np.float32, mode="r", shape=(rows, dim))
+            scale = int8_scale(matrix, EMBEDDING_SCAN_PAGE_SIZE)
+        else:
+            matrix, scale = np.zeros((0, dim), dtype=np.float32), np.ones(dim, dtype=np.float32)
+        with open(codes_path, "wb") as fp:
+            for start in range(0, rows, EMBEDDING_SCAN_PAGE_SIZE):
+                fp.write(encode_int8(matrix[start:start + EMBEDDING_SCAN_PAGE_SIZE], scale).tobytes())
+        scale.astype(np.float32).tofile(scale_path)
+
+    def _replace_codes(self, kb_uuid: str, source_path: str, rows: int, dim: int) -> None:
+        """
+        codes for a float32 file about to replace the kb's file, swapped in by the caller's
+        transaction right before it. without quantization the codes are removed.
+        """
+        if self._quantization != "int8":
+            self._remove_codes(kb_uuid)
+            return
+        codes_path, scale_path = self._codes_paths(kb_uuid)
+        self._write_codes(source_path, rows, dim, f"{codes_path}.tmp", f"{scale_path}.tmp")
+        os.replace(f"{scale_path}.tmp", scale_path)
+        os.replace(f"{codes_path}.tmp", codes_path)
+
+    def _remove_codes(self, kb_uuid: str) -> None:
+        for path in self._codes_paths(kb_uuid):
+            if os.path.exists(path):
+                os.remove(path)
+        self._codes.pop(kb_uuid, None)
+
+    def _tombstone(self, kb_uuid: str, column: str, values: List[str]) -> None:
+        removed: List[str] = []
+        for start in range(0, len(values), 500):
+            part = values[start:start + 500]
+            where = f"WHERE kb_uuid = ? AND deleted = 0 AND {column} IN ({','.join('?' * len(part))})"
+            removed.extend(
+                vector_uuid
+                for (vector_uuid,) in self._conn.execute(f"SELECT uuid FROM vector_store_rows {where}", [kb_uuid, *part])
+            )
+            self._conn.execute(f"UPDATE vector_store_rows SET deleted = 1 {where}", [kb_uuid, *part])
+        if removed:
+            self._conn.execute(
+                "UPDATE vector_store_kbs SET live = live - ?, uuid_hash = uuid_hash - ?, version = version + 1"
+                " WHERE kb_uuid = ?",
+                (len(removed), sum(embedding_uuid_hash(vector_uuid) for vector_uuid in removed), kb_uuid),
+            )
+
+    def add(self, kb_uuid: str, doc_uuid: str, vectors: List[Dict[str, Any]], replace_doc: bool = False) -> None:
+        """only kbs already in the store are written, the others are filled on first use"""
+        if self._meta(kb_uuid) is None:
+            return
+        with self._transaction():
+            if replace_doc:
+                self._tombstone(kb_uuid, "doc_uuid", [doc_uuid])
+            self._append(kb_uuid, [{**item, "doc_uuid": doc_uuid} for item in vectors])
+        self._maybe_compact(kb_uuid)
+
+    def remove(self, kb_uuid: str, vector_uuids: List[str]) -> None:
+        if self._meta(kb_uuid) is None or not vector_uuids:
+            return
+        with self._transaction():
+            self._tombstone(kb_uuid, "uuid", vector_uuids)
+        self._maybe_compact(kb_uuid)
+
+    def remove_doc(self, kb_uuid: str, doc_uuid: str) -> None:
+        if self._meta(kb_uuid) is None:
+            return
+        with self._transaction():
+            self._tombstone(kb_uuid, "doc_uuid", [doc_uuid])
+        self._maybe_compact(kb_uuid)
+
+    def drop(self, kb_uuid: str) -> None:
+        with self._transaction():
+            self._conn.execute("DELETE FROM vector_store_rows WHERE kb_uuid = ?", (kb_uuid,))
+            self._conn.execute("DELETE FROM vector_store_kbs WHERE kb_uuid = ?", (kb_uuid,))
+            self._views.pop(kb_uuid, None)
+            self._remove_codes(kb_uuid)
+            if os.path.exists(self._path(kb_uuid)):
+                os.remove(self._path(kb_uuid))
+
+    def rebuild(
+        self, kb_uuid: str, embed_index: str = KB_DOC_EMBED_INDEX, generation: Optional[int] = None
+    ) -> None:
+        """refill the kb from its ES vector index, stamped with generation"""
+        with self._build_lock(kb_uuid):
+            self._rebuild(kb_uuid, embed_index, generation)
+
+    def _rebuild(self, kb_uuid: str, embed_index: str, generation: Optional[int]) -> None:
+        """
+        stream the vectors into a staging file and table, then swap both in with one
+        transaction: readers (in any process) see the old copy or the new one, never a
+        partial kb. the caller holds the build lock of the kb.
+        """
+        path = self._path(kb_uuid)
+        staging_path = f"{path}.rebuild"
+        synced_at = int(time.time() * 1000)
+        with self._transaction():
+            self._conn.execute("DELETE FROM vector_store_staging WHERE kb_uuid = ?", (kb_uuid,))
+        dim: Optional[int] = None
+        rows = 0
+        uuid_hash = 0
+        with open(staging_path, "wb") as fp:
+            page: List[Dict[str, Any]] = []
+            for item in iter_doc_embeddings(kb_uuid, index=embed_index):
+                embedding = item.get("embedding")
+                if not embedding:
+                    continue
+                dim = dim or len(embedding)
+                if len(embedding) != dim:
+                    continue
+                page.append(item)
+                if len(page) >= EMBEDDING_SCAN_PAGE_SIZE:
+                    uuid_hash += self._stage_page(kb_uuid, fp, rows, page)
+                    rows += len(page)
+                    page = []
+            if page:
+                uuid_hash += self._stage_page(kb_uuid, fp, rows, page)
+                rows += len(page)
+        staged_codes = self._quantization == "int8" and dim is not None
+        if staged_codes:
+            codes_path, scale_path = self._codes_paths(kb_uuid)
+            self._write_codes(staging_path, rows, dim, f"{codes_path}.rebuild", f"{scale_path}.rebuild")
+
+        with self._transaction():
+            previous = self._meta(kb_uuid)
+            self._conn.execute("DELETE FROM vector_store_rows WHERE kb_uuid = ?", (kb_uuid,))
+            self._conn.execute("DELETE FROM vector_store_kbs WHERE kb_uuid = ?", (kb_uuid,))
+            if dim is not None:
+                self._conn.execute(
+                    "INSERT INTO vector_store_rows (kb_uuid, row, uuid, doc_uuid, chunk, chunk_hash, create_at, norm)"
+                    " SELECT kb_uuid, row, uuid, doc_uuid, chunk, chunk_hash, create_at, norm"
+                    " FROM vector_store_staging WHERE kb_uuid = ?",
+                    (kb_uuid,),
+                )
+                self._conn.execute(
+                    "INSERT INTO vector_store_kbs (kb_uuid, dim, rows, live, version, generation, uuid_hash, synced_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kb_uuid, dim, rows, rows, (previous[3] + 1) if previous else 0, generation, uuid_hash, synced_at),
+                )
+                if staged_codes:
+                    os.replace(f"{scale_path}.rebuild", scale_path)
+                    os.replace(f"{codes_path}.rebuild", codes_path)
+                else:
+                    self._remove_codes(kb_uuid)
+                os.replace(staging_path, path)
+            else:
+                os.remove(staging_path)
+                if os.path.exists(path):
+                    os.remove(path)
+                self._remove_codes(kb_uuid)
+            self._conn.execute("DELETE FROM vector_store_staging WHERE kb_uuid = ?", (kb_uuid,))
+            self._views.pop(kb_uuid, None)
+            self._codes.pop(kb_uuid, None)
+        self.rebuilds += 1
+
+    def _stage_page(self, kb_uuid: str, fp: Any, first_row: int, items: List[Dict[str, Any]]) -> int:
+        """write a page of a rebuild, returns the uuid hash sum of its vectors"""
+        data = np.asarray([item["embedding"] for item in items], dtype=np.float32)
+        norms = np.linalg.norm(data, axis=1)
+        fp.write(data.tobytes())
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT INTO vector_store_staging"
+                " (kb_uuid, row, uuid, doc_uuid, chunk, chunk_hash, create_at, norm)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        kb_uuid,
+                        first_row + offset,
+                        item["uuid"],
+                        item.get("doc_uuid"),
+                        item.get("chunk", ""),
+                        item.get("chunk_hash"),
+                        item.get("create_at"),
+                        float(norm),
+                    )
+                    for offset, (item, norm) in enumerate(zip(items, norms))
+                ],
+            )
+        return sum(embedding_uuid_hash(item["uuid"]) for item in items)
+
+    def _maybe_compact(self, kb_uuid: str) -> None:
+        meta = self._meta(kb_uuid)
+        if meta is None:
+            return
+        _, rows, live, _ = meta
+        if rows >= _COMPACT_MIN_ROWS and rows - live > rows * self._compact_ratio:
+            self.compact(kb_uuid)
+
+    def compact(self, kb_uuid: str) -> None:
+        """rewrite the vector file with live rows only and renumber the id table"""
+        with self._transaction():
+            meta = self._meta(kb_uuid)
+            if meta is None:
+                return
+            dim, rows, _, _ = meta
+            live_rows = [
+                row for (row,) in self._conn.execute(
+                    "SELECT row FROM vector_store_rows WHERE kb_uuid = ? AND deleted = 0 ORDER BY row",
+                    (kb_uuid,),
+                )
+            ]
+            path = self._path(kb_uuid)
+            if rows:
+                source = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dim))
+                with open(f"{path}.tmp", "wb") as fp:
+                    for start in range(0, len(live_rows), EMBEDDING_SCAN_PAGE_SIZE):
+                        fp.write(np.ascontiguousarray(source[live_rows[start:start + EMBEDDING_SCAN_PAGE_SIZE]]).tobytes())
+                del source
+            else:
+                open(f"{path}.tmp", "wb").close()
+            self._replace_codes(kb_uuid, f"{path}.tmp", len(live_rows), dim)
+            self._conn.execute("DELETE FROM vector_store_rows WHERE kb_uuid = ? AND deleted = 1", (kb_uuid,))
+            # ascending order never collides with a row that has not moved yet
+            self._conn.executemany(
+                "UPDATE vector_store_rows SET row = ? WHERE kb_uuid = ? AND row = ?",
+                [(new_row, kb_uuid, old_row) for new_row, old_row in enumerate(live_rows) if new_row != old_row],
+            )
+            self._conn.execute(
+                "UPDATE vector_store_kbs SET rows = ?, live = ?, version = version + 1 WHERE kb_uuid = ?",
+                (len(live_rows), len(live_rows), kb_uuid),
+            )
+            os.replace(f"{path}.tmp", path)
+        self.compactions += 1
+
+    # ==== reads ====
+
+    def ensure(
+        self,
+        kb_uuid: str,
+        embed_index: str = KB_DOC_EMBED_INDEX,
+        dim: Optional[int] = None,
+        generation: Optional[int] = None,
+    ) -> bool:
+        """
+        whether the kb copy can be served as current as of generation. generation None
+        (the last write may not be searchable in ES yet) serves an existing copy as is,
+        so does an unreachable ES. a missing copy, a copy of another dim (the kb was
+        re-embedded) or one that could not catch up is refreshed in the background
+        and False returned: the caller reads ES meanwhile.
+        """
+        if self._is_current(kb_uuid, embed_index, dim, generation):
+            return True
+        self._refresher.submit(kb_uuid, embed_index, generation, dim)
+        return False
+
+    def _is_current(self, kb_uuid: str, embed_index: str, dim: Optional[int], generation: Optional[int]) -> bool:
+        """a copy stamped with another generation catches up with ES (see catch_up)"""
+        meta = self._meta(kb_uuid)
+        if meta is None or (dim is not None and meta[0] != dim):
+            return False
+        stamp, _, _ = self._stamp(kb_uuid)
+        if generation is None or stamp == generation:
+            return True
+        try:
+            if not catch_up(_KbCopy(self, kb_uuid), kb_uuid, embed_index):
+                return False
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"[WARN] vector store serving kb {kb_uuid} without ES check: {exc}")
+            return True
+        with self._transaction():
+            self._conn.execute("UPDATE vector_store_kbs SET generation = ? WHERE kb_uuid = ?", (generation, kb_uuid))
+        if time.monotonic() - self._verified_at.get(kb_uuid, 0.0) > LOCAL_COPY_VERIFY_SECONDS:
+            self._refresher.submit(kb_uuid, embed_index, generation, dim)
+        return True
+
+    def refresh(
+        self,
+        kb_uuid: str,
+        embed_index: str = KB_DOC_EMBED_INDEX,
+        generation: Optional[int] = None,
+        dim: Optional[int] = None,
+    ) -> None:
+        """
+        full check of the copy against ES by fingerprint, rebuilding it on a mismatch.
+        a copy of another dim is always rebuilt: a re-embed keeps the vector uuids.
+        """
+        with self._build_lock(kb_uuid):
+            synced_at = int(time.time() * 1000)
+            meta = self._meta(kb_uuid)
+            stamp = self._stamp(kb_uuid)
+            same_dim = meta is not None and (dim is None or meta[0] == dim)
+            if same_dim and stamp[1:] == embedding_fingerprint(kb_uuid, index=embed_index):
+                with self._transaction():
+                    self._conn.execute(
+                        "UPDATE vector_store_kbs SET generation = ?, synced_at = ? WHERE kb_uuid = ? AND live = ?"
+                        " AND uuid_hash = ?",
+                        (generation, synced_at, kb_uuid, stamp[1], stamp[2]),
+                    )
+            else:
+                self._rebuild(kb_uuid, embed_index, generation)
+            self._verified_at[kb_uuid] = time.monotonic()
+
+    def _view(self, kb_uuid: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """memmap of the vector file and 1/norm per row (0 for tombstones)"""
+        meta = self._meta(kb_uuid)
+        if meta is None or meta[1] == 0:
+            return None
+        dim, rows, _, version = meta
+        path = self._path(kb_uuid)
+        stat = os.stat(path)
+        identity = (stat.st_ino, stat.st_size)
+        if stat.st_size < rows * dim * 4:
+            # the file was swapped by a rebuild or compaction after meta was read
+            meta = self._meta(kb_uuid)
+            if meta is None or meta[1] == 0:
+                return None
+            dim, rows, _, version = meta
+            stat = os.stat(path)
+            identity = (stat.st_ino, stat.st_size)
+        with self._lock:
+            cached = self._views.get(kb_uuid)
+            if cached and cached[0] == version and cached[1] == identity:
+                return cached[2], cached[3]
+            inv_norms = np.zeros(rows, dtype=np.float32)
+            for row, norm in self._conn.execute(
+                "SELECT row, norm FROM vector_store_rows WHERE kb_uuid = ? AND deleted = 0 AND norm > 0",
+                (kb_uuid,),
+            ):
+                inv_norms[row] = 1.0 / norm
+            matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dim))
+            self._views[kb_uuid] = (version, identity, matrix, inv_norms)
+            return matrix, inv_norms
+
+    def _quantized(self, kb_uuid: str, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """memmapped codes covering the rows of matrix and their scale"""
+        rows, dim = matrix.shape
+        codes_path, scale_path = self._codes_paths(kb_uuid)
+        stat = os.stat(codes_path) if os.path.exists(codes_path) else None
+        if stat is None or stat.st_size < rows * dim or not os.path.exists(scale_path):
+            # codes of a store filled before quantization was enabled, or of an
+            # append that failed after its float32 rows were written
+            self._requantize(kb_uuid)
+            stat = os.stat(codes_path)
+        identity = (stat.st_ino, stat.st_size)
+        with self._lock:
+            cached = self._codes.get(kb_uuid)
+            if cached and cached[0] == identity and cached[1].shape[0] == rows:
+                return cached[1], cached[2]
+            codes = np.memmap(codes_path, dtype=np.int8, mode="r", shape=(rows, dim))
+            scale = np.fromfile(scale_path, dtype=np.float32)
+            self._codes[kb_uuid] = (identity, codes, scale)
+            return codes, scale
+
+    def _requantize(self, kb_uuid: str) -> None:
+        """encode the whole kb again, holding the write lock so no append interleaves"""
+        with self._transaction():
+            meta = self._meta(kb_uuid)
+            if meta is None:
+                return
+            dim, rows, _, _ = meta
+            codes_path, scale_path = self._codes_paths(kb_uuid)
+            self._write_codes(self._path(kb_uuid), rows, dim, f"{codes_path}.tmp", f"{scale_path}.tmp")
+            os.replace(f"{scale_path}.tmp", scale_path)
+            os.replace(f"{codes_path}.tmp", codes_path)
+
+    def search(
+        self, kb_uuid: str, query_vector: List[float], top_k: int, score_threshold: float = -1.0
+    ) -> List[Dict[str, Any]]:
+        view = self._view(kb_uuid)
+        if view is None:
+            return []
+        matrix, inv_norms = view
+        if matrix.shape[1] != len(query_vector):
+            return []
+        if self._quantization == "int8":
+            codes, scale = self._quantized(kb_uuid, matrix)
+            hits = quantized_top_k(
+                codes, scale, matrix, query_vector, top_k, self._oversample, score_threshold, row_weights=inv_norms
+            )
+        else:
+            scores = (matrix @ normalize(query_vector)) * inv_norms
+            scores[inv_norms == 0] = -np.inf
+            hits = top_k_indices(scores, top_k, score_threshold)
+        if not hits:
+            return []
+        with self._lock:
+            found = {
+                row: (doc_uuid, chunk)
+                for row, doc_uuid, chunk in self._conn.execute(
+                    "SELECT row, doc_uuid, chunk FROM vector_store_rows WHERE kb_uuid = ? AND row IN (%s)"
+                    % ",".join("?" * len(hits)),
+                    [kb_uuid, *[row for row, _ in hits]],
+                )
+            }
+        return [
+            {"kb_uuid": kb_uuid, "doc_uuid": found[row][0], "chunk": found[row][1], "score": score}
+            for row, score in hits
+            if row in found
+        ]
+
+    def iter_vectors(self, kb_uuid: str, page_size: int = EMBEDDING_SCAN_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """live vector docs in the same shape as kb_doc_embed_index sources"""
+        view = self._view(kb_uuid)
+        if view is None:
+            return
+        matrix, _ = view
+        last_row = -1
+        while True:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT row, uuid, doc_uuid, chunk, chunk_hash, create_at FROM vector_store_rows"
+                    " WHERE kb_uuid = ? AND deleted = 0 AND row > ? ORDER BY row LIMIT ?",
+                    (kb_uuid, last_row, page_size),
+                ).fetchall()
+            for row, uuid_, doc_uuid, chunk, chunk_hash, create_at in page:
+                if row >= matrix.shape[0]:
+                    return
+                yield {
+                    "uuid": uuid_,
+                    "kb_uuid": kb_uuid,
+                    "doc_uuid": doc_uuid,
+                    "chunk": chunk,
+                    "chunk_hash": chunk_hash,
+                    "embedding": matrix[row].tolist(),
+                    "create_at": create_at,
+                }
+            if len(page) < page_size:
+                return
+            last_row = page[-1][0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            kbs, rows, live = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(SUM(live), 0) FROM vector_store_kbs"
+            ).fetchone()
+            size = self._conn.execute("SELECT COALESCE(SUM(rows * dim * 4), 0) FROM vector_store_kbs").fetchone()[0]
+        # code files on disk, one byte per value
+        quantized = size // 4 if self._quantization == "int8" else 0
+        return {
+            "kbs": kbs,
+            "rows": rows,
+            "live": live,
+            "bytes": size,
+            "quantization": self._quantization,
+            "quantized_bytes": quantized,
+            "rebuilds": self.rebuilds,
+            "compactions": self.compactions,
+        }
+
+
+class _KbCopy:
+    """one kb of the store in the shape catch_up expects from a local copy"""
+
+    def __init__(self, store: VectorStore, kb_uuid: str):
+        self._store = store
+        self._kb_uuid = kb_uuid
+
+    def __len__(self) -> int:
+        meta = self._store._meta(self._kb_uuid)
+        return meta[2] if meta else 0
+
+    @property
+    def synced_at(self) -> Optional[int]:
+        with self._store._lock:
+            row = self._store._conn.execute(
+                "SELECT synced_at FROM vector_store_kbs WHERE kb_uuid = ?", (self._kb_uuid,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @synced_at.setter
+    def synced_at(self, value: int) -> None:
+        with self._store._transaction():
+            self._store._conn.execute(
+                "UPDATE vector_store_kbs SET synced_at = ? WHERE kb_uuid = ?", (value, self._kb_uuid)
+            )
+
+    def doc_vector_uuids(self, doc_uuids: set) -> List[str]:
+        found: List[str] = []
+        values = list(doc_uuids)
+        with self._store._lock:
+            for start in range(0, len(values), 500):
+                part = values[start:start + 500]
+                found.extend(
+                    vector_uuid
+                    for (vector_uuid,) in self._store._conn.execute(
+                        "SELECT uuid FROM vector_store_rows WHERE kb_uuid = ? AND deleted = 0"
+                        f" AND doc_uuid IN ({','.join('?' * len(part))})",
+                        [self._kb_uuid, *part],
+                    )
+                )
+        return found
+
+    def remove(self, vector_uuids: List[str]) -> None:
+        self._store.remove(self._kb_uuid, vector_uuids)
+
+    def add(self, doc_uuid: str, vectors: List[Dict[str, Any]]) -> None:
+        self._store.add(self._kb_uuid, doc_uuid, vectors)
+
+
+_store: Optional[VectorStore] = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store() -> Optional[VectorStore]:
+    """get the mmap vector store (singleton pattern), None when disabled"""
+    global _store
+    if not VECTOR_STORE_ENABLED:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = VectorStore(
+                    VECTOR_STORE_DIR,
+                    VECTOR_STORE_COMPACT_RATIO,
+                    quantization=VECTOR_QUANTIZATION,
+                    oversample=QUANTIZATION_OVERSAMPLE,
+                )
+    return _store
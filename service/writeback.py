@@ -0,0 +1,205 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_LEASE_SECONDS = 120
+_POLL_SECONDS = 1.0
+_BACKOFF_BASE = 2.0
+_BACKOFF_MAX = 300.0
+
+
+class WriteBackQueue:
+    """
+    bounded background job queue with a durable sqlite spool.
+    every job is spooled before submit returns; workers lease a job, run the
+    handler and delete it on success, failures are retried with backoff until
+    max_attempts, then kept in the spool as dead. spooled jobs survive restarts
+    and are replayed by the next process that starts workers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Dict[str, Any]], None],
+        spool_path: str,
+        capacity: int,
+        workers: int,
+        max_attempts: int,
+    ):
+        directory = os.path.dirname(spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self._handler = handler
+        self._conn = sqlite3.connect(spool_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS writeback_jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " queue TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " dead INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+        self._queue: "queue.Queue[int]" = queue.Queue(maxsize=max(1, capacity))
+        self._capacity = max(1, capacity)
+        self._worker_count = max(1, workers)
+        self._max_attempts = max(1, max_attempts)
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_lag = 0.0
+
+    # ==== lifecycle ====
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for idx in range(self._worker_count):
+                thread = threading.Thread(
+                    target=self._worker, name=f"{self.name}-writeback-{idx}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # ==== producer ====
+
+    def submit(self, payload: Dict[str, Any]) -> bool:
+        """spool a job, return False when the queue is at capacity"""
+        now = time.time()
+        with self._db_lock:
+            pending = self._conn.execute(
+                "SELECT COUNT(*) FROM writeback_jobs WHERE queue = ? AND dead = 0", (self.name,)
+            ).fetchone()[0]
+            if pending >= self._capacity:
+                return False
+            cursor = self._conn.execute(
+                "INSERT INTO writeback_jobs (queue, payload, enqueued_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (self.name, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            self._conn.commit()
+            job_id = cursor.lastrowid
+        self.start()
+        try:
+            self._queue.put_nowait(job_id)
+        except queue.Full:
+            pass  # picked up by the spool sweep
+        return True
+
+    # ==== workers ====
+
+    def _worker(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                job_id = self._queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                self._sweep()
+                continue
+            self._run_job(job_id)
+
+    def _sweep(self) -> None:
+        """requeue spooled jobs that are due: retries, replays after restart, overflow"""
+        now = time.time()
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT id FROM writeback_jobs WHERE queue = ? AND dead = 0"
+                " AND next_attempt_at <= ? AND lease_until < ? ORDER BY id LIMIT ?",
+                (self.name, now, now, self._capacity),
+            ).fetchall()
+        for (job_id,) in rows:
+            try:
+                self._queue.put_nowait(job_id)
+            except queue.Full:
+                break
+
+    def _lease(self, job_id: int) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "UPDATE writeback_jobs SET lease_until = ? WHERE id = ? AND dead = 0"
+                " AND next_attempt_at <= ? AND lease_until < ?",
+                (now + _LEASE_SECONDS, job_id, now, now),
+            )
+            self._conn.commit()
+            if cursor.rowcount != 1:
+                return None  # done, dead, not due, or leased by another worker/process
+            row = self._conn.execute(
+                "SELECT payload, enqueued_at, attempts FROM writeback_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return {"payload": json.loads(row[0]), "enqueued_at": row[1], "attempts": row[2]}
+
+    def _run_job(self, job_id: int) -> None:
+        job = self._lease(job_id)
+        if job is None:
+            return
+        try:
+            self._handler(job["payload"])
+        except Exception as exc:  # pylint: disable=broad-except
+            self._fail(job_id, job["attempts"] + 1, exc)
+            return
+        with self._db_lock:
+            self._conn.execute("DELETE FROM writeback_jobs WHERE id = ?", (job_id,))
+            self._conn.commit()
+        self.processed += 1
+        self.last_lag = time.time() - job["enqueued_at"]
+
+    def _fail(self, job_id: int, attempts: int, exc: Exception) -> None:
+        dead = attempts >= self._max_attempts
+        delay = min(_BACKOFF_MAX, _BACKOFF_BASE ** attempts)
+        with self._db_lock:
+            self._conn.execute(
+                "UPDATE writeback_jobs SET attempts = ?, next_attempt_at = ?, lease_until = 0,"
+                " dead = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, int(dead), str(exc)[:500], job_id),
+            )
+            self._conn.commit()
+        if dead:
+            self.failed += 1
+            print(f"[ERROR] {self.name} write-back job {job_id} gave up after {attempts} attempts: {exc}")
+        else:
+            self.retries += 1
+            print(f"[WARN] {self.name} write-back job {job_id} failed, retry in {delay:.0f}s: {exc}")
+
+    # ==== metrics ====
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._db_lock:
+            depth, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(enqueued_at) FROM writeback_jobs WHERE queue = ? AND dead = 0",
+                (self.name,),
+            ).fetchone()
+            dead = self._conn.execute(
+                "SELECT COUNT(*) FROM writeback_jobs WHERE queue = ? AND dead = 1", (self.name,)
+            ).fetchone()[0]
+        return {
+            "depth": depth,
+            "capacity": self._capacity,
+            "workers": len(self._threads),
+            "oldest_lag_seconds": now - oldest if oldest else 0.0,
+            "last_lag_seconds": self.last_lag,
+            "processed": self.processed,
+            "retries": self.retries,
+            "failed": self.failed,
+            "dead": dead,
+        }